@@ -13,7 +13,7 @@ Provide a simple GUI and command line tool to perform compressing and decompress
 
 
 def is_gui(args):
-    return args.compress is None and args.decompress is None
+    return args.compress is None and args.decompress is None and args.batch is None
 
 
 def run_gui():
@@ -28,12 +28,51 @@ def main():
     parser.add_argument('--compress', '-c', metavar='IMG_PATH',
                         help='compress the image via cmd line with a certain style')
     parser.add_argument('--decompress', '-d', metavar='HIC', help='decompress the hic image via cmd line')
+    parser.add_argument('--max-level', '-l', type=int, default=0,
+                        help='decompress a HIC image at 1/2^MAX_LEVEL scale, skipping its finest levels')
+    parser.add_argument('--region', '-r', type=int, nargs=4, metavar=('TOP', 'LEFT', 'HEIGHT', 'WIDTH'),
+                        help='decompress only this part of a JPEG image')
+    parser.add_argument('--batch', '-b', metavar='DIR_OR_GLOB',
+                        help='compress (or decompress the hic files among) many images on a pool of processes')
+    parser.add_argument('--batch-workers', type=int, help='processes for --batch, defaults to the number of cores')
     parser.add_argument('--compression', '-s', metavar='STYLE',
                         choices=[model.Compression.HIC.value, model.Compression.JPEG.value],
                         help='dictate which compression algorithm we use', default=model.Compression.HIC.value)
+    parser.add_argument('--huffman-tables', choices=[t.value for t in model.HuffmanTables],
+                        default=settings.JPEG_HUFFMAN_TABLES.value,
+                        help='build Huffman trees for every JPEG image or use the standard ones, which coarsens the '
+                             'luminance coefficients by a power of 2 until they fit')
+    parser.add_argument('--symbols', choices=[s.value for s in model.Symbols], default=settings.SYMBOLS.value,
+                        help='code runs of zeros and values separately or as joint (zeros, size) symbols')
+    parser.add_argument('--entropy', choices=[e.value for e in model.Entropy], default=settings.ENTROPY.value,
+                        help='entropy coder of a HIC file, Huffman codes or interleaved rANS')
+    parser.add_argument('--wavelet', choices=[w.value for w in model.Wavelet], default=settings.WAVELET.value,
+                        help='wavelet of a HIC file, cdf5/3 and cdf9/7 are computed by lifting')
+    parser.add_argument('--lossless', default=False, action='store_true',
+                        help='code a HIC file without losing anything, implies the cdf5/3 wavelet')
     parser.add_argument('--output', '-o', metavar='OUT', help='output path', default='.')
     parser.add_argument('--verbose', '-v', help='control the debug flag', default=False, action='store_true')
+    parser.add_argument('--workers', '-w', type=int, help='run the color channels on this many workers',
+                        default=settings.CHANNEL_WORKERS)
+    parser.add_argument('--executor', '-e', choices=["thread", "process"], help='what the channel workers are',
+                        default=settings.CHANNEL_EXECUTOR)
+    parser.add_argument('--tile-workers', '-t', type=int, help='code the wavelet tiles on this many processes',
+                        default=settings.TILE_WORKERS)
+    parser.add_argument('--restart-workers', type=int, default=settings.RESTART_WORKERS,
+                        help='decode the restart segments of a JPEG channel on this many processes')
+    parser.add_argument('--profile', '-p', metavar='OUT', help='profile the command line run into OUT')
+    parser.add_argument('--profile-style', choices=["cprofile", "collapsed"], default="cprofile",
+                        help='cProfile stats or collapsed stacks of our own stage timings')
     args = parser.parse_args()
+    settings.CHANNEL_WORKERS = args.workers
+    settings.TILE_WORKERS = args.tile_workers
+    settings.CHANNEL_EXECUTOR = args.executor
+    settings.RESTART_WORKERS = args.restart_workers
+    settings.JPEG_HUFFMAN_TABLES = model.HuffmanTables(args.huffman_tables)
+    settings.SYMBOLS = model.Symbols(args.symbols)
+    settings.ENTROPY = model.Entropy(args.entropy)
+    settings.WAVELET = model.Wavelet.CDF_5_3 if args.lossless else model.Wavelet(args.wavelet)
+    settings.WAVELET_LOSSLESS = args.lossless
 
     if not args.verbose:
         print("=== Suppressing debug messages ==")
@@ -41,10 +80,20 @@ def main():
 
     if is_gui(args):
         run_gui()
-    elif args.compress is not None:
+    elif args.profile is not None:
+        run.profile(lambda: run_command(args), args.profile, args.profile_style)
+    else:
+        run_command(args)
+
+
+def run_command(args):
+    if args.compress is not None:
         run.compress(args.compress, args.output, model.Compression(args.compression))
     elif args.decompress is not None:
-        run.decompress(args.decompress)
+        run.decompress(args.decompress, max_level=args.max_level,
+                       region=None if args.region is None else tuple(args.region))
+    elif args.batch is not None:
+        run.batch(args.batch, args.output, model.Compression(args.compression), workers=args.batch_workers)
     else:
         raise RuntimeError("Illegal state")
 
@@ -0,0 +1,50 @@
+import argparse
+import json
+import sys
+
+import hiccup.model as model
+import hiccup.settings as settings
+
+from bin.benchmark import suite
+
+"""
+python -m bin.benchmark --output results.json
+python -m bin.benchmark --compare results.json
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time hiccup stage by stage")
+    parser.add_argument('--images', '-i', metavar='GLOB', help='images to run over, defaults to resources/')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 0.5, 0.25], help='resize every image by these')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='timed runs per image, we report the median')
+    parser.add_argument('--compression', '-s', choices=[c.value for c in model.Compression], action='append',
+                        help='only time these compressions')
+    parser.add_argument('--output', '-o', metavar='JSON', help='write the results here')
+    parser.add_argument('--compare', '-c', metavar='BASELINE', help='flag stages slower than this earlier output')
+    parser.add_argument('--threshold', type=float, default=0.1, help='fraction slower that counts as a regression')
+    parser.add_argument('--floor', type=float, default=0.005, help='seconds slower that is still just noise')
+    args = parser.parse_args()
+    settings.DEBUG = False
+
+    compressions = None if args.compression is None else [model.Compression(c) for c in args.compression]
+    results = suite.run(suite.images(args.images), args.scales, args.repeat, compressions=compressions)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = suite.compare(baseline, results, args.threshold, args.floor)
+        for r in regressions:
+            print("REGRESSION %-24s x%-5s %-4s %-10s %8.4fs -> %8.4fs" % (
+                r["image"], r["scale"], r["compression"], r["stage"], r["baseline"], r["current"]))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against " + args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import glob
+import os
+import statistics
+import time
+
+import cv2
+
+import hiccup.codec as codec
+import hiccup.compression as compression
+import hiccup.hicimage as hic
+import hiccup.model as model
+import hiccup.settings as settings
+
+"""
+Time every stage of both compressions over a set of images at a few scales. Results are plain dicts so they go straight
+to json and back for comparing against a baseline.
+"""
+
+RESOURCES = os.path.join(os.path.dirname(__file__), "..", "..", "resources")
+
+STAGES = {
+    model.Compression.JPEG: [
+        ("compress", compression.jpeg_compression),
+        ("encode", codec.jpeg_encode),
+        ("serialize", lambda h: h.byte_stream()),
+        ("parse", hic.HicImage.from_bytes),
+        ("decode", codec.jpeg_decode),
+        ("decompress", compression.jpeg_decompression)
+    ],
+    model.Compression.HIC: [
+        ("compress", compression.wavelet_compression),
+        ("encode", codec.wavelet_encode),
+        ("serialize", lambda h: h.byte_stream()),
+        ("parse", hic.HicImage.from_bytes),
+        ("decode", codec.wavelet_decode),
+        ("decompress", compression.wavelet_decompression)
+    ]
+}
+ENCODE_STAGES = ["compress", "encode", "serialize"]
+DECODE_STAGES = ["parse", "decode", "decompress"]
+
+
+def images(pattern=None):
+    pattern = os.path.join(RESOURCES, "*") if pattern is None else pattern
+    return sorted([p for p in glob.glob(pattern) if cv2.haveImageReader(p)])
+
+
+def scaled(rgb, scale: float):
+    if scale == 1:
+        return rgb
+    # cv2 wants (width, height)
+    (height, width) = rgb.shape[:2]
+    return cv2.resize(rgb, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+def summarize(times: list) -> dict:
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "runs": times
+    }
+
+
+def time_stages(rgb, c: model.Compression, repeat: int) -> dict:
+    """
+    Every repetition runs the whole pipeline, each stage feeding on what the last gave back
+    """
+    times = dict([(name, []) for (name, _) in STAGES[c]])
+    size = 0
+    for _ in range(repeat):
+        value = rgb
+        for (name, f) in STAGES[c]:
+            start = time.perf_counter()
+            value = f(value)
+            times[name].append(time.perf_counter() - start)
+            if name == "serialize":
+                size = len(value)
+
+    stages = dict([(name, summarize(t)) for (name, t) in times.items()])
+    return {
+        "bytes": size,
+        "stages": stages,
+        "encode": sum([stages[name]["median"] for name in ENCODE_STAGES]),
+        "decode": sum([stages[name]["median"] for name in DECODE_STAGES])
+    }
+
+
+def run(paths: list, scales: list, repeat: int, compressions=None, log=print) -> dict:
+    compressions = list(model.Compression) if compressions is None else compressions
+    results = []
+    for path in paths:
+        original = cv2.imread(path)
+        for scale in scales:
+            rgb = scaled(original, scale)
+            for c in compressions:
+                result = {
+                    "image": os.path.basename(path),
+                    "scale": scale,
+                    "shape": list(rgb.shape[:2]),
+                    "compression": c.value
+                }
+                result.update(time_stages(rgb, c, repeat))
+                log("%-24s x%-5s %-4s encode %8.4fs decode %8.4fs %9d bytes" % (
+                    result["image"], scale, c.value, result["encode"], result["decode"], result["bytes"]))
+                results.append(result)
+
+    return {
+        "settings": dict([(k, str(v)) for (k, v) in vars(settings).items() if k.isupper()]),
+        "repeat": repeat,
+        "results": results
+    }
+
+
+def key(result: dict) -> tuple:
+    return result["image"], result["scale"], result["compression"]
+
+
+def compare(baseline: dict, current: dict, threshold: float, floor: float) -> list:
+    """
+    Medians that got slower than the baseline by more than threshold (a fraction), ignoring anything that moved less
+    than floor seconds since that's just noise
+    """
+    old = dict([(key(r), r) for r in baseline["results"]])
+    regressions = []
+    for result in current["results"]:
+        if key(result) not in old:
+            continue
+        before = old[key(result)]
+        for (stage, times) in result["stages"].items():
+            if stage not in before["stages"]:
+                continue
+            was = before["stages"][stage]["median"]
+            now = times["median"]
+            if now - was > floor and now > was * (1 + threshold):
+                regressions.append({
+                    "image": result["image"],
+                    "scale": result["scale"],
+                    "compression": result["compression"],
+                    "stage": stage,
+                    "baseline": was,
+                    "current": now
+                })
+    return regressions
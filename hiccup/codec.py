@@ -1,5 +1,5 @@
 import functools
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 
@@ -8,7 +8,9 @@ import hiccup.model as model
 import hiccup.utils as utils
 import hiccup.transform as transform
 import hiccup.huffman as huffman
+import hiccup.rans as rans
 import hiccup.hicimage as hic
+import hiccup.instrument as instrument
 
 """
 Encoding/Decoding functionality aka
@@ -16,15 +18,27 @@ Encoding/Decoding functionality aka
     Huffman Encoding - looking at papers, you can rely on the default Huffman encodings for say jpeg but then for 
     our eventual Wavelet encoding, the same Huffman encodings are definitely not applicable. To be consistent, and 
     avoid having to copy the entire RL Huffman table, I'll generate on the fly and persist. This is expensive for
-    smaller images, but for very large images this is a small penalty.
+    smaller images, but for very large images this is a small penalty. JPEG_HUFFMAN_TABLES can still pick the standard
+    tables for the JPEG channels whose values they fit. SYMBOLS picks whether the run lengths get a tree of their own
+    or are folded into joint (zeros, size) symbols with the raw value bits after them, for both schemes.
+    ENTROPY swaps the Huffman codes of HIC files for rANS, the "trees" are then rANS models, see rans.py.
 """
 
+CHANNELS = ["lum", "cr", "cb"]  # the order channels are laid out in the payloads
+
 
 class RunLength:
     @classmethod
     def from_dict(cls, d):
         return cls(d["value"], d["zeros"])
 
+    @classmethod
+    def from_arrays(cls, lengths, values):
+        """
+        Readable view of what run_length_coding() gives back
+        """
+        return [cls(value=t[1], length=t[0]) for t in zip(lengths, values)]
+
     def __init__(self, value=0, length=0):
         self.value = value
         self.length = length
@@ -52,191 +66,319 @@ def differential_coding(blocks: np.ndarray):
     return utils.differences(dc_comps)
 
 
-def run_length_coding(arr: np.ndarray, max_len=0xF) -> List[RunLength]:
+@instrument.timed("rle")
+def run_length_coding(arr: np.ndarray, max_len=0xF, stops=None) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Come up with the run length encoding for a matrix
+    Come up with the run length encoding for a matrix, as two arrays (lengths, values) where lengths counts the zeros
+    before each value. Runs never carry on past any of the positions in stops, those are always written out even if
+    they are zero, so whatever follows a stop can be decoded on its own
     """
+    arr = np.ravel(np.asarray(arr))
+    nonzero = np.flatnonzero(arr)
+    if stops is not None:
+        nonzero = np.union1d(nonzero, stops)
+    values = arr[nonzero]
+    lengths = np.diff(nonzero, prepend=-1) - 1
 
-    def _break_up_rle(code, max_len):
-        l = code["zeros"]
-        div = l // max_len
-        full = {
-            "zeros": max_len - 1,  # minus 1 because we get another for free from the value
-            "value": 0
-        }
-        return ([full] * div) + [{
-            "zeros": l - (div * max_len),
-            "value": code["value"]
-        }]
-
-    def reduction(agg, next):
-        if "value" in agg[-1]:
-            agg.append({"zeros": 0})
-
-        if next == 0:
-            agg[-1]["zeros"] += 1
-            return agg
-
-        if "value" not in agg[-1]:
-            agg[-1]["value"] = next
-
-        return agg
-    utils.debug_msg("Going to determine RLE for %d size array" % len(arr))
-    rl = functools.reduce(reduction, arr, [{"zeros": 0}])
-    utils.debug_msg("%d long RLE created" % len(rl))
     # If the last element has no value then it was 0! That is a special tuple, (0,0)
-    if "value" not in rl[-1]:
-        rl[-1] = {"zeros": 0, "value": 0}
+    if len(nonzero) == 0 or nonzero[-1] != len(arr) - 1:
+        values = np.append(values, np.zeros(1, dtype=values.dtype))
+        lengths = np.append(lengths, 0)
 
     # the goal of RLE in the case of compression is to contain the first symbol (length, size) within a byte
     # so if the length is too long, then we need to break it up
     if max_len is not None:
-        utils.debug_msg("Breaking up RLE lengths that are larger than %d" % max_len)
-        rl = [_break_up_rle(code, max_len) for code in rl]
-        rl = utils.flatten(rl)
-
-    utils.debug_msg("Make RLE objects")
-    return [RunLength.from_dict(r) for r in rl]
-
-
-def decode_run_length(rles: List[RunLength], length: int):
-    arr = []
-    for (i, d) in enumerate(rles):
-        arr.append(d.segment)
-    arr = utils.flatten(arr)
-    # arr = utils.flatten([d.segment for d in rles])
-
-    if rles[-1].is_trailing:
-        fill = length - len(arr)
-        arr += ([0] * fill)
-
-    return arr
-
-
+        splits = lengths // max_len
+        if splits.any():
+            # every split is max_len zeros, max_len - 1 of them plus another for free from the 0 value
+            ends = np.cumsum(splits + 1) - 1
+            broken_lengths = np.full(ends[-1] + 1, max_len - 1, dtype=lengths.dtype)
+            broken_values = np.zeros(ends[-1] + 1, dtype=values.dtype)
+            broken_lengths[ends] = lengths - splits * max_len
+            broken_values[ends] = values
+            lengths, values = broken_lengths, broken_values
+
+    instrument.count("rle runs", len(lengths))
+    return lengths, values
+
+
+@instrument.timed("rle decode")
+def decode_run_length(lengths: np.ndarray, values: np.ndarray, length: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Invert run_length_coding(). Every value lands right after its run of zeros so we just scatter the values into a
+    zeroed buffer of the decoded length, the trailing (0,0) only ever writes a zero
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    values = np.asarray(values)
+    positions = np.cumsum(lengths + 1) - 1
+    if out is None:
+        # without the trailing (0,0) the runs themselves say how long we are
+        if len(positions) > 0 and values[-1] != 0:
+            length = max(length, positions[-1] + 1)
+        out = np.zeros(length, dtype=values.dtype if len(values) > 0 else np.int64)
+    else:
+        out[:] = 0
+
+    fits = positions < len(out)
+    out[positions[fits]] = values[fits]
+    return out
+
+
+@instrument.timed("wavelet encode")
 def wavelet_encode(compressed: model.CompressedImage):
     """
     In brief reading of literature, Huffman coding is still considered for wavelet image compression. There are other
     more effective (and complicated schemes) that I think are out of scope of this project which is just to introduce
     the concepts.
+
+    Every tile gets its own trees and every resolution level of a tile its own bit strings, so a tile can be decoded
+    on its own and only as far down the pyramid as we care to go. See wavelet_payloads() for the layout.
     """
+    tiling = compressed.tiling
+    encoded = utils.channel_map(compressed.as_dict, wavelet_encode_channel)
+    utils.debug_msg("Have encoded %d tiles", len(tiling))
+    return hic.HicImage.wavelet_image(wavelet_payloads(tiling, compressed.coding, encoded))
 
-    def collapse_subbands(k, v):
-        out = [transform.zigzag(l) for l in v]
-        out = utils.flatten(out)
-        return out
 
-    utils.debug_msg("Starting Wavelet encoding")
-    lin_subbands = utils.dict_map(compressed.as_dict, collapse_subbands)
-    utils.debug_msg("Have completed linearizing the subbands")
-    rles = utils.dict_map(lin_subbands, lambda _, v: run_length_coding(v))
-    utils.debug_msg("Have completed the run length encodings")
+def wavelet_payloads(tiling: model.Tiling, coding: model.WaveletCoding, encoded: dict) -> List[hic.Payload]:
+    """
+    Lay out the encoded tiles of every channel. After the image and tile shapes, the restart interval (the second
+    number is spare), the symbols, the entropy coder, the wavelet and its levels and whether we're lossless come the
+    trees of every tile, then the bit strings of the approximations of every tile, then those of the coarsest details
+    and so on. Whoever only wants a smaller image can stop reading early. Within a tile the payloads are grouped by
+    kind over the channels
+    """
+    trees = wavelet_trees(settings.SYMBOLS)
+    tables = [[encoded[k][i][j] for j in range(trees) for k in CHANNELS] for i in range(len(tiling))]
+    groups = (len(encoded[CHANNELS[0]][0]) - trees) // trees
+    levels = [
+        [encoded[k][i][trees * (g + 1) + j] for j in range(trees) for k in CHANNELS]
+        for g in range(groups) for i in range(len(tiling))
+    ]
+    return utils.flatten([
+        [
+            hic.TupP(tiling.shape[0], tiling.shape[1]),
+            hic.TupP(tiling.tile_shape[0], tiling.tile_shape[1]),
+            hic.TupP(settings.WAVELET_RESTART_INTERVAL, 0),
+            hic.PlainStringP(settings.SYMBOLS.value),
+            hic.PlainStringP(settings.ENTROPY.value),
+            hic.PlainStringP(coding.wavelet.value),
+            hic.TupP(coding.levels, int(coding.lossless))
+        ]
+    ] + tables + levels)
+
 
-    values_huffs = utils.dict_map(rles,
-                                  lambda _, v: huffman.HuffmanTree.construct_from_data(v, key_func=lambda t: t.value))
-    length_huffs = utils.dict_map(rles,
-                                  lambda _, v: huffman.HuffmanTree.construct_from_data(v, key_func=lambda t: t.length))
-    utils.debug_msg("Huffman trees are constructed")
+def wavelet_tile_payloads(payloads, max_level: int = 0) -> Tuple[model.Tiling, int, model.Symbols, model.Entropy,
+                                                                 model.WaveletCoding, dict]:
+    """
+    Reverse wavelet_payloads(), the tiling, the restart interval, the symbols, the entropy coder, the wavelet coding and
+    for every channel the payloads of each of its tiles. With max_level the finest max_level levels are left out, and
+    never touched
+    """
+    tiling = model.Tiling(payloads[0].numbers, payloads[1].numbers)
+    restart = payloads[2].numbers[0]
+    symbols = model.Symbols(payloads[3].payload)
+    entropy = model.Entropy(payloads[4].payload)
+    (levels, lossless) = payloads[6].numbers
+    coding = model.WaveletCoding(model.Wavelet(payloads[5].payload), levels, bool(lossless))
+    assert 0 <= max_level <= levels
+    n = len(CHANNELS)
+    trees = wavelet_trees(symbols)
+    per_tile = trees * n
+    groups = levels + 1 - max_level
+    header = 7
+
+    def tile(i, j):
+        tables = [payloads[header + i * per_tile + t * n + j] for t in range(trees)]
+        data = [payloads[header + (g + 1) * len(tiling) * per_tile + i * per_tile + t * n + j]
+                for g in range(groups) for t in range(trees)]
+        return tables + data
+
+    channels = dict([(k, [tile(i, j) for i in range(len(tiling))]) for (j, k) in enumerate(CHANNELS)])
+    return tiling, restart, symbols, entropy, coding, channels
+
+
+def wavelet_trees(symbols: model.Symbols) -> int:
+    """
+    Trees of a tile, which is also how many bit strings every level has. Values and lengths, or the joint symbols
+    """
+    return 1 if symbols == model.Symbols.JOINT else 2
 
-    def encode_huff(d):
-        huffs = [t[1] for t in d.items()]
-        return [huffman_encode(h) for h in huffs]
 
-    def encode_data(d):
-        huffs = [t[1] for t in d.items()]
-        return [huffman_data_encode(h) for h in huffs]
+def wavelet_groups(subbands: list) -> list:
+    """
+    The approximation on its own and then the three details of every level, coarsest first
+    """
+    return [subbands[:1]] + utils.group_tuples(subbands[1:], 3)
 
-    smallest = compressed.luminance_component[0].shape
-    biggest = compressed.luminance_component[-1].shape
 
-    payloads = utils.flatten([
-        encode_huff(values_huffs),
-        encode_huff(length_huffs),
+def wavelet_encode_channel(k, tiles: list) -> List[List[hic.Payload]]:
+    return [wavelet_encode_tile(subbands) for subbands in tiles]
 
-        encode_data(values_huffs),
-        encode_data(length_huffs),
 
-        [
-            hic.TupP(smallest[0], smallest[1]),
-            hic.TupP(biggest[0], biggest[1])
+def wavelet_encode_tile(subbands: list) -> List[hic.Payload]:
+    """
+    Value tree and length tree for the subbands of one channel of a tile, and then the value and length bit strings of
+    every level with those trees. With joint symbols it's one tree and one bit string per level instead, see
+    joint_symbols(). With a restart interval the runs of a level stop every that many coefficients and its bit strings
+    are cut into segments there
+    """
+    restart = settings.WAVELET_RESTART_INTERVAL
+    levels = [np.concatenate([transform.zigzag(l) for l in g]) for g in wavelet_groups(subbands)]
+    if restart > 0:
+        rles = [run_length_coding(l, stops=np.append(np.arange(restart, len(l), restart), len(l)) - 1) for l in levels]
+        # the runs stop at every segment end so the first run at or after a segment start belongs to it
+        segments = [np.searchsorted(np.cumsum(r[0] + 1) - 1, np.arange(0, len(l), restart))
+                    for (r, l) in zip(rles, levels)]
+    else:
+        rles = [run_length_coding(l) for l in levels]
+        segments = [None] * len(levels)
+
+    if settings.SYMBOLS == model.Symbols.JOINT:
+        joints = [joint_symbols(lengths, values) for (lengths, values) in rles]
+        huff = entropy_model(np.concatenate([j[0] for j in joints]))
+        return [huffman_encode(huff)] + [
+            huffman_data_encode(huff, symbols, segments=s, extra=extra)
+            for ((symbols, extra), s) in zip(joints, segments)
         ]
-    ])
-    return hic.HicImage.wavelet_image(payloads)
+
+    huffs = [entropy_model(np.concatenate([r[1] for r in rles])), entropy_model(np.concatenate([r[0] for r in rles]))]
+    data = [
+        [huffman_data_encode(huffs[0], values, segments=s), huffman_data_encode(huffs[1], lengths, segments=s)]
+        for ((lengths, values), s) in zip(rles, segments)
+    ]
+    return [huffman_encode(h) for h in huffs] + utils.flatten(data)
 
 
-def wavelet_decode_pull_subbands(data, shapes):
-    offset = utils.size(shapes[0])
-    subbands = [transform.izigzag(np.array(data[:offset]), shapes[0])]
+@instrument.timed("wavelet decode")
+def wavelet_decode(hic: hic.HicImage, max_level: int = 0) -> model.CompressedImage:
+    """
+    max_level leaves off that many of the finest levels, giving us a 1/2^max_level scale image
+    """
+    assert hic.hic_type == model.Compression.HIC
+    (tiling, restart, symbols, entropy, coding, channels) = wavelet_tile_payloads(hic.payloads, max_level=max_level)
+    decode = functools.partial(wavelet_decode_channel, tiling=tiling, coding=coding, restart=restart, symbols=symbols,
+                               entropy=entropy)
+    channels = utils.channel_map(channels, decode)
+    utils.debug_msg("Decoded %d tiles", len(tiling))
+    return model.CompressedImage.from_dict(channels, tiling=tiling, coding=coding)
 
-    for i in range(len(shapes)):
-        subbands.append(transform.izigzag(np.array(data[offset:offset + utils.size(shapes[i])]), shapes[i]))
-        offset += utils.size(shapes[i])
 
-        subbands.append(transform.izigzag(np.array(data[offset:offset + utils.size(shapes[i])]), shapes[i]))
-        offset += utils.size(shapes[i])
+def wavelet_decode_channel(k, tiles: list, tiling: model.Tiling, coding: model.WaveletCoding, restart: int = 0,
+                           symbols: model.Symbols = model.Symbols.SEPARATE,
+                           entropy: model.Entropy = model.Entropy.HUFFMAN) -> list:
+    return [wavelet_decode_tile(payloads, shape, coding, restart, symbols, entropy)
+            for (payloads, shape) in zip(tiles, tiling.tile_shapes)]
 
-        subbands.append(transform.izigzag(np.array(data[offset:offset + utils.size(shapes[i])]), shapes[i]))
-        offset += utils.size(shapes[i])
+
+def wavelet_decode_tile(payloads: List[hic.Payload], shape, coding: model.WaveletCoding, restart: int = 0,
+                        symbols: model.Symbols = model.Symbols.SEPARATE,
+                        entropy: model.Entropy = model.Entropy.HUFFMAN) -> list:
+    """
+    Reverse wavelet_encode_tile() for as many levels as we were given, shape is the size of the tile in pixels.
+    Restart segments are decoded one after the other (the tiles are what goes on processes), a corrupt one leaves
+    its coefficients at zero
+    """
+    trees = wavelet_trees(symbols)
+    huffs = [entropy_decode(p, entropy) for p in payloads[:trees]]
+    shapes = transform.wavelet_subband_shapes(shape, coding.wavelet, coding.levels)
+
+    subbands = []
+    for (g, i) in enumerate(range(trees, len(payloads), trees)):
+        # the approximation is the same shape as the coarsest details
+        band_shape = shapes[max(g - 1, 0)]
+        bands = 1 if g == 0 else 3
+        size = utils.size(band_shape)
+        if symbols == model.Symbols.JOINT:
+            data = wavelet_decode_joint(payloads[i], huffs[0], bands * size, restart)
+        elif restart > 0:
+            data = wavelet_decode_segments(payloads[i], huffs[0], payloads[i + 1], huffs[1], bands * size, restart)
+        else:
+            values = huffman_data_decode(payloads[i], huffs[0])
+            lengths = huffman_data_decode(payloads[i + 1], huffs[1])
+            data = decode_run_length(lengths, values, bands * size)
+        subbands += [transform.izigzag(data[b * size:(b + 1) * size], band_shape) for b in range(bands)]
     return subbands
 
 
-def wavelet_decoded_subbands_shapes(min_shape, max_shape):
+def wavelet_decode_segments(values: hic.SegmentsP, value_huff: huffman.HuffmanTree, lengths: hic.SegmentsP,
+                            length_huff: huffman.HuffmanTree, length: int, restart: int) -> np.ndarray:
+    bounds = np.append(np.arange(0, length, restart), length)
+    assert len(values) == len(lengths) == len(bounds) - 1
+    out = np.zeros(length, dtype=np.int64)
+    for (i, (a, b)) in enumerate(zip(bounds[:-1], bounds[1:])):
+        data = decode_run_length_segment(value_huff, length_huff, values.segment(i), lengths.segment(i), b - a)
+        if data is None:
+            utils.debug_msg("Restart segment of %d coefficients is corrupt, leaving it blank", b - a)
+        else:
+            out[a:b] = data
+    return out
+
+
+def wavelet_decode_joint(data: hic.Payload, huff: huffman.HuffmanTree, length: int, restart: int) -> np.ndarray:
+    """
+    The length coefficients of a level coded with joint symbols, like wavelet_decode_segments() with a restart interval
     """
-    We just do Haar or Daubechie, assume power of 2
+    if restart <= 0:
+        (lengths, values) = invert_joint_symbols(*huff.decode_data(data.payload, extra=JOINT_EXTRA))
+        return decode_run_length(lengths, values, length)
+
+    bounds = np.append(np.arange(0, length, restart), length)
+    assert len(data) == len(bounds) - 1
+    out = np.zeros(length, dtype=np.int64)
+    for (i, (a, b)) in enumerate(zip(bounds[:-1], bounds[1:])):
+        try:
+            (lengths, values) = invert_joint_symbols(*huff.decode_data(data.segment(i), extra=JOINT_EXTRA))
+            segment = run_length_blocks(values, lengths, b - a)
+        except RuntimeError:
+            segment = None
+        if segment is None:
+            utils.debug_msg("Restart segment of %d coefficients is corrupt, leaving it blank", b - a)
+        else:
+            out[a:b] = segment
+    return out
+
+
+def joint_symbols(lengths: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, tuple]:
     """
+    One (zeros, size) symbol for every run of run_length_coding() and the (bits, lengths) of the raw bits that go after
+    it, see magnitude_bits(). Runs are never longer than 14 so they fit above JOINT_SIZE_BITS bits of size
+    """
+    sizes = size_categories(values)
+    symbols = (np.asarray(lengths, dtype=np.int64) << JOINT_SIZE_BITS) | sizes
+    return symbols, (magnitude_bits(values, sizes), sizes)
 
-    levels = int(np.sqrt(max_shape[0] // min_shape[0]))
-    shapes = [(min_shape[0] * (np.power(2, i)), min_shape[1] * (np.power(2, i))) for i in range(0, levels + 1)]
-    return shapes
 
+def invert_joint_symbols(symbols: list, raw: list) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The (lengths, values) of the runs joint_symbols() made
+    """
+    symbols = np.asarray(symbols, dtype=np.int64)
+    sizes = symbols & ((1 << JOINT_SIZE_BITS) - 1)
+    return symbols >> JOINT_SIZE_BITS, invert_magnitude_bits(np.asarray(raw, dtype=np.int64), sizes)
 
-def wavelet_decoded_length(min_shape, max_shape):
-    shapes = wavelet_decoded_subbands_shapes(min_shape, max_shape)
-    length = functools.reduce(lambda agg, s: agg + (3 * (s[0] * s[1])), shapes, 0)
-    length += (min_shape[0] * min_shape[1])
-    return length
 
+JOINT_SIZE_BITS = 5  # our symbols don't have to fit a byte so sizes go up to 31 bits
+JOINT_EXTRA = [s & ((1 << JOINT_SIZE_BITS) - 1) for s in range(16 << JOINT_SIZE_BITS)]
 
-def wavelet_decode(hic: hic.HicImage) -> model.CompressedImage:
-    utils.debug_msg("Wavelet decode")
-    assert hic.hic_type == model.Compression.HIC
-    payloads = hic.payloads
-    utils.debug_msg("Decoding Huffman trees")
-    value_huffs = {
-        "lum": huffman_decode(payloads[0]),
-        "cr": huffman_decode(payloads[1]),
-        "cb": huffman_decode(payloads[2])
-    }
-    length_huffs = {
-        "lum": huffman_decode(payloads[3]),
-        "cr": huffman_decode(payloads[4]),
-        "cb": huffman_decode(payloads[5])
-    }
 
-    utils.debug_msg("Decode RLE values")
-    value_comps = {
-        "lum": huffman_data_decode(payloads[6], value_huffs["lum"]),
-        "cr": huffman_data_decode(payloads[7], value_huffs["cr"]),
-        "cb": huffman_data_decode(payloads[8], value_huffs["cb"]),
-    }
-    utils.debug_msg("Decode RLE lengths")
-    length_comps = {
-        "lum": huffman_data_decode(payloads[9], length_huffs["lum"]),
-        "cr": huffman_data_decode(payloads[10], length_huffs["cr"]),
-        "cb": huffman_data_decode(payloads[11], length_huffs["cb"]),
-    }
-    min_shape = payloads[12].numbers
-    max_shape = payloads[13].numbers
+def entropy_model(data: np.ndarray):
+    """
+    Huffman tree or rANS model for data, whichever settings.ENTROPY says. Both code data with encode_data() and give
+    their table for huffman_encode() with encode_table()
+    """
+    if settings.ENTROPY == model.Entropy.RANS:
+        return rans.RansModel.construct_from_data(data)
+    return huffman.HuffmanTree.construct_from_data(data, max_length=settings.HUFFMAN_MAX_CODE_LENGTH)
 
-    utils.debug_msg("Unloaded all of the data")
-    # ====
-    rles = utils.dict_map(value_comps,
-                          lambda k, v: [RunLength(value=t[1], length=t[0]) for t in list(zip(length_comps[k], v))])
-    length = wavelet_decoded_length(min_shape, max_shape)
 
-    data = utils.dict_map(rles, lambda _, v: decode_run_length(v, length))
-    shapes = wavelet_decoded_subbands_shapes(min_shape, max_shape)
-    channels = utils.dict_map(data, lambda _, v: wavelet_decode_pull_subbands(v, shapes))
-    return model.CompressedImage.from_dict(channels)
+def entropy_decode(data: hic.PayloadStringP, entropy: model.Entropy):
+    """
+    Reverse entropy_model() from what huffman_encode() stored
+    """
+    if entropy == model.Entropy.RANS:
+        return rans.RansModel.construct_from_coding([p.numbers for p in data.payloads])
+    return huffman_decode(data)
 
 
 def huffman_encode(huff: huffman.HuffmanTree) -> hic.Payload:
@@ -257,21 +399,85 @@ def huffman_decode(data: hic.PayloadStringP) -> huffman.HuffmanTree:
     return huffman.HuffmanTree.construct_from_coding(leaves)
 
 
-def huffman_data_encode(huff: huffman.HuffmanTree) -> hic.Payload:
+def huffman_data_encode(huff: huffman.HuffmanTree, data=None, segments=None, extra=None) -> hic.Payload:
     """
-    Encode huffman data into payload
+    Encode huffman data into payload, the data the tree was built from unless we are given some. With segments (the
+    first symbol of every restart segment) each segment is encoded on its own and starts on a byte. extra is the
+    (bits, lengths) of the raw bits that follow every symbol, if there are any
     """
-    data = huff.encode_data()
-    return hic.BitStringP(data)
+    if segments is None:
+        return hic.BitStringP(huff.encode_data(data, extra))
+    data = huff.data if data is None else data
+    bounds = np.append(segments, len(data))
+    return hic.SegmentsP.join([
+        huff.encode_data(data[a:b], None if extra is None else (extra[0][a:b], extra[1][a:b]))
+        for (a, b) in zip(bounds[:-1], bounds[1:])
+    ])
+
+
+def huffman_data_decode(data: hic.Payload, huffman: huffman.HuffmanTree, start: int = 0, end: int = None,
+                        extra=None):
+    """
+    Decode huffman data from payload with huffman tree, between bit positions start and end if we only want some.
+    The padding between restart segments is skipped. With extra (how many raw bits follow every symbol) we get the
+    symbols and their raw bits
+    """
+    end = data.payload.length if end is None else end
+    if isinstance(data, hic.SegmentsP):
+        ranges = [(max(a, start), min(b, end)) for (a, b) in zip(data.starts, data.ends)]
+        decoded = [huffman.decode_data(data.payload, a, b, extra) for (a, b) in ranges if a < b]
+        if extra is None:
+            return utils.flatten(decoded)
+        return utils.flatten([d[0] for d in decoded]), utils.flatten([d[1] for d in decoded])
+    return huffman.decode_data(data.payload, start, end, extra)
 
 
-def huffman_data_decode(data: hic.BitStringP, huffman: huffman.HuffmanTree) -> list:
+def restart_segments(data: hic.Payload) -> list:
     """
-    Decode huffman data from payload with huffman tree
+    The bits of every restart segment of a payload, a plain bit string is one segment
     """
-    return huffman.decode_data(data.payload)
+    if isinstance(data, hic.SegmentsP):
+        return [data.segment(i) for i in range(len(data))]
+    return [data.payload]
 
 
+def decode_run_length_segment(value_huff: huffman.HuffmanTree, length_huff: huffman.HuffmanTree, value_bits,
+                              length_bits, length: int) -> np.ndarray:
+    """
+    The length coefficients of one restart segment, its runs stop right at its end. None when the runs don't add up
+    to that, the segment was corrupted
+    """
+    try:
+        values = value_huff.decode_data(value_bits)
+        lengths = length_huff.decode_data(length_bits)
+    except RuntimeError:
+        return None
+    return run_length_blocks(values, lengths, length)
+
+
+def run_length_blocks(values, lengths, length: int) -> np.ndarray:
+    """
+    decode_run_length() for runs that stop right at length, None if they don't
+    """
+    if len(values) != len(lengths) or int(np.sum(lengths, dtype=np.int64)) + len(lengths) != length:
+        return None
+    return decode_run_length(lengths, values, length)
+
+
+def segment_map(f, tables: list, segments: list, workers: int = None) -> list:
+    """
+    f(i, (tables, batch)) over the restart segments in as many batches as there are workers, on processes so the
+    Huffman decoding actually runs side by side. Every batch rebuilds its trees from tables once, results come back
+    flattened in order
+    """
+    workers = settings.RESTART_WORKERS if workers is None else workers
+    bounds = np.linspace(0, len(segments), max(1, min(workers, len(segments))) + 1).astype(int)
+    batches = dict([(i, (tables, segments[a:b])) for (i, (a, b)) in enumerate(zip(bounds[:-1], bounds[1:]))])
+    done = utils.channel_map(batches, f, workers=workers, executor="process")
+    return utils.flatten([done[i] for i in range(len(batches))])
+
+
+@instrument.timed("jpeg encode")
 def jpeg_encode(compressed: model.CompressedImage) -> hic.HicImage:
     """
     Generally follow JPEG encoding. Since for the wavelet work I am don't have some standard huffman tree to work with
@@ -282,145 +488,502 @@ def jpeg_encode(compressed: model.CompressedImage) -> hic.HicImage:
 
     For RL it's also easier implementation-wise to split up the length from the value and not try to optimize and weave
     them together. Yes, the encoding will suffer bloat, but we are trying to highlight the transforms anyway.
+
+    With joint symbols or the standard tables a channel is coded like JPEG does it instead, see jpeg_joint_streams().
     """
-    utils.debug_msg("Starting JPEG encoding")
-    dc_comps = utils.dict_map(compressed.as_dict,
-                              lambda _, v: differential_coding(transform.split_matrix(v, settings.JPEG_BLOCK_SIZE)))
+    coding = jpeg_coding(compressed)
+    # every channel gives us its trees (if any) and then its bit strings and its group index
+    encoded = utils.channel_map(compressed.as_dict, functools.partial(jpeg_encode_channel, coding=coding))
+    utils.debug_msg("Encoded our channels")
 
-    utils.debug_msg("Determined differences DC components")
+    payloads = [hic.PlainStringP(coding[k][t].value) for t in range(2) for k in CHANNELS] + \
+        [hic.ArrayP([coding[k][2] for k in CHANNELS])] + utils.flatten([encoded[k][:-1] for k in CHANNELS]) + [
+            hic.TupP(compressed.shape[0][0], compressed.shape[0][1]),
+            hic.TupP(compressed.shape[1][0], compressed.shape[1][1]),
+            hic.TupP(settings.JPEG_RESTART_INTERVAL, settings.JPEG_BLOCK_GROUP)
+        ] + [encoded[k][-1] for k in CHANNELS]
+    return hic.HicImage.jpeg_image(payloads)
 
-    def ac_comp_fun(k, v):
-        utils.debug_msg("Determining AC components for: " + k)
-        splits = transform.split_matrix(v, settings.JPEG_BLOCK_SIZE)
-        acs = transform.ac_components(splits)
-        utils.debug_msg("Calculating RLE for: " + k)
-        out = run_length_coding(acs)
-        return out
 
-    # on each transformed channel, run RLE on the AC components of each block
-    ac_comps = utils.dict_map(compressed.as_dict, ac_comp_fun)
+def jpeg_coding(compressed: model.CompressedImage) -> dict:
+    """
+    The (tables, symbols, shift) every channel is coded with, what we were asked for unless the channel has values too
+    large for it. The standard tables only come with joint symbols and have no AC symbols past 1023 or DC differences
+    past 2047. Our DCT isn't normalized like JPEG's so the lum channel mostly has larger ones, its coefficients are
+    shifted right by shift bits (rounding) until they fit. That is the one lossy thing we do here, and only with the
+    standard tables
+    """
+    coding = {}
+    for (k, v) in compressed.as_dict.items():
+        (tables, symbols) = (settings.JPEG_HUFFMAN_TABLES, settings.SYMBOLS)
+        if tables == model.HuffmanTables.STANDARD:
+            shift = standard_shift(v)
+            if shift > 0:
+                utils.debug_msg("Coefficients of %s are shifted %d bits to fit the standard tables", k, shift)
+            coding[k] = (tables, model.Symbols.JOINT, shift)
+        else:
+            coding[k] = (tables, joint_fits(symbols, v), 0)
+    return coding
+
+
+def standard_shift(v: np.ndarray) -> int:
+    """
+    The fewest bits a channel has to be shifted right by for its AC values and its DC differences to have symbols in
+    the standard tables
+    """
+    splits = transform.split_matrix(v, settings.JPEG_BLOCK_SIZE)
+    starts = jpeg_group_starts(jpeg_block_grid(v.shape), settings.JPEG_BLOCK_GROUP)
+    dcs = splits[:, 0, 0].astype(np.int64)
+    acs = transform.ac_components(splits)
+    shift = 0
+    while np.abs(group_differences(shift_right(dcs, shift), starts)).max(initial=0) > STANDARD_LARGEST_DC or \
+            np.abs(shift_right(acs, shift)).max(initial=0) > STANDARD_LARGEST:
+        shift += 1
+    return shift
+
+
+def shift_right(v: np.ndarray, shift: int) -> np.ndarray:
+    """
+    v divided by 2^shift, rounded
+    """
+    return np.round(np.divide(v, 1 << shift)).astype(np.int64) if shift > 0 else v
 
-    utils.debug_msg("Determined RLEs for AC components")
-    dc_huffs = utils.dict_map(dc_comps, lambda _, v: huffman.HuffmanTree.construct_from_data(v))
-    ac_value_huffs = utils.dict_map(ac_comps,
-                                    lambda _, v: huffman.HuffmanTree.construct_from_data(v, key_func=lambda s: s.value))
-    ac_length_huffs = utils.dict_map(ac_comps,
-                                     lambda _, v: huffman.HuffmanTree.construct_from_data(v,
-                                                                                          key_func=lambda s: s.length))
 
-    def encode_huff(d):
-        huffs = [t[1] for t in d.items()]
-        return [huffman_encode(h) for h in huffs]
+def joint_fits(symbols: model.Symbols, values: np.ndarray) -> model.Symbols:
+    """
+    Joint symbols only have 4 bits for the size, fall back on separate ones for anything larger
+    """
+    if symbols == model.Symbols.JOINT and np.abs(values).max(initial=0) > JOINT_LARGEST:
+        utils.debug_msg("Values too large for joint symbols, coding them separately")
+        return model.Symbols.SEPARATE
+    return symbols
 
-    def encode_data(d):
-        huffs = [t[1] for t in d.items()]
-        return [huffman_data_encode(h) for h in huffs]
 
-    payloads = utils.flatten([
-        encode_huff(dc_huffs),
-        encode_huff(ac_value_huffs),
-        encode_huff(ac_length_huffs),
+def jpeg_channel_payload_count(coding: tuple) -> int:
+    """
+    Trees and bit strings of a channel, the standard tables are never stored
+    """
+    if coding[0] == model.HuffmanTables.STANDARD:
+        return 2
+    return 4 if coding[1] == model.Symbols.JOINT else 6
 
-        encode_data(dc_huffs),
-        encode_data(ac_value_huffs),
-        encode_data(ac_length_huffs),
 
-        [
-            hic.TupP(compressed.shape[0][0], compressed.shape[0][1]),
-            hic.TupP(compressed.shape[1][0], compressed.shape[1][1])
-        ]
-    ])
+def jpeg_block_grid(shape) -> Tuple[int, int]:
+    """
+    Blocks along each axis of a channel
+    """
+    n = settings.JPEG_BLOCK_SIZE
+    return -(-shape[0] // n), -(-shape[1] // n)
 
-    return hic.HicImage.jpeg_image(payloads)
 
+def jpeg_group_starts(grid, group: int) -> np.ndarray:
+    """
+    First block of every block group. A group is group blocks along a block row (the last one in a row may be short)
+    and groups are numbered like the blocks, row by row
+    """
+    rows, cols = grid
+    return (np.arange(rows)[:, None] * cols + np.arange(0, cols, group)[None, :]).ravel()
 
-def jpeg_decode(hic: hic.HicImage) -> model.CompressedImage:
+
+def group_differences(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
     """
-    Reverse jpeg_encode()
-    payloads = utils.flatten([
-        encode_huff(dc_huffs),
-        encode_huff(ac_value_huffs),
-        encode_huff(ac_length_huffs),
+    Differential coding that starts over at every group, the first value of a group is kept as is
+    """
+    diffs = np.diff(values, prepend=0)
+    diffs[starts] = values[starts]
+    return diffs
+
 
-        encode_data(dc_huffs),
-        encode_data(ac_value_huffs),
-        encode_data(ac_length_huffs)
+def invert_group_differences(diffs: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    sums = np.cumsum(diffs)
+    before = np.where(starts > 0, sums[np.maximum(starts - 1, 0)], 0)
+    return sums - np.repeat(before, np.diff(np.append(starts, len(diffs))))
+
+
+def bit_offsets(huff: huffman.HuffmanTree, data, starts: np.ndarray, segments: np.ndarray = None,
+                extra=None) -> np.ndarray:
+    """
+    Where the symbols at starts begin in the bit string of data, and then where the bit string ends. segments are the
+    symbols restart segments start at, each of those gets padded to a byte like huffman_data_encode() does. extra is
+    the raw bits after every symbol, only their lengths matter
+    """
+    lengths = huff.code_lengths(data)
+    if extra is not None:
+        lengths = lengths + extra[1]
+    ends = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if segments is not None and len(segments) > 1:
+        sizes = np.diff(ends[segments])
+        padding = np.cumsum((-sizes) % 8)
+        ends[segments[1]:] += np.repeat(padding, np.diff(np.append(segments[1:], len(ends))))
+    return ends[np.append(starts, len(data))]
+
+
+def jpeg_encode_channel(k, v: np.ndarray, coding: dict = None) -> List[hic.Payload]:
+    """
+    The trees (if they aren't the standard ones) and then the bit strings for one channel, coded like coding[k] says
+    (separate symbols and our own trees if we aren't told). Every block group is coded
+    on its own, the DC differences start over and the AC runs stop at the end of a group, and last comes the index of
+    where each group starts in the bit strings. With a restart interval every that many groups the bit strings start
+    a new segment on a byte
+    """
+    (tables, symbols, shift) = (model.HuffmanTables.CUSTOM, model.Symbols.SEPARATE, 0) if coding is None else coding[k]
+    splits = shift_right(transform.split_matrix(v, settings.JPEG_BLOCK_SIZE), shift)
+    starts = jpeg_group_starts(jpeg_block_grid(v.shape), settings.JPEG_BLOCK_GROUP)
+    dc_comps = group_differences(splits[:, 0, 0].astype(np.int64), starts)
+    utils.debug_msg("Determining AC components for: %s", k)
+    acs = transform.ac_components(splits)
+    if symbols == model.Symbols.JOINT:
+        streams = jpeg_joint_streams(k, dc_comps, acs.reshape(len(splits), -1), starts, tables)
+    else:
+        streams = jpeg_separate_streams(k, dc_comps, acs, starts, len(splits))
+    trees = [huffman_encode(s[0]) for s in streams] if tables == model.HuffmanTables.CUSTOM else []
+
+    if settings.JPEG_RESTART_INTERVAL > 0:
+        restarts = np.arange(0, len(starts), settings.JPEG_RESTART_INTERVAL)
+        segments = [s[3][restarts] for s in streams]
+    else:
+        segments = [None] * len(streams)
+    index = np.column_stack([
+        bit_offsets(huff, data, group_starts, segment, extra)
+        for ((huff, data, extra, group_starts), segment) in zip(streams, segments)
     ])
+    data = [
+        huffman_data_encode(huff, data, segment, extra)
+        for ((huff, data, extra, _), segment) in zip(streams, segments)
+    ]
+    return trees + data + [hic.ArrayP(index)]
+
+
+def jpeg_separate_streams(k, dc_comps: np.ndarray, acs: np.ndarray, starts: np.ndarray, blocks: int) -> list:
     """
-    utils.debug_msg("JPEG decode")
-    assert hic.hic_type == model.Compression.JPEG
-    payloads = hic.payloads
-    utils.debug_msg("Decoding Huffman trees")
-    dc_huffs = {
-        "lum": huffman_decode(payloads[0]),
-        "cr": huffman_decode(payloads[1]),
-        "cb": huffman_decode(payloads[2])
-    }
-    ac_value_huffs = {
-        "lum": huffman_decode(payloads[3]),
-        "cr": huffman_decode(payloads[4]),
-        "cb": huffman_decode(payloads[5])
-    }
-    ac_length_huffs = {
-        "lum": huffman_decode(payloads[6]),
-        "cr": huffman_decode(payloads[7]),
-        "cb": huffman_decode(payloads[8])
-    }
+    (tree, symbols, raw bits, first symbol of every group) for the DC differences, the AC values and the AC lengths
+    """
+    utils.debug_msg("Calculating RLE for: %s", k)
+    sub_length = utils.size(settings.JPEG_BLOCK_SHAPE()) - 1
+    ac_comps = run_length_coding(acs, stops=np.append(starts[1:], blocks) * sub_length - 1)
+    # runs never cross a group so the first run at or after the start of a group belongs to it
+    run_starts = np.searchsorted(np.cumsum(ac_comps[0] + 1) - 1, starts * sub_length)
 
-    utils.debug_msg("Decode DC differences")
-    dc_comps = {
-        "lum": huffman_data_decode(payloads[9], dc_huffs["lum"]),
-        "cr": huffman_data_decode(payloads[10], dc_huffs["cr"]),
-        "cb": huffman_data_decode(payloads[11], dc_huffs["cb"]),
-    }
+    max_length = settings.HUFFMAN_MAX_CODE_LENGTH
+    return [
+        (huffman.HuffmanTree.construct_from_data(dc_comps, max_length=max_length), dc_comps, None, starts),
+        (huffman.HuffmanTree.construct_from_data(ac_comps[1], max_length=max_length), ac_comps[1], None, run_starts),
+        (huffman.HuffmanTree.construct_from_data(ac_comps[0], max_length=max_length), ac_comps[0], None, run_starts)
+    ]
 
-    utils.debug_msg("Decode RLE values")
-    ac_values = {
-        "lum": huffman_data_decode(payloads[12], ac_value_huffs["lum"]),
-        "cr": huffman_data_decode(payloads[13], ac_value_huffs["cr"]),
-        "cb": huffman_data_decode(payloads[14], ac_value_huffs["cb"]),
-    }
-    utils.debug_msg("Decode RLE lengths")
-    ac_lengths = {
-        "lum": huffman_data_decode(payloads[15], ac_length_huffs["lum"]),
-        "cr": huffman_data_decode(payloads[16], ac_length_huffs["cr"]),
-        "cb": huffman_data_decode(payloads[17], ac_length_huffs["cb"]),
-    }
+
+def jpeg_joint_streams(k, dc_comps: np.ndarray, acs: np.ndarray, starts: np.ndarray,
+                       tables: model.HuffmanTables) -> list:
+    """
+    Like jpeg_separate_streams() but for joint symbols, there is a DC and an AC bit string and both are size
+    categories followed by the magnitude bits, see jpeg_ac_symbols(). The trees are the standard ones or our own
+    """
+    utils.debug_msg("Calculating AC symbols for: %s", k)
+    dc_sizes = size_categories(dc_comps)
+    (ac_symbols, ac_values, block_starts) = jpeg_ac_symbols(acs)
+    ac_sizes = ac_symbols & 0xF
+    if tables == model.HuffmanTables.STANDARD:
+        (dc_tree, ac_tree) = standard_trees(k)
+    else:
+        max_length = settings.HUFFMAN_MAX_CODE_LENGTH
+        dc_tree = huffman.HuffmanTree.construct_from_data(dc_sizes, max_length=max_length)
+        ac_tree = huffman.HuffmanTree.construct_from_data(ac_symbols, max_length=max_length)
+    return [
+        (dc_tree, dc_sizes, (magnitude_bits(dc_comps, dc_sizes), dc_sizes), starts),
+        (ac_tree, ac_symbols, (magnitude_bits(ac_values, ac_sizes), ac_sizes), block_starts[starts])
+    ]
+
+
+STANDARD_LARGEST = 1023  # JPEG's AC symbols go up to size 10
+STANDARD_LARGEST_DC = 2047  # and its DC differences up to size 11
+JOINT_LARGEST = (1 << 15) - 1  # the largest size that fits a joint symbol
+END_OF_BLOCK = 0x00
+ZERO_RUN = 0xF0  # 16 zeros
+DC_EXTRA = list(range(64))  # raw bits after every DC symbol (the size itself) and after every joint symbol
+AC_EXTRA = [s & 0xF for s in range(256)]
+
+
+def standard_trees(k) -> Tuple[huffman.HuffmanTree, huffman.HuffmanTree]:
+    if k == "lum":
+        return (huffman.HuffmanTree.standard(model.HTables.JPEG_DC_LUMINANCE),
+                huffman.HuffmanTree.standard(model.HTables.JPEG_AC_LUMINANCE))
+    return (huffman.HuffmanTree.standard(model.HTables.JPEG_DC_CHROMINANCE),
+            huffman.HuffmanTree.standard(model.HTables.JPEG_AC_CHROMINANCE))
+
+
+def size_categories(values: np.ndarray) -> np.ndarray:
+    """
+    JPEG's size category of every value, how many bits its magnitude takes
+    """
+    return np.frexp(np.abs(values))[1].astype(np.int64)
+
+
+def magnitude_bits(values: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    The raw bits that go after a size category, a negative value goes as its ones' complement
+    """
+    values = np.asarray(values, dtype=np.int64)
+    return np.where(values < 0, values + np.left_shift(1, sizes) - 1, values)
+
+
+def invert_magnitude_bits(bits: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    bits = np.asarray(bits, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    negative = bits < np.left_shift(1, np.maximum(sizes - 1, 0))
+    return np.where((sizes > 0) & negative, bits - np.left_shift(1, sizes) + 1, bits)
+
+
+def jpeg_ac_symbols(acs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    JPEG's AC symbols for a stack of linearized blocks without their DC: (zeros before << 4) | size for every nonzero
+    value, preceded by a (15, 0) for every 16 zeros the run can't hold, and a (0, 0) end of block closing every block.
+    Unlike JPEG every block gets its end of block, even when its last value is nonzero, so we can find the blocks
+    without walking the symbols. Gives back the symbols, the value of every symbol (zero for the markers) and the first
+    symbol of every block
+    """
+    (b, i) = np.nonzero(acs)
+    first = np.ones(len(b), dtype=bool)
+    first[1:] = b[1:] != b[:-1]
+    runs = i - np.where(first, -1, np.roll(i, 1)) - 1
+    (zero_runs, runs) = np.divmod(runs, 16)
+    values = acs[b, i].astype(np.int64)
+
+    # a value comes after its (15, 0)s and everything of the blocks before it, ends of blocks included
+    value_at = np.cumsum(zero_runs + 1) - 1 + b
+    block_symbols = np.bincount(b, weights=zero_runs + 1, minlength=len(acs)).astype(np.int64)
+    end_at = np.cumsum(block_symbols) + np.arange(len(acs))
+
+    symbols = np.full(end_at[-1] + 1 if len(acs) else 0, ZERO_RUN, dtype=np.int64)
+    symbols[value_at] = (runs << 4) | size_categories(values)
+    symbols[end_at] = END_OF_BLOCK
+    out = np.zeros(len(symbols), dtype=np.int64)
+    out[value_at] = values
+    return symbols, out, np.concatenate([[0], end_at[:-1] + 1]).astype(np.int64)
+
+
+def jpeg_ac_blocks(symbols, raw, blocks: int, sub_length: int) -> np.ndarray:
+    """
+    Reverse jpeg_ac_symbols() into blocks x sub_length values. None when the symbols don't make that many blocks
+    """
+    symbols = np.asarray(symbols, dtype=np.int64)
+    ends = symbols == END_OF_BLOCK
+    if ends.sum() != blocks or (len(symbols) > 0 and not ends[-1]):
+        return None
+    block = np.cumsum(ends) - ends
+    sizes = symbols & 0xF
+    moves = np.cumsum(np.where(ends, 0, (symbols >> 4) + 1))
+    positions = moves - np.concatenate([[0], moves[ends][:-1]])[block] - 1
+    values = ~ends & (sizes > 0)
+    if np.any(positions[values] >= sub_length):
+        return None
+    out = np.zeros((blocks, sub_length), dtype=np.int64)
+    out[block[values], positions[values]] = invert_magnitude_bits(np.asarray(raw)[values], sizes[values])
+    return out
+
+
+def jpeg_channel_payloads(payloads) -> Tuple[dict, dict, dict, int, int, dict]:
+    """
+    Reverse the layout of jpeg_encode(): the (tables, symbols, shift) and the coding payloads of every channel, the
+    channel shapes, the block group size, the restart interval and the group index of every channel
+    """
+    n = len(CHANNELS)
+    shifts = payloads[2 * n].array.ravel().tolist()
+    coding = dict([
+        (k, (model.HuffmanTables(payloads[j].payload), model.Symbols(payloads[n + j].payload), shifts[j]))
+        for (j, k) in enumerate(CHANNELS)
+    ])
+    channels = {}
+    rest = 2 * n + 1
+    for k in CHANNELS:
+        count = jpeg_channel_payload_count(coding[k])
+        channels[k] = [payloads[rest + i] for i in range(count)]
+        rest += count
     shapes = {
-        "lum": payloads[18].numbers,
-        "cr": payloads[19].numbers,
-        "cb": payloads[19].numbers
+        "lum": payloads[rest].numbers,
+        "cr": payloads[rest + 1].numbers,
+        "cb": payloads[rest + 1].numbers
     }
-    utils.debug_msg("Unloaded all of the data")
-    # ====
+    (restart, group) = payloads[rest + 2].numbers
+    indexes = dict([(k, payloads[rest + 3 + j]) for (j, k) in enumerate(CHANNELS)])
+    return coding, channels, shapes, group, restart, indexes
+
+
+def jpeg_coders(k, coding: tuple, trees: List[hic.Payload]) -> list:
+    """
+    (tree, raw bits after every symbol) for each bit string of a channel, trees are the channel's own tree payloads
+    """
+    (tables, symbols, _) = coding
+    if tables == model.HuffmanTables.STANDARD:
+        return list(zip(standard_trees(k), [DC_EXTRA, AC_EXTRA]))
+    if symbols == model.Symbols.JOINT:
+        return list(zip([huffman_decode(p) for p in trees], [DC_EXTRA, AC_EXTRA]))
+    return [(huffman_decode(p), None) for p in trees]
+
 
+def jpeg_split_payloads(coding: tuple, payloads: list) -> Tuple[list, list]:
+    """
+    The tree payloads and the bit string payloads of a channel
+    """
+    trees = len(payloads) // 2 if coding[0] == model.HuffmanTables.CUSTOM else 0
+    return payloads[:trees], payloads[trees:]
+
+
+def jpeg_blocks(coding: tuple, decoded: list, blocks: int, starts: np.ndarray) -> np.ndarray:
+    """
+    Linearized blocks from what the bit strings of some block groups decoded to, starts being the first block of every
+    group. None when they don't add up to blocks blocks, they were corrupted
+    """
     sub_length = utils.size(settings.JPEG_BLOCK_SHAPE()) - 1
-    utils.debug_msg("Calculating AC RLEs")
-    ac_rle = utils.dict_map(ac_values,
-                            lambda k, v: [RunLength(t[1], t[0]) for t in list(zip(ac_lengths[k], v))])
-
-    def ac_mat_fun(k, v):
-        utils.debug_msg("Determining deficient AC matricies for: " + k)
-        ac_length = utils.size(shapes[k]) - len(dc_comps[k])
-        out = decode_run_length(v, ac_length)
-        if k == "lum":
-            s = [str(i) for i in out]
-            print(" ".join(s))
-        return out
-
-    ac_mats = utils.dict_map(ac_rle, ac_mat_fun)
-    ac_mats = utils.dict_map(ac_mats, lambda _, v: utils.group_tuples(v, sub_length))
-    dc_comps = utils.dict_map(dc_comps, lambda _, v: utils.invert_differences(v))
-
-    def merge_comps(dc_key, dc_values):
-        utils.debug_msg("Merging: " + dc_key)
-        tuples = ac_mats[dc_key]  # there are all of the AC zigzag arrays missing their DC component
-        assert len(tuples) == len(dc_values)
-        zipped = zip(dc_values, tuples)  # combine them to be mapped later
-        lin_mats = [[t[0], *t[1]] for t in zipped]  # create the linearized block
-        mats = [transform.izigzag(np.array(m), settings.JPEG_BLOCK_SHAPE()) for m in lin_mats]
-        return mats
-
-    compressed = utils.dict_map(dc_comps, merge_comps)
-    merged = utils.dict_map(compressed, lambda k, v: transform.merge_blocks(np.array(v), shapes[k]))
+    if coding[1] == model.Symbols.JOINT:
+        [(dc_sizes, dc_raw), (ac_symbols, ac_raw)] = decoded
+        dc_comps = invert_magnitude_bits(dc_raw, dc_sizes)
+        acs = jpeg_ac_blocks(ac_symbols, ac_raw, blocks, sub_length)
+    else:
+        [dc_comps, ac_values, ac_lengths] = decoded
+        dc_comps = np.array(dc_comps, dtype=np.int64)
+        # every block is missing its DC component
+        acs = run_length_blocks(ac_values, ac_lengths, blocks * sub_length)
+        acs = None if acs is None else acs.reshape(-1, sub_length)
+    if len(dc_comps) != blocks or acs is None:
+        return None
+    dc_values = invert_group_differences(dc_comps, starts)
+    return np.column_stack([dc_values, acs])  # create the linearized blocks
+
+
+@instrument.timed("jpeg decode")
+def jpeg_decode(hic: hic.HicImage) -> model.CompressedImage:
+    """
+    Reverse jpeg_encode(), the payloads are
+        the tables of lum, cr and cb, then their symbols, then how far each was shifted to fit the standard tables,
+        dc tree, ac value tree, ac length tree, dc bit string, ac value bit string, ac length bit string of lum,
+        the same for cr and cb,
+    only a dc and ac tree and bit string with joint symbols and no trees with the standard tables, then the lum and
+    chroma shapes, the restart interval and block group size and the group index of every channel. The bit strings are
+    segments instead when there is a restart interval
+    """
+    assert hic.hic_type == model.Compression.JPEG
+    (coding, channels, shapes, group, restart, _) = jpeg_channel_payloads(hic.payloads)
+    utils.debug_msg("Unloaded all of the data")
+
+    decode = functools.partial(jpeg_decode_channel, coding=coding, shapes=shapes, group=group, restart=restart)
+    merged = utils.channel_map(channels, decode)
     return model.CompressedImage.from_dict(merged)
+
+
+def jpeg_decode_channel(k, payloads: List[hic.Payload], coding: dict, shapes: dict, group: int,
+                        restart: int = 0) -> np.ndarray:
+    """
+    Reverse jpeg_encode_channel(), the restart segments are decoded by segment_map()
+    """
+    coding = coding[k]
+    starts = jpeg_group_starts(jpeg_block_grid(shapes[k]), group)
+    restarts = np.arange(0, len(starts), restart) if restart > 0 else np.zeros(1, dtype=np.int64)
+    first_blocks = np.append(starts[restarts], np.prod(jpeg_block_grid(shapes[k])))
+    group_bounds = np.append(restarts, len(starts))
+
+    (trees, data) = jpeg_split_payloads(coding, payloads)
+    bits = [restart_segments(p) for p in data]
+    assert all([len(b) == len(restarts) for b in bits])
+    segments = [
+        ([b[i] for b in bits], first_blocks[i + 1] - first_blocks[i],
+         starts[group_bounds[i]:group_bounds[i + 1]] - first_blocks[i])
+        for i in range(len(restarts))
+    ]
+    utils.debug_msg("Decoding %d restart segments of: %s", len(segments), k)
+    lin_mats = np.concatenate(segment_map(jpeg_decode_segments, (k, coding, trees), segments))
+
+    utils.debug_msg("Merging: %s", k)
+    blocks = transform.izigzag(lin_mats << coding[2], settings.JPEG_BLOCK_SHAPE())
+    return transform.merge_blocks(blocks, shapes[k])
+
+
+def jpeg_decode_segments(i, work: tuple) -> list:
+    """
+    The linearized blocks of a batch of restart segments. work is the channel, its coding and tree payloads and a list
+    of the bits of every bit string, the number of blocks and the first block of every group of each segment. A
+    corrupted segment comes back as blocks of zeros, the ones around it don't care
+    """
+    ((k, coding, trees), segments) = work
+    coders = jpeg_coders(k, coding, trees)
+    sub_length = utils.size(settings.JPEG_BLOCK_SHAPE()) - 1
+
+    decoded = []
+    for (bits, blocks, starts) in segments:
+        try:
+            symbols = [huff.decode_data(b, extra=extra) for ((huff, extra), b) in zip(coders, bits)]
+            lin_mats = jpeg_blocks(coding, symbols, blocks, starts)
+        except RuntimeError:
+            lin_mats = None
+        if lin_mats is None:
+            utils.debug_msg("Restart segment of %d blocks is corrupt, leaving it blank", blocks)
+            lin_mats = np.zeros((blocks, sub_length + 1), dtype=np.int64)
+        decoded.append(lin_mats)
+    return decoded
+
+
+@instrument.timed("jpeg decode region")
+def jpeg_decode_region(hic: hic.HicImage, region) -> dict:
+    """
+    Only decode the blocks of every channel that we need to show region, (top, left, height, width) in pixels. Every
+    channel comes back as its coefficients for a block aligned rectangle and where that rectangle starts in the channel
+    """
+    assert hic.hic_type == model.Compression.JPEG
+    (coding, channels, shapes, group, _, indexes) = jpeg_channel_payloads(hic.payloads)
+    (top, left, height, width) = region
+    n = settings.JPEG_BLOCK_SIZE
+    # the chroma gets upsampled which smears every pixel over its neighbours, grab a couple more around the edges
+    margin = 2
+    pixels = {
+        "lum": ((top, top + height), (left, left + width)),
+        "cr": ((top // 2 - margin, -(-(top + height) // 2) + margin),
+               (left // 2 - margin, -(-(left + width) // 2) + margin))
+    }
+    pixels["cb"] = pixels["cr"]
+
+    def blocks(k):
+        ((y0, y1), (x0, x1)) = pixels[k]
+        (h, w) = shapes[k]
+        return (max(y0, 0) // n, -(-min(y1, h) // n)), (max(x0, 0) // n, -(-min(x1, w) // n))
+
+    work = dict([(k, (channels[k], indexes[k].array) + blocks(k)) for k in CHANNELS])
+    decode = functools.partial(jpeg_decode_channel_blocks, coding=coding, shapes=shapes, group=group)
+    return utils.channel_map(work, decode)
+
+
+def jpeg_decode_channel_blocks(k, work: tuple, coding: dict, shapes: dict, group: int):
+    """
+    work is the coding payloads and group index of a channel and the block rows and block columns we want. Decode those
+    rows, but only the block groups that cover the columns. Gives back their coefficients and the pixel where they
+    start
+    """
+    coding = coding[k]
+    (payloads, index, rows, cols) = work
+    shape = shapes[k]
+    n = settings.JPEG_BLOCK_SIZE
+    sub_length = utils.size(settings.JPEG_BLOCK_SHAPE()) - 1
+    grid = jpeg_block_grid(shape)
+    per_row = -(-grid[1] // group)
+    (g0, g1) = (cols[0] // group, -(-cols[1] // group))
+    (b0, b1) = (g0 * group, min(g1 * group, grid[1]))
+    starts = np.arange(g0, g1) * group - b0
+
+    (trees, data) = jpeg_split_payloads(coding, payloads)
+    coders = jpeg_coders(k, coding, trees)
+    lin_rows = []
+    for r in range(*rows):
+        (first, last) = (r * per_row + g0, r * per_row + g1)
+        symbols = [
+            huffman_data_decode(p, huff, index[first, s], index[last, s], extra)
+            for (s, (p, (huff, extra))) in enumerate(zip(data, coders))
+        ]
+        lin_mats = jpeg_blocks(coding, symbols, b1 - b0, starts)
+        if lin_mats is None:
+            utils.debug_msg("Block row %d of %s is corrupt, leaving it blank", r, k)
+            lin_mats = np.zeros((b1 - b0, sub_length + 1), dtype=np.int64)
+        lin_rows.append(lin_mats)
+    utils.debug_msg("Decoded %d block rows of %s", rows[1] - rows[0], k)
+
+    blocks = transform.izigzag(np.concatenate(lin_rows) << coding[2], settings.JPEG_BLOCK_SHAPE())
+    (y, x) = (rows[0] * n, b0 * n)
+    coefficients = transform.merge_blocks(blocks, (min(rows[1] * n, shape[0]) - y, min(b1 * n, shape[1]) - x))
+    return coefficients, (y, x)
@@ -1,3 +1,5 @@
+import functools
+
 import cv2
 import numpy as np
 
@@ -7,69 +9,160 @@ import hiccup.quantization as qnt
 import hiccup.model as model
 import hiccup.settings as settings
 import hiccup.utils as utils
+import hiccup.instrument as instrument
 
 """
 Houses the entry functions to either compression algorithm
 """
 
 
+@instrument.timed("jpeg compression")
 def jpeg_compression(rgb_image: np.ndarray) -> model.CompressedImage:
     """
     JPEG compression
     """
-    utils.debug_msg("Starting JPEG compression")
-    yrcrcb = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2YCrCb)
-    [gray, color_1, color_2] = cv2.split(yrcrcb)
+    with instrument.span("color conversion"):
+        yrcrcb = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2YCrCb)
+        [gray, color_1, color_2] = cv2.split(yrcrcb)
     channels = {
         "lum": gray,
         "cr": color_1,
         "cb": color_2
     }
 
-    def channel_fun(k, v):
-        utils.debug_msg("Process channel: " + k)
-        if k == "lum":
-            return transform.dct_channel(v, model.QTables.JPEG_LUMINANCE, block_size=settings.JPEG_BLOCK_SIZE)
-        else:
-            return transform.dct_channel(transform.down_sample(v), model.QTables.JPEG_CHROMINANCE,
-                                         block_size=settings.JPEG_BLOCK_SIZE)
-
-    channels = utils.dict_map(channels, channel_fun)
+    channels = utils.channel_map(channels, jpeg_compress_channel)
     utils.debug_msg("Transformed our channels")
     return model.CompressedImage.from_dict(channels)
 
 
+def jpeg_compress_channel(k, v: np.ndarray) -> np.ndarray:
+    utils.debug_msg("Process channel: %s", k)
+    if k == "lum":
+        return transform.dct_channel(v, model.QTables.JPEG_LUMINANCE, block_size=settings.JPEG_BLOCK_SIZE)
+    else:
+        return transform.dct_channel(transform.down_sample(v), model.QTables.JPEG_CHROMINANCE,
+                                     block_size=settings.JPEG_BLOCK_SIZE)
+
+
+@instrument.timed("jpeg decompression")
 def jpeg_decompression(d: model.CompressedImage) -> np.ndarray:
     """
     Decompress a JPEG image for viewing
     """
+    channels = utils.channel_map(d.as_dict, jpeg_decompress_channel)
+    with instrument.span("color conversion"):
+        y = transform.force_merge(channels["lum"], channels["cr"], channels["cb"])
+        return cv2.cvtColor(y, cv2.COLOR_YCrCb2RGB)
+
+
+@instrument.timed("jpeg decompression region")
+def jpeg_decompression_region(channels: dict, region) -> np.ndarray:
+    """
+    The region (top, left, height, width) of the image, from what codec.jpeg_decode_region() gave us. Each channel
+    covers at least the region and we only ever invert that much
+    """
+    (top, left, height, width) = region
+    channels = utils.channel_map(channels, jpeg_decompress_channel_region)
+
+    def crop(k):
+        (pixels, (y, x)) = channels[k]
+        return pixels[top - y:top + height - y, left - x:left + width - x]
+
+    with instrument.span("color conversion"):
+        y = transform.force_merge(crop("lum"), crop("cr"), crop("cb"))
+        return cv2.cvtColor(y, cv2.COLOR_YCrCb2RGB)
+
+
+def jpeg_decompress_channel_region(k, v: tuple) -> tuple:
+    (coefficients, (y, x)) = v
+    if k == "lum":
+        return jpeg_decompress_channel(k, coefficients), (y, x)
+    return jpeg_decompress_channel(k, coefficients), (2 * y, 2 * x)
 
-    def channel_fun(k, v):
-        if k == "lum":
-            return transform.inv_dct_channel(v, model.QTables.JPEG_LUMINANCE, block_size=settings.JPEG_BLOCK_SIZE)
-        else:
-            return transform.up_sample(transform.inv_dct_channel(v, model.QTables.JPEG_CHROMINANCE,
-                                                                 block_size=settings.JPEG_BLOCK_SIZE))
 
-    channels = utils.dict_map(d.as_dict, channel_fun)
-    y = transform.force_merge(channels["lum"], channels["cr"], channels["cb"])
-    return cv2.cvtColor(y, cv2.COLOR_YCrCb2RGB)
+def jpeg_decompress_channel(k, v: np.ndarray) -> np.ndarray:
+    if k == "lum":
+        return transform.inv_dct_channel(v, model.QTables.JPEG_LUMINANCE, block_size=settings.JPEG_BLOCK_SIZE)
+    else:
+        return transform.up_sample(transform.inv_dct_channel(v, model.QTables.JPEG_CHROMINANCE,
+                                                             block_size=settings.JPEG_BLOCK_SIZE))
 
 
+@instrument.timed("wavelet compression")
 def wavelet_compression(rgb_image: np.ndarray) -> model.CompressedImage:
-    yrcrcb = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2YCrCb)
-    [gray, color_1, color_2] = cv2.split(yrcrcb)
+    """
+    Wavelet compression, tile by tile so that we never transform more than a tile at a time
+    """
+    coding = wavelet_coding()
+    with instrument.span("color conversion"):
+        yrcrcb = wavelet_color(rgb_image, coding)
+        [gray, color_1, color_2] = cv2.split(yrcrcb)
 
     channels = {
         "lum": gray,
         "cr": color_1,
         "cb": color_2
     }
+    # dyadic tiles so that every tile still lines up in a scaled down decode
+    tiling = model.Tiling.split(gray.shape, settings.WAVELET_TILES, align=2 ** coding.levels)
+
+    channels = utils.channel_map(channels, functools.partial(wavelet_compress_channel, tiling=tiling, coding=coding))
+
+    return model.CompressedImage.from_dict(channels, tiling=tiling, coding=coding)
+
+
+@instrument.timed("wavelet decompression")
+def wavelet_decompression(channels: model.CompressedImage) -> np.ndarray:
+    """
+    Invert every tile straight into its place in the channel. If the finest levels were never decoded we end up with a
+    smaller image, half the size for every level that is missing
+    """
+    coding = channels.coding
+    tiling = channels.tiling.reduced(wavelet_missing_levels(channels.luminance_component[0], coding.levels))
+
+    decompress = functools.partial(wavelet_decompress_channel, tiling=tiling, coding=coding)
+    channels = utils.channel_map(channels.as_dict, decompress)
+    with instrument.span("color conversion"):
+        yrcrcb = transform.force_merge(channels["lum"], channels["cr"], channels["cb"]).astype(np.uint8)
+        return wavelet_inverse_color(yrcrcb, coding)
+
+
+def wavelet_coding() -> model.WaveletCoding:
+    """
+    How the settings have us transform, which is what goes in the file
+    """
+    if settings.WAVELET_LOSSLESS and settings.WAVELET != model.Wavelet.CDF_5_3:
+        raise RuntimeError("Lossless wavelet compression needs the reversible %s" % model.Wavelet.CDF_5_3.value)
+    return model.WaveletCoding(settings.WAVELET, settings.WAVELET_NUM_LEVELS, settings.WAVELET_LOSSLESS)
+
+
+def wavelet_color(rgb_image: np.ndarray, coding: model.WaveletCoding) -> np.ndarray:
+    """
+    The three channels we code, YCrCb unless we are lossless
+    """
+    if coding.lossless:
+        return transform.reversible_color(rgb_image)
+    return cv2.cvtColor(rgb_image, cv2.COLOR_RGB2YCrCb)
+
+
+def wavelet_inverse_color(yrcrcb: np.ndarray, coding: model.WaveletCoding) -> np.ndarray:
+    if coding.lossless:
+        return transform.inverse_reversible_color(yrcrcb)
+    return cv2.cvtColor(yrcrcb, cv2.COLOR_YCrCb2RGB)
+
+
+def wavelet_compress_channel(k, v: np.ndarray, tiling: model.Tiling, coding: model.WaveletCoding) -> list:
+    return [wavelet_compress_tile(v[region], coding) for region in tiling.regions]
+
 
-    def channel_func(k, v: np.ndarray):
+def wavelet_compress_tile(v: np.ndarray, coding: model.WaveletCoding) -> list:
+    with instrument.span("transform"):
         offset = np.subtract(v.astype(np.int64), np.power(2, 8))
-        transformed = transform.wavelet_split_resolutions(offset, settings.WAVELET, settings.WAVELET_NUM_LEVELS)
-        subbands = transform.subband_view(transformed)
+        transformed = transform.wavelet_split_resolutions(offset, coding.wavelet, coding.levels)
+    if coding.lossless:
+        return transformed
+    with instrument.span("quantize"):
+        subbands = transform.subband_view(wavelet_normalize(transformed, coding))
         if settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER != 0:
             subbands = qnt.subband_quantize(subbands, multiplier=settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER)
         r_transformed = transform.linearize_subband(subbands)
@@ -78,23 +171,51 @@ def wavelet_compression(rgb_image: np.ndarray) -> model.CompressedImage:
         if settings.WAVELET_THRESHOLD != 0:
             thresholded = [transform.threshold(part, settings.WAVELET_THRESHOLD) for part in thresholded]
         rounded = [qnt.round_quantize(t) for t in thresholded]
-        return rounded
+    return rounded
 
-    channels = utils.dict_map(channels, channel_func)
 
-    return model.CompressedImage.from_dict(channels)
+def wavelet_normalize(subbands: list, coding: model.WaveletCoding, inverse=False) -> list:
+    """
+    The quantization steps and thresholds are made for pywt's orthonormal wavelets. The lifting ones keep their
+    approximations at the scale of the pixels, so scale every subband to where an orthonormal one would have it (and
+    back again with inverse)
+    """
+    if coding.wavelet not in transform.LIFTING:
+        return subbands
+    norms = transform.wavelet_subband_norms(coding.wavelet, coding.levels)
+    if inverse:
+        return [np.divide(s, n) for (s, n) in zip(subbands, norms)]
+    return [np.multiply(s, n) for (s, n) in zip(subbands, norms)]
 
 
-def wavelet_decompression(channels: model.CompressedImage) -> np.ndarray:
-    def channel_func(k, v):
-        subbands = transform.subband_view(v)
-        if settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER != 0:
-            subbands = qnt.subband_invert_quantize(subbands, settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER)
-        li = transform.linearize_subband(subbands)
-        merged = transform.wavelet_merge_resolutions(li, settings.WAVELET)
-        offset = np.add(merged, np.power(2, 8)).astype(np.uint8)
-        return offset
-
-    channels = utils.dict_map(channels.as_dict, channel_func)
-    yrcrcb = transform.force_merge(channels["lum"], channels["cr"], channels["cb"]).astype(np.uint8)
-    return cv2.cvtColor(yrcrcb, cv2.COLOR_YCrCb2RGB)
+def wavelet_decompress_channel(k, v: list, tiling: model.Tiling, coding: model.WaveletCoding) -> np.ndarray:
+    out = np.empty(tiling.shape, dtype=np.uint8)
+    for (tile, region) in zip(v, tiling.regions):
+        wavelet_decompress_tile(tile, out[region], coding)
+    return out
+
+
+def wavelet_missing_levels(subbands: list, levels: int) -> int:
+    return levels - (len(subbands) - 1) // 3
+
+
+def wavelet_decompress_tile(v: list, out: np.ndarray, coding: model.WaveletCoding):
+    """
+    Invert the tile straight into out, which is smaller when the tile is missing its finest levels
+    """
+    li = v
+    if not coding.lossless:
+        with instrument.span("quantize"):
+            subbands = transform.subband_view(v)
+            if settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER != 0:
+                subbands = qnt.subband_invert_quantize(subbands, settings.WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER)
+            li = wavelet_normalize(transform.linearize_subband(subbands), coding, inverse=True)
+    with instrument.span("transform"):
+        merged = transform.wavelet_merge_resolutions(li, coding.wavelet)
+    missing = wavelet_missing_levels(v, coding.levels)
+    gain = transform.wavelet_approximation_gain(coding.wavelet)
+    if missing > 0 and gain != 1:
+        # every level of the approximation gains a factor of 2
+        merged = np.divide(merged, gain ** missing)
+    # odd sized tiles come back a row or column too big, and whatever the quantization pushed past a byte is clipped
+    out[:] = np.clip(np.add(merged[:out.shape[0], :out.shape[1]], np.power(2, 8)), 0, 255).astype(np.uint8)
@@ -1,15 +1,38 @@
 import abc
+import mmap
+import struct
+from collections.abc import Sequence
 from typing import List
-import pickle
+
+import numpy as np
 
 import hiccup.utils as utils
 import hiccup.model as model
 import hiccup.iohelper as io
+import hiccup.instrument as instrument
 
 """
 Wrap the representation of a HIC image to make it easier to write/retrieve from byte stream
+
+A HIC file is
+    header      magic, format version, compression and how many sections follow
+    directory   (kind, offset, length) per section, the kind says which Payload to read it back as
+    sections    the raw little-endian payloads, back to back
+
+so reading one is a couple of struct reads and then slicing, nothing gets unpickled. On top of that the sections are
+only decoded when someone actually asks for them, from_file() maps the file so we don't even read what we never touch.
 """
 
+MAGIC = b"HIC\x00"
+VERSION = 1
+HEADER = struct.Struct("<4sHBI")
+SECTION = struct.Struct("<BQQ")
+
+COMPRESSION_CODES = {
+    model.Compression.JPEG: 1,
+    model.Compression.HIC: 2
+}
+
 
 class Payload:
     """
@@ -28,14 +51,15 @@ class Payload:
 
 
 class TupP(Payload):
-    @classmethod
-    def from_bytes(cls, b):
-        tup = pickle.loads(b)
-        return cls(tup[0], tup[1])
-
     """
     Tuple, probably shape or Huffman node
     """
+    KIND = 1
+    FORMAT = struct.Struct("<qq")
+
+    @classmethod
+    def from_bytes(cls, b):
+        return cls(*cls.FORMAT.unpack(b))
 
     def __init__(self, n1, n2):
         self.n1 = n1
@@ -50,38 +74,40 @@ class TupP(Payload):
 
     @property
     def byte_stream(self):
-        return pickle.dumps((self.n1, self.n2))
+        return self.FORMAT.pack(int(self.n1), int(self.n2))
 
 
 class BitStringP(Payload):
     """
     Bit string, probably the encoded huffman data
     """
+    KIND = 2
 
     @classmethod
     def from_bytes(cls, b):
-        return cls(io.padded_bytes_2_bs(b))
+        return cls(io.Bits.from_padded_bytes(b))
 
-    def __init__(self, string: str):
-        self.payload = string
+    def __init__(self, bits: io.Bits):
+        self.payload = bits
 
     def __eq__(self, other):
         return type(self) == type(other) and self.payload == other.payload
 
     @property
     def byte_stream(self):
-        return io.padded_bs_2_bytes(self.payload)
+        return self.payload.padded_bytes()
 
 
 class PlainStringP(Payload):
     ENCODING = "ascii"
+    KIND = 3
     """
     Just a string (for readability), probably the image type
     """
 
     @classmethod
     def from_bytes(cls, b):
-        return cls(b.decode(cls.ENCODING))
+        return cls(bytes(b).decode(cls.ENCODING))
 
     def __init__(self, string: str):
         self.payload = string
@@ -97,14 +123,19 @@ class PlainStringP(Payload):
 class PayloadStringP(Payload):
     """
     String of payloads, we'll want these consecutive cause they are grouped. Probably a group
-    of Huffman nodes
+    of Huffman nodes. Only TupP are grouped so the body is a count and then each column of the pairs as raw integers,
+    as narrow as they fit since every tile carries its own tables
     """
+    KIND = 4
+    HEADER = struct.Struct("<IBB")
 
     @classmethod
     def from_bytes(cls, b):
-        d = pickle.loads(b)
-        p = [d["type"].from_bytes(b) for b in d["data"]]
-        return cls(d["type"], p)
+        count, size_1, size_2 = cls.HEADER.unpack_from(b)
+        offset = cls.HEADER.size
+        column_1 = np.frombuffer(b, dtype="<i%d" % size_1, count=count, offset=offset)
+        column_2 = np.frombuffer(b, dtype="<i%d" % size_2, count=count, offset=offset + count * size_1)
+        return cls(TupP, [TupP(*t) for t in zip(column_1.tolist(), column_2.tolist())])
 
     def __init__(self, t, payloads: List[Payload]):
         self.t = t
@@ -115,31 +146,172 @@ class PayloadStringP(Payload):
 
     @property
     def byte_stream(self):
-        return pickle.dumps({
-            "type": self.t,
-            "data": [p.byte_stream for p in self.payloads]
-        })
+        assert self.t == TupP
+        pairs = np.array([p.numbers for p in self.payloads], dtype=np.int64).reshape(-1, 2)
+        column_1 = narrowest(pairs[:, 0])
+        column_2 = narrowest(pairs[:, 1])
+        header = self.HEADER.pack(len(pairs), column_1.itemsize, column_2.itemsize)
+        return header + column_1.tobytes() + column_2.tobytes()
+
+
+class ArrayP(Payload):
+    """
+    2d array of integers, probably an index into other sections. Stored as raw integers as narrow as they fit
+    """
+    KIND = 5
+    HEADER = struct.Struct("<BII")
+
+    @classmethod
+    def from_bytes(cls, b):
+        size, rows, cols = cls.HEADER.unpack_from(b)
+        array = np.frombuffer(b, dtype="<i%d" % size, count=rows * cols, offset=cls.HEADER.size)
+        return cls(array.reshape(rows, cols).astype(np.int64))
+
+    def __init__(self, array: np.ndarray):
+        array = np.asarray(array, dtype=np.int64)
+        self.array = array.reshape(-1, 1) if array.ndim == 1 else array
+
+    def __eq__(self, other):
+        return type(self) == type(other) and np.array_equal(self.array, other.array)
+
+    @property
+    def byte_stream(self):
+        array = narrowest(self.array)
+        return self.HEADER.pack(array.itemsize, *self.array.shape) + array.tobytes()
+
+
+class SegmentsP(Payload):
+    """
+    Bit string cut into restart segments. Every segment starts on a byte and the header holds where each one ends, so
+    any of them can be picked out and decoded without the others. payload is still the whole bit string with the
+    padding in between
+    """
+    KIND = 6
+    HEADER = struct.Struct("<BI")
+
+    @classmethod
+    def from_bytes(cls, b):
+        size, count = cls.HEADER.unpack_from(b)
+        ends = np.frombuffer(b, dtype="<i%d" % size, count=count, offset=cls.HEADER.size).astype(np.int64)
+        return cls(io.Bits.from_padded_bytes(b[cls.HEADER.size + size * count:]), ends)
+
+    @classmethod
+    def join(cls, segments: List[io.Bits]):
+        sizes = np.array([len(s.data) for s in segments], dtype=np.int64)
+        ends = 8 * (np.cumsum(sizes) - sizes) + [len(s) for s in segments]
+        bits = io.Bits(b"".join([bytes(s.data) for s in segments]), int(ends[-1]) if len(segments) else 0)
+        return cls(bits, ends)
+
+    def __init__(self, bits: io.Bits, ends: np.ndarray):
+        self.payload = bits
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.payload == other.payload and np.array_equal(self.ends, other.ends)
+
+    def __len__(self):
+        return len(self.ends)
+
+    @property
+    def starts(self) -> np.ndarray:
+        return np.concatenate([[0], -(-self.ends[:-1] // 8) * 8]).astype(np.int64)
+
+    def segment(self, i: int) -> io.Bits:
+        """
+        The bits of segment i on their own, a slice so only those bytes go along when shipped to another process
+        """
+        (start, end) = (int(self.starts[i]), int(self.ends[i]))
+        return io.Bits(self.payload.data[start // 8:-(-end // 8)], end - start)
+
+    @property
+    def byte_stream(self):
+        ends = narrowest(self.ends)
+        return self.HEADER.pack(ends.itemsize, len(ends)) + ends.tobytes() + self.payload.padded_bytes()
+
+
+def narrowest(ints: np.ndarray) -> np.ndarray:
+    """
+    Little endian copy in the smallest signed integer type that holds every value
+    """
+    for size in [1, 2, 4]:
+        info = np.iinfo("<i%d" % size)
+        if ints.size == 0 or (ints.min() >= info.min and ints.max() <= info.max):
+            return ints.astype("<i%d" % size)
+    return ints.astype("<i8")
+
+
+PAYLOAD_KINDS = dict([(t.KIND, t) for t in [TupP, BitStringP, PlainStringP, PayloadStringP, ArrayP, SegmentsP]])
+
+
+class Sections(Sequence):
+    """
+    The payloads of a HIC buffer, each section is decoded the first time it is accessed and remembered after that
+    """
+
+    def __init__(self, view: memoryview, directory: List[tuple]):
+        self._view = view
+        self.directory = directory
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.directory)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i not in self._decoded:
+            kind, offset, length = self.directory[i]
+            self._decoded[i] = PAYLOAD_KINDS[kind].from_bytes(self._view[offset:offset + length])
+        return self._decoded[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def kind(self, i):
+        """
+        What payload a section holds, without decoding it
+        """
+        return PAYLOAD_KINDS[self.directory[i][0]]
+
+    def release(self):
+        """
+        Let go of the buffer, nothing can be decoded after this
+        """
+        self._decoded = {}
+        self._view.release()
 
 
 class HicImage:
     @classmethod
+    @instrument.timed("parse")
     def from_bytes(cls, raw_data):
-        t = model.Compression(PlainStringP.from_bytes(raw_data[0]).payload)
+        """
+        Parse the header and directory, the sections are zero copy slices handed to their Payload once they are needed
+        """
+        view = memoryview(raw_data)
+        if len(view) < HEADER.size:
+            raise RuntimeError("Not a HIC file")
+        magic, version, compression, count = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise RuntimeError("Not a HIC file")
+        if version != VERSION:
+            raise RuntimeError("Unsupported HIC version %d" % version)
+        t = utils.first(COMPRESSION_CODES.items(), lambda c: c[1] == compression)[0]
+
+        if HEADER.size + count * SECTION.size > len(view):
+            raise RuntimeError("Corrupt HIC directory")
+        directory = [SECTION.unpack_from(view, HEADER.size + i * SECTION.size) for i in range(count)]
+        for (i, (kind, offset, length)) in enumerate(directory):
+            if kind not in PAYLOAD_KINDS or offset + length > len(view):
+                raise RuntimeError("Corrupt HIC section %d" % i)
+        payloads = Sections(view, directory)
+
         if t == model.Compression.JPEG:
-            # huffs
-            # tree per data per channel == 9
-            huffs = [PayloadStringP.from_bytes(b) for b in raw_data[1:10]]
-            # data
-            data = [BitStringP.from_bytes(b) for b in raw_data[10:19]]
-            # shapes
-            shapes = [TupP.from_bytes(b) for b in raw_data[19:21]]
-            return cls.jpeg_image(huffs + data + shapes)
+            return cls.jpeg_image(payloads)
         else:
-            assert t == model.Compression.HIC
-            huffs = [PayloadStringP.from_bytes(b) for b in raw_data[1:7]]
-            data = [BitStringP.from_bytes(b) for b in raw_data[7:13]]
-            shapes = [TupP.from_bytes(b) for b in raw_data[13:15]]
-            return cls.wavelet_image(huffs + data + shapes)
+            return cls.wavelet_image(payloads)
 
     @classmethod
     def wavelet_image(cls, payloads):
@@ -158,26 +330,63 @@ class HicImage:
 
     @classmethod
     def from_file(cls, path):
+        """
+        Memory map the file, only the header and directory are read up front
+        """
         with open(path, 'rb') as f:
-            raw_data = pickle.load(f)
-        assert raw_data is not None
-        return cls.from_bytes(raw_data)
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RuntimeError("Not a HIC file")
+        hi = cls.from_bytes(mapped)
+        hi._mapped = mapped
+        return hi
 
     def __init__(self, hic_type: model.Compression, settings: List[Payload], payloads: List[Payload]):
         self.hic_type = hic_type
         self.settings = settings
         self._payloads = payloads
+        self._mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the file we were read from. Payloads that were already decoded may still point into it, in which case
+        the map goes away with them instead
+        """
+        if self._mapped is None:
+            return
+        if isinstance(self._payloads, Sections):
+            self._payloads.release()
+        try:
+            self._mapped.close()
+        except BufferError:
+            pass
+        self._mapped = None
 
     def write_file(self, path):
-        utils.debug_msg("Writing HIC file to: " + path)
+        utils.debug_msg("Writing HIC file to: %s", path)
         with open(path, 'wb') as f:
-            pickle.dump(self.byte_stream(), f)
+            f.write(self.byte_stream())
 
     @property
     def payloads(self):
         return self._payloads
 
+    @instrument.timed("serialize")
     def byte_stream(self):
-        data = self.settings + self.payloads
-        data = [p.byte_stream for p in data]
-        return data
+        sections = [p.byte_stream for p in self.payloads]
+        header = HEADER.pack(MAGIC, VERSION, COMPRESSION_CODES[self.hic_type], len(sections))
+
+        directory = []
+        offset = HEADER.size + len(sections) * SECTION.size
+        for (p, b) in zip(self.payloads, sections):
+            directory.append(SECTION.pack(p.KIND, offset, len(b)))
+            offset += len(b)
+        instrument.count("hic bytes", offset)
+        return b"".join([header] + directory + sections)
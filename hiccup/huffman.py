@@ -1,61 +1,141 @@
 import heapq
-import functools
 
+import numpy as np
+
+import hiccup.model as model
 import hiccup.utils as utils
+import hiccup.iohelper as io
+import hiccup.instrument as instrument
 
 """
-While we use the defaults given by the specs for encoding, we need to realize a Huffman tree to decode
+While we use the defaults given by the specs for encoding, we need to realize a Huffman tree to decode. The tree only
+decides how long each code is, the codes themselves are assigned canonically so that the lengths are all we persist.
 """
 
 
 class HuffmanTree:
+    PEEK_BITS = 10  # codes up to this long are decoded with a single table lookup
+
     @classmethod
-    def construct_from_data(cls, data, key_func=utils.identity):
+    @instrument.timed("huffman build")
+    def construct_from_data(cls, data, key_func=utils.identity, max_length=None):
         """
         Public constructor from data
         """
-        groups = utils.group_by(data, key_func=key_func)
-        utils.debug_msg("Groupby has found %d groups" % len(groups))
-        leaves = [cls.Node.leaf(t[0], len(t[1])) for t in groups.items()]
-        root, leaves = cls._construct(leaves)
-        utils.debug_msg("Finished constructing huffman")
-        return cls(root, leaves, data, key_func)
+        if isinstance(data, np.ndarray) and key_func is utils.identity:
+            # straight from the run length arrays, no need to box every symbol to count them
+            values, counts = np.unique(data, return_counts=True)
+            leaves = [cls.Node.leaf(*t) for t in zip(values.tolist(), counts.tolist())]
+        else:
+            groups = utils.group_by(data, key_func=key_func)
+            leaves = [cls.Node.leaf(t[0], len(t[1])) for t in groups.items()]
+        instrument.count("huffman symbols", len(data))
+        instrument.count("huffman leaves", len(leaves))
+        return cls._limit(cls._construct(leaves), max_length, data, key_func)
 
     @classmethod
-    def construct_from_leaves(cls, segments, key_func=utils.identity):
+    def construct_from_leaves(cls, segments, key_func=utils.identity, max_length=None):
         leaves = [cls.Node.leaf(*s) for s in segments]
-        root, leaves = cls._construct(leaves)
-        return cls(root, leaves, None, key_func)
+        return cls._limit(cls._construct(leaves), max_length, None, key_func)
 
     @classmethod
     def construct_from_coding(cls, segments, key_func=utils.identity):
         """
-        When we store in binary it's going to be (value, symbol), from the symbol we can place our value back in the
-        correct place of the tree
+        When we store in binary it's going to be (value, length), since the codes are canonical the lengths alone are
+        enough to place our value back in the correct place of the tree. Explicit code strings are still understood,
+        only their length matters.
         """
-        d = dict([(t[1], t[0]) for t in segments])
+        lengths = dict([(t[0], len(t[1]) if isinstance(t[1], str) else t[1]) for t in segments])
+        codes = cls._canonical_codes(lengths)
+        root, leaves = cls._canonical_tree(codes)
+        return cls(root, leaves, None, key_func, codes=codes)
 
-        levels = len(sorted(segments, key=lambda t: len(t[1]))[-1][1])
+    @classmethod
+    def _canonical_tree(cls, codes: dict):
+        """
+        Realize the tree for a canonical code table
+        """
         root = cls.Node(None, None, None, None)
         leaves = []
+        for (value, (code, length)) in codes.items():
+            node = root
+            for shift in range(length - 1, -1, -1):
+                if (code >> shift) & 1:
+                    if node.left is cls.Node.GROUND:
+                        node.left = cls.Node.leaf(None, None)
+                        node.inherit(node.left)
+                    node = node.left
+                else:
+                    if node.right is cls.Node.GROUND:
+                        node.right = cls.Node.leaf(None, None)
+                        node.inherit(node.right)
+                    node = node.right
+            node.value = value
+            leaves.append(node)
+        return root, leaves
 
-        # the side effects are real
-        def h_trav(r, depth, s):
-            if s in d:
-                # I am really a leaf
-                leaves.append(r)
-                r.value = d[s]
-                return
-            if depth != levels:
-                r.left = cls.Node.leaf(None, None)
-                h_trav(r.left, depth + 1, s + "1")
+    @classmethod
+    def _limit(cls, constructed, max_length, data, key_func):
+        """
+        Keep the plain Huffman tree when it already fits in max_length bits, otherwise fall back on package-merge for
+        the optimal lengths that do
+        """
+        root, leaves = constructed
+        if max_length is None or len(leaves) < 2 or root.depth - 1 <= max_length:
+            return cls(root, leaves, data, key_func)
 
-                r.right = cls.Node.leaf(None, None)
-                h_trav(r.right, depth + 1, s + "0")
-                r.mass_adopt()
+        if len(leaves) > (1 << max_length):
+            raise RuntimeError("Cannot fit %d symbols in codes of %d bits" % (len(leaves), max_length))
+        lengths = cls._package_merge([l.frequency for l in leaves], max_length)
+        codes = cls._canonical_codes(dict([(l.value, n) for (l, n) in zip(leaves, lengths)]))
+        root, leaves = cls._canonical_tree(codes)
+        return cls(root, leaves, data, key_func, codes=codes)
 
-        h_trav(root, 0, '')
-        return cls(root, leaves, None, key_func)
+    @classmethod
+    def _package_merge(cls, frequencies, max_length):
+        """
+        Length limited Huffman code lengths (Larmore and Hirschberg). Each round packages the cheapest pairs of the
+        previous round and merges them back with the original coins, after max_length rounds the 2n - 2 cheapest items
+        tell us how many times each symbol sits in the tree, which is exactly its code length.
+
+        Items are (weight, symbol, children) so a package only points at what it was made from and we count the symbols
+        at the very end.
+        """
+        n = len(frequencies)
+        order = sorted(range(n), key=lambda i: frequencies[i])
+        coins = [(frequencies[i], i, None) for i in order]
+
+        items = coins
+        for _ in range(max_length - 1):
+            packages = [(items[k][0] + items[k + 1][0], None, (items[k], items[k + 1]))
+                        for k in range(0, len(items) - 1, 2)]
+            items = list(heapq.merge(coins, packages, key=lambda t: t[0]))
+
+        lengths = [0] * n
+        stack = items[:2 * n - 2]
+        while len(stack) > 0:
+            _, symbol, children = stack.pop()
+            if children is None:
+                lengths[symbol] += 1
+            else:
+                stack.extend(children)
+        return lengths
+
+    @classmethod
+    def _canonical_codes(cls, lengths: dict) -> dict:
+        """
+        Assign the canonical code to every value from its code length alone. Shorter codes come first and values of the
+        same length are ordered by value, so the same lengths always give the same codes.
+        """
+        codes = {}
+        code = 0
+        prev_length = 0
+        for (value, length) in sorted(lengths.items(), key=lambda t: (t[1], t[0])):
+            code <<= (length - prev_length)
+            codes[value] = (code, length)
+            code += 1
+            prev_length = length
+        return codes
 
     @classmethod
     def _construct(cls, leaves):
@@ -78,100 +158,154 @@ class HuffmanTree:
 
         return root, leaves
 
-    def __init__(self, root, leaves, data, key_func):
+    def __init__(self, root, leaves, data, key_func, codes=None):
         self.root = root
         self.leaves = leaves
         self.data = data
         self.key_func = key_func
 
-        # speed things up
-        self._cache = {
-            self.get_leaf: {}
-        }
-
-    def blow_cache(self):
-        """
-        Control memory somewhat
-        """
-        self._cache = {
-            self.get_leaf: {}
-        }
-
-    def in_cache(self, k, v):
-        return v in self._cache[k]
-
-    def get_cache(self, k, v):
-        return self._cache[k][v]
+        # the tree only tells us how long each code is, the bits themselves are canonical
+        if codes is None:
+            codes = self._canonical_codes(dict([(l.value, len(l.path()) - 1) for l in self.leaves]))
+        self.codes = codes
+        self._decoder = None
 
-    def cache(self, k, v, to_cache):
-        self._cache[k][v] = to_cache
-
-    def get_leaf(self, value):
+    @classmethod
+    def standard(cls, option: model.HTables):
         """
-        Find our ending leaf from value that must exist by construction
+        One of the JPEG Annex K tables. They only ever get built (and their decode table filled) once
         """
-        if self.in_cache(self.get_leaf, value):
-            return self.get_cache(self.get_leaf, value)
-        out = utils.first(self.leaves, lambda l: l.value == value)
-        self.cache(self.get_leaf, value, out)
-        return out
-
-    def translate_path(self, path, str=""):
-        if len(path) < 2:
-            return str
-        child = path[-2]
-        parent = path[-1]
-        path = path[:-1]
-        if parent.left == child:
-            return self.translate_path(path, str=str + "1")
-        elif parent.right == child:
-            return self.translate_path(path, str=str + "0")
-        raise RuntimeError("Invalid state")
-
-    def encode_data(self, data=None):
+        if option not in _standard_trees:
+            (counts, values) = standard_tables[option]
+            lengths = utils.flatten([[n + 1] * c for (n, c) in enumerate(counts)])
+            _standard_trees[option] = cls.construct_from_coding(list(zip(values, lengths)))
+        return _standard_trees[option]
+
+    @instrument.timed("huffman encode")
+    def encode_data(self, data=None, extra=None) -> io.Bits:
         """
-        Construct binary encoding with Huffman tree
+        Construct binary encoding from the canonical code table. extra is (bits, lengths) of raw bits to write after
+        every code, like the magnitudes after JPEG's size categories
         """
         if data is None:
             data = self.data
 
-        paths = [self.get_leaf(self.key_func(d)).path() for d in data]
-        utils.debug_msg("Got %d paths" % len(paths))
-        strs = [self.translate_path(path) for path in paths]
-        utils.debug_msg("Got the strs")
-        return "".join(strs)
+        codes = self.codes
+        key_func = self.key_func
+        if isinstance(data, np.ndarray) and key_func is utils.identity:
+            table = self._code_array(data)
+        else:
+            table = np.array([codes[key_func(d)] for d in data], dtype=np.int64).reshape(-1, 2)
+        if extra is not None:
+            lengths = np.asarray(extra[1], dtype=np.int64)
+            table = np.column_stack([(table[:, 0] << lengths) | np.asarray(extra[0], dtype=np.int64),
+                                     table[:, 1] + lengths])
+        writer = io.BitWriter()
+        writer.write_codes(table[:, 0], table[:, 1])
+        bits = writer.bits()
+        instrument.count("huffman bits", len(bits))
+        return bits
+
+    def code_lengths(self, data) -> np.ndarray:
+        """
+        How many bits every symbol of data is encoded with
+        """
+        if isinstance(data, np.ndarray) and self.key_func is utils.identity:
+            return self._code_array(data)[:, 1]
+        return np.array([self.codes[self.key_func(d)][1] for d in data], dtype=np.int64)
 
-    def encode_table(self):
-        s = [n.encoding for n in self.leaves]
-        s = [(t[0], self.translate_path(t[1])) for t in s]
-        return s
-
-    def decode_data(self, str):
-        bits = list(str)
-
-        def reduce(agg, ele):
-            if agg[-1]["node"] == self.Node.GROUND:
-                agg.append({"node": self.root})
-            if ele == "1":
-                next_ele = agg[-1]["node"].left
-            elif ele == "0":
-                next_ele = agg[-1]["node"].right
-            else:
-                raise RuntimeError("Illegal state")
+    def _code_array(self, data: np.ndarray) -> np.ndarray:
+        """
+        (code, length) rows for every symbol of a numeric array, looked up with a binary search over the sorted values
+        """
+        values = sorted(self.codes)
+        keys = np.array(values)
+        table = np.array([self.codes[v] for v in values], dtype=np.int64).reshape(-1, 2)
+        index = np.minimum(np.searchsorted(keys, data), len(keys) - 1)
+        if np.any(keys[index] != data):
+            raise RuntimeError("Data has values that are not in the Huffman tree")
+        return table[index]
 
-            if next_ele.is_leaf:
-                agg[-1]["value"] = next_ele.value
-                agg[-1]["node"] = next_ele.left  # either is fine, it's just an indicator
-                return agg
-            else:
-                agg[-1]["node"] = next_ele
-                return agg
+    def encode_table(self):
+        """
+        (value, code length) pairs in canonical order
+        """
+        return [(t[0], t[1][1]) for t in sorted(self.codes.items(), key=lambda t: t[1][::-1])]
 
-        values = functools.reduce(reduce, bits, [{
-            "node": self.root
-        }])
-        # chop last one because the reduction anticipates more values
-        return [v["value"] for v in values if "value" in v]
+    def decode_table(self):
+        """
+        Build (once) the structures to decode with: a table indexed by the next PEEK_BITS bits that resolves any code of
+        at most PEEK_BITS bits in one step, and the canonical first code of every length for the longer codes.
+        """
+        if self._decoder is not None:
+            return self._decoder
+
+        n = self.PEEK_BITS
+        lookup = [None] * (1 << n)
+        ordered = sorted(self.codes.items(), key=lambda t: t[1][::-1])
+        symbols = [t[0] for t in ordered]
+        firsts = {}
+        for (i, (value, (code, length))) in enumerate(ordered):
+            if length not in firsts:
+                firsts[length] = (code, i)
+            if length <= n:
+                start = code << (n - length)
+                end = (code + 1) << (n - length)
+                lookup[start:end] = [(value, length)] * (end - start)
+
+        long_codes = [(length,) + firsts[length] for length in sorted(firsts) if length > n]
+        self._decoder = (lookup, symbols, long_codes)
+        return self._decoder
+
+    def _decode_long(self, reader: io.BitReader):
+        """
+        Slow path for the codes that do not fit the lookup table, walk the canonical lengths
+        """
+        _, symbols, long_codes = self.decode_table()
+        for (i, (length, first, index)) in enumerate(long_codes):
+            code = reader.peek(length)
+            last = long_codes[i + 1][2] if i + 1 < len(long_codes) else len(symbols)
+            if 0 <= code - first < last - index:
+                return symbols[index + code - first], length
+        raise RuntimeError("Illegal state")
+
+    @instrument.timed("huffman decode")
+    def decode_data(self, bits: io.Bits, start: int = 0, end: int = None, extra=None):
+        """
+        Decode the symbols between bit positions start and end, all of them by default. With extra, how many raw bits
+        follow each symbol (indexed by the symbol), we give back the symbols and those raw bits
+        """
+        if isinstance(bits, str):
+            bits = io.Bits.from_string(bits)
+        lookup, _, _ = self.decode_table()
+        n = self.PEEK_BITS
+        reader = io.BitReader(bits, start=start)
+        end = bits.length if end is None else end
+
+        values = []
+        if extra is None:
+            while reader.position < end:
+                hit = lookup[reader.peek(n)]
+                if hit is None:
+                    hit = self._decode_long(reader)
+                if hit[1] > end - reader.position:
+                    break
+                reader.skip(hit[1])
+                values.append(hit[0])
+            return values
+
+        raw = []
+        while reader.position < end:
+            hit = lookup[reader.peek(n)]
+            if hit is None:
+                hit = self._decode_long(reader)
+            k = extra[hit[0]]
+            if hit[1] + k > end - reader.position:
+                break
+            reader.skip(hit[1])
+            values.append(hit[0])
+            raw.append(reader.read(k))
+        return values, raw
 
     class Node:
         GROUND = None
@@ -257,3 +391,55 @@ class HuffmanTree:
 
         def __ge__(self, other):
             return self > other or self == other
+
+
+"""
+JPEG Annex K tables, as JPEG stores them: how many codes there are of each length from 1 to 16 bits and then the symbols
+in code order. The DC symbols are size categories, the AC ones (zeros before << 4) | size with (0, 0) closing a block
+and (15, 0) standing for 16 zeros. Symbols of the same length are in increasing order so our canonical codes come out
+exactly the same as the standard's
+"""
+standard_tables = {
+    model.HTables.JPEG_DC_LUMINANCE: (
+        [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+        list(range(12))
+    ),
+    model.HTables.JPEG_DC_CHROMINANCE: (
+        [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+        list(range(12))
+    ),
+    model.HTables.JPEG_AC_LUMINANCE: (
+        [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d],
+        [
+            0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+            0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+            0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+            0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+            0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+            0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+            0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+            0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+            0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+            0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+            0xf9, 0xfa
+        ]
+    ),
+    model.HTables.JPEG_AC_CHROMINANCE: (
+        [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+        [
+            0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+            0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+            0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34, 0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+            0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+            0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+            0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+            0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+            0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+            0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+            0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+            0xf9, 0xfa
+        ]
+    )
+}
+
+_standard_trees = {}
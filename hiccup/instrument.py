@@ -0,0 +1,149 @@
+import functools
+import threading
+import time
+
+"""
+Where the time goes. Stages open named spans and bump counters, both of which go nowhere unless someone attached a
+collector, so left alone this costs a list check per call.
+
+A collector is anything with on_span(path, seconds) and on_count(name, n), path being the tuple of span names from the
+outermost one in. Collector below just adds things up, a service can attach its own to ship stage latencies elsewhere.
+Spans nest per thread and anything running in another process isn't seen at all.
+"""
+
+_collectors = []
+_local = threading.local()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+        self.path = tuple(stack)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        for collector in list(_collectors):
+            collector.on_span(self.path, seconds)
+        return False
+
+
+def span(name: str):
+    """
+    with instrument.span("huffman build"):
+        ...
+    """
+    if not _collectors:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name: str):
+    """
+    Decorator for when the span is the whole function
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _collectors:
+                return f(*args, **kwargs)
+            with _Span(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, n: int = 1):
+    if not _collectors:
+        return
+    for collector in list(_collectors):
+        collector.on_count(name, n)
+
+
+def attach(collector):
+    _collectors.append(collector)
+    return collector
+
+
+def detach(collector):
+    _collectors.remove(collector)
+
+
+class Collector:
+    """
+    Totals and call counts for every span path, plus totals for every counter. Use it as a context manager to only
+    collect for a block
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def on_span(self, path: tuple, seconds: float):
+        with self._lock:
+            (calls, total) = self.spans.get(path, (0, 0.0))
+            self.spans[path] = (calls + 1, total + seconds)
+
+    def on_count(self, name: str, n: int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def __enter__(self):
+        return attach(self)
+
+    def __exit__(self, *args):
+        detach(self)
+        return False
+
+    def total(self, name: str) -> float:
+        """
+        Seconds spent in every span called name wherever it was nested
+        """
+        return sum([t[1] for (path, t) in self.spans.items() if path[-1] == name])
+
+    def self_time(self, path: tuple) -> float:
+        children = [t[1] for (p, t) in self.spans.items() if len(p) == len(path) + 1 and p[:len(path)] == path]
+        return max(0.0, self.spans[path][1] - sum(children))
+
+    def report(self) -> str:
+        lines = ["%-60s %8s %10s" % ("span", "calls", "seconds")]
+        for path in sorted(self.spans):
+            (calls, total) = self.spans[path]
+            lines.append("%-60s %8d %10.4f" % ("  " * (len(path) - 1) + path[-1], calls, total))
+        for name in sorted(self.counters):
+            lines.append("%-60s %19d" % (name, self.counters[name]))
+        return "\n".join(lines)
+
+    def collapsed(self) -> str:
+        """
+        Collapsed stacks (a;b;c microseconds) of our spans for flame graph tools, every line is the self time
+        """
+        lines = []
+        for path in sorted(self.spans):
+            micros = int(round(self.self_time(path) * 1e6))
+            if micros > 0:
+                lines.append("%s %d" % (";".join(path), micros))
+        return "\n".join(lines)
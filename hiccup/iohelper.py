@@ -1,11 +1,188 @@
 import rawpy
-import bitstring
+import numpy as np
 
 """
 IO ickiness
 """
 
 
+class Bits:
+    """
+    Packed bit string, most significant bit first. The last byte is zero padded so we also hold on to how many bits
+    are actually used
+    """
+
+    @classmethod
+    def from_string(cls, s: str):
+        """
+        Mostly for tests and debugging, the entropy path never goes through text
+        """
+        writer = BitWriter()
+        for c in s:
+            writer.write(1 if c == "1" else 0, 1)
+        return writer.bits()
+
+    @classmethod
+    def from_padded_bytes(cls, b):
+        """
+        Invert padded_bytes(), b may be a memoryview so we never copy the data
+        """
+        padding = b[0]
+        data = b[1:]
+        return cls(data, len(data) * 8 - padding)
+
+    def __init__(self, data, length: int):
+        self.data = data
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __reduce__(self):
+        # data may be a view into a mapped file, ship a copy to other processes
+        return Bits, (bytes(self.data), self.length)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.length == other.length and bytes(self.data) == bytes(other.data)
+
+    def __str__(self):
+        s = "".join([format(b, "08b") for b in bytes(self.data)])
+        return s[:self.length]
+
+    def padded_bytes(self) -> bytes:
+        """
+        Byte aligned with a leading byte for how much padding is at the end
+        """
+        padding = (-self.length) % 8
+        return bytes([padding]) + bytes(self.data)
+
+
+class BitWriter:
+    """
+    Accumulate codes into a bytearray, a 32 bit word at a time
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._acc = 0
+        self._n = 0
+        self.length = 0
+
+    def write(self, code: int, length: int):
+        """
+        Append the lowest length bits of code
+        """
+        self._acc = (self._acc << length) | code
+        self._n += length
+        self.length += length
+        while self._n >= 32:
+            self._n -= 32
+            self._buffer += (self._acc >> self._n).to_bytes(4, "big")
+            self._acc &= (1 << self._n) - 1
+
+    def write_codes(self, codes: np.ndarray, lengths: np.ndarray):
+        """
+        Vectorized write(), expand the codes into bits a chunk at a time and pack them with numpy
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(lengths) == 0:
+            return
+        width = np.arange(lengths.max())
+        for i in range(0, len(lengths), self.CHUNK):
+            c = codes[i:i + self.CHUNK, None]
+            shifts = lengths[i:i + self.CHUNK, None] - 1 - width
+            used = shifts >= 0
+            bits = (c >> np.where(used, shifts, 0).astype(np.uint64)) & np.uint64(1)
+            self._write_bits(bits[used].astype(np.uint8))
+
+    def _write_bits(self, bits: np.ndarray):
+        pending = np.array([(self._acc >> (self._n - 1 - i)) & 1 for i in range(self._n)], dtype=np.uint8)
+        bits = np.concatenate([pending, bits])
+        self.length += len(bits) - self._n
+        whole = len(bits) - (len(bits) % 8)
+        self._buffer += np.packbits(bits[:whole]).tobytes()
+        self._acc = 0
+        self._n = 0
+        for b in bits[whole:].tolist():
+            self._acc = (self._acc << 1) | b
+            self._n += 1
+
+    def bits(self) -> Bits:
+        """
+        Flush what is left into the last (padded) bytes
+        """
+        data = bytearray(self._buffer)
+        n = self._n
+        if n > 0:
+            padding = (-n) % 8
+            data += (self._acc << padding).to_bytes((n + padding) // 8, "big")
+        return Bits(bytes(data), self.length)
+
+
+class BitReader:
+    """
+    Read back a Bits, refilling a window a 32 bit word at a time. Peeking past the end just gives zeros
+    """
+
+    def __init__(self, bits: Bits, start: int = 0):
+        self._data = bits.data
+        self.length = bits.length
+        self.position = start - start % 8
+        self._next = start // 8  # next byte to load into the window
+        self._acc = 0
+        self._n = 0
+        self.skip(start % 8)
+
+    def _fill(self):
+        chunk = bytes(self._data[self._next:self._next + 4])
+        self._next += 4
+        self._acc = ((self._acc & ((1 << self._n) - 1)) << 32) | int.from_bytes(chunk.ljust(4, b"\0"), "big")
+        self._n += 32
+
+    def peek(self, n: int) -> int:
+        """
+        Next n bits as an integer without moving on
+        """
+        while self._n < n:
+            self._fill()
+        return (self._acc >> (self._n - n)) & ((1 << n) - 1)
+
+    def skip(self, n: int):
+        while self._n < n:
+            self._fill()
+        self._n -= n
+        self.position += n
+
+    def read(self, n: int) -> int:
+        out = self.peek(n)
+        self.skip(n)
+        return out
+
+    @property
+    def remaining(self):
+        return self.length - self.position
+
+
+def read_codes(bits: Bits, start: int, lengths: np.ndarray) -> np.ndarray:
+    """
+    Vectorized counterpart of BitWriter.write_codes(), the codes of the given lengths packed back to back from start
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(len(lengths), dtype=np.int64)
+    skip = start % 8
+    chunk = bytes(bits.data[start // 8:(start + total + 7) // 8])
+    raw = np.unpackbits(np.frombuffer(chunk, dtype=np.uint8))[skip:skip + total].astype(np.int64)
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    ends = np.cumsum(lengths)
+    # every bit weighs what its distance to the end of its code says, less than 53 bits so the sums are exact
+    shifts = ends[owner] - 1 - np.arange(total)
+    return np.bincount(owner, weights=(raw << shifts).astype(np.float64), minlength=len(lengths)).astype(np.int64)
+
+
 def open_raw_img(path):
     """
     open image from path
@@ -29,28 +206,15 @@ def bin_string_as_bytes(s: str) -> bytearray:
     Need to represent each bit as an actual bit instead of wasting a byte per char. Also I have to respect the zeros
     """
     assert len(s) > 0 and len(s) % 8 == 0  # if not, I probably forgot to pad upstream in HIC
-    return bitstring.BitArray('0b' + s).bytes
+    return Bits.from_string(s).data
 
 
 def padded_bs_2_bytes(s: str) -> bytearray:
     """
     I NEED TO BE BYTE ALIGNED, otherwise how do I know what's going on
     """
-    b = bitstring.BitArray('0b' + s)
-
-    padding = 8 - (len(b) % 8)
-    # assert we are byte aligned
-    b.append(padding)
-
-    to_prep = bitstring.Bits(uint=padding, length=8)
-    b.prepend(to_prep)
-
-    return b.tobytes()
+    return Bits.from_string(s).padded_bytes()
 
 
 def padded_bytes_2_bs(bites: bytearray) -> str:
-    b = bitstring.BitArray(bytes=bites)
-    padding = b[:8].int
-    b <<= 8
-    bits = b.bin[:-padding-8]
-    return bits
+    return str(Bits.from_padded_bytes(bites))
@@ -28,27 +28,131 @@ class QTables(enum.Enum):
     JPEG_CHROMINANCE = "jpeg standard chrominance"
 
 
+class HTables(enum.Enum):
+    JPEG_DC_LUMINANCE = "jpeg standard dc luminance"
+    JPEG_DC_CHROMINANCE = "jpeg standard dc chrominance"
+    JPEG_AC_LUMINANCE = "jpeg standard ac luminance"
+    JPEG_AC_CHROMINANCE = "jpeg standard ac chrominance"
+
+
+class HuffmanTables(enum.Enum):
+    """
+    Where the Huffman trees of a JPEG file come from. Custom ones are built from every image and stored with it, the
+    standard ones are the JPEG Annex K tables which cost nothing to build or store but don't fit any image in particular
+    """
+    CUSTOM = "custom"
+    STANDARD = "standard"
+
+
+class Symbols(enum.Enum):
+    """
+    What the Huffman trees code runs of zeros with. Separate trees for the run lengths and the values, or a single one
+    for joint (zeros, size) symbols that are each followed by the raw bits of the value, like JPEG does
+    """
+    SEPARATE = "separate"
+    JOINT = "joint"
+
+
+class Entropy(enum.Enum):
+    """
+    The entropy coder of a HIC file, canonical Huffman codes or interleaved rANS with a static model
+    """
+    HUFFMAN = "huffman"
+    RANS = "rans"
+
+
 class Wavelet(enum.Enum):
     DAUBECHIE = "db1"
     HAAR = "haar"
     COIF = "coif1"
     SYM = "sym2"
+    CDF_5_3 = "cdf5/3"  # integer lifting, reversible, see transform.lift()
+    CDF_9_7 = "cdf9/7"
+
+
+class WaveletCoding:
+    """
+    What the tiles of a HIC file went through, it goes in the file so decoding never has to guess from the settings
+    """
+
+    def __init__(self, wavelet: Wavelet, levels: int, lossless: bool = False):
+        self.wavelet = wavelet
+        self.levels = levels
+        self.lossless = lossless
+
+    def __eq__(self, other):
+        return type(self) == type(other) and (self.wavelet, self.levels, self.lossless) == (
+            other.wavelet, other.levels, other.lossless)
+
+
+class Tiling:
+    """
+    How a channel is cut up into tiles. Tiles are numbered row by row and the ones on the right and bottom edges may
+    come up short
+    """
+
+    @classmethod
+    def split(cls, shape, tiles, align=1):
+        """
+        Cut a channel into (at most) tiles x tiles tiles, the tile sides are rounded up to a multiple of align
+        """
+        return cls(shape, tuple([-(-(-(-n // tiles)) // align) * align for n in shape[:2]]))
+
+    def __init__(self, shape, tile_shape):
+        self.shape = tuple(shape)
+        self.tile_shape = tuple(tile_shape)
+
+    def __len__(self):
+        rows, cols = self.grid
+        return rows * cols
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.shape == other.shape and self.tile_shape == other.tile_shape
+
+    @property
+    def grid(self):
+        return -(-self.shape[0] // self.tile_shape[0]), -(-self.shape[1] // self.tile_shape[1])
+
+    @property
+    def regions(self):
+        """
+        (row slice, column slice) of every tile
+        """
+        rows, cols = self.grid
+        th, tw = self.tile_shape
+        return [(slice(r * th, min((r + 1) * th, self.shape[0])), slice(c * tw, min((c + 1) * tw, self.shape[1])))
+                for r in range(rows) for c in range(cols)]
+
+    @property
+    def tile_shapes(self):
+        return [(r[0].stop - r[0].start, r[1].stop - r[1].start) for r in self.regions]
+
+    def reduced(self, levels: int):
+        """
+        The same tiles in an image scaled down by 2^levels
+        """
+        scale = 2 ** levels
+        assert self.tile_shape[0] % scale == 0 and self.tile_shape[1] % scale == 0
+        return Tiling([-(-n // scale) for n in self.shape], [n // scale for n in self.tile_shape])
 
 
 class CompressedImage:
     """
-    Better for typing
+    Better for typing. For HIC each channel is a list of tiles, described by tiling, and each tile a list of subbands
+    of the transform described by coding
     """
 
     @classmethod
-    def from_dict(cls, d):
+    def from_dict(cls, d, tiling=None, coding=None):
         assert len(d) == 3
-        return cls(d["lum"], d["cr"], d["cb"])
+        return cls(d["lum"], d["cr"], d["cb"], tiling=tiling, coding=coding)
 
-    def __init__(self, lum, cr, cb):
+    def __init__(self, lum, cr, cb, tiling: Tiling = None, coding: WaveletCoding = None):
         self.luminance_component = lum
         self.red_chrominance_component = cr
         self.blue_chrominance_component = cb
+        self.tiling = tiling
+        self.coding = coding
 
     @property
     def shape(self):
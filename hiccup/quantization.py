@@ -46,7 +46,8 @@ def deadzone_quantize(block, div):
 
 def jpeg_quantize(block: np.ndarray, option: model.QTables):
     """
-    With an 8x8 block, perform dead quantization with a certain table. Dead 'cause we are creating deadzones
+    With an 8x8 block (or a stack of them), perform dead quantization with a certain table. Dead 'cause we are creating
+    deadzones
     """
     t = table[option]
     return deadzone_quantize(block, t)
@@ -81,14 +82,16 @@ def round_quantize(block: np.ndarray):
     return np.round(block).astype(np.int32)
 
 
-def quality_threshold_value(vals: list, q_factor=1):
+def quality_threshold_value(vals: np.ndarray, q_factor=1):
     """
     For wavelet compression, we won't rely on magical tables for quantization, we'll just pick how many coefficients we
     to keep by thresholding a certain percentage as suggested in the literature.
 
     NB we also just uniformly more aggressively on the subbands so this doesn't have to be used.
+
+    We only need the one order statistic, so select it in linear time instead of sorting everything.
     """
-    s = list(sorted(vals))
+    vals = np.ravel(np.asarray(vals))
     keep_up_too = int(np.ceil(len(vals) * q_factor))
     thresh_index = len(vals) - keep_up_too
-    return s[thresh_index]
+    return np.partition(vals, thresh_index)[thresh_index]
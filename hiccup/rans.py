@@ -0,0 +1,261 @@
+import numpy as np
+
+import hiccup.iohelper as io
+import hiccup.instrument as instrument
+
+"""
+Interleaved rANS with a static model, the other entropy coder next to huffman.py. A Huffman code spends a whole number
+of bits on every symbol, which hurts on the zero heavy wavelet levels where one symbol takes most of the probability.
+rANS gets within a hair of the entropy and spreads the symbols over lanes (symbol i goes to lane i % lanes), every lane
+has its own state so one numpy pass over the lanes codes a symbol on each of them. A numpy pass costs about as much as
+a few dozen symbols in plain Python though, so short streams just get the one lane and a plain loop.
+
+States are 32 bits and renormalize 16 bits at a time. A stream is
+    the symbol count (7 bits a byte, the high bit says another byte follows),
+    the final state of every lane (4 bytes each), how many lanes there are follows from the count,
+    the 16 bit words in the order the decoder wants them,
+    the raw bits after every symbol (if there are any), see encode_data()
+The model itself is just (value, frequency) pairs, the frequencies summing to 1 << prob_bits. Short streams don't need
+(or pay for storing) fine probabilities, so prob_bits grows with the stream up to MAX_PROB_BITS.
+"""
+
+MIN_PROB_BITS = 8
+MAX_PROB_BITS = 16  # no more than the 16 bits we renormalize by
+RANS_L = 1 << 16  # lower bound of a normalized state
+LANES = 64
+MIN_LANES = 16  # a numpy step costs about what a few dozen symbols in plain Python do
+LANE_SYMBOLS = 2048  # symbols a lane has to have to be worth its own state
+
+
+class RansModel:
+    @classmethod
+    @instrument.timed("rans build")
+    def construct_from_data(cls, data):
+        """
+        Count the symbols of data and scale the counts to the probability precision
+        """
+        values, counts = np.unique(np.asarray(data), return_counts=True)
+        instrument.count("rans symbols", len(data))
+        bits = int(np.clip(max(len(data), 2 * len(values)).bit_length(), MIN_PROB_BITS, MAX_PROB_BITS))
+        return cls(values, normalize_frequencies(counts, bits), data)
+
+    @classmethod
+    def construct_from_coding(cls, segments):
+        """
+        From the (value, frequency) pairs of encode_table()
+        """
+        values = np.array([t[0] for t in segments], dtype=np.int64)
+        frequencies = np.array([t[1] for t in segments], dtype=np.int64)
+        total = int(frequencies.sum())
+        if len(values) > 0 and (frequencies.min() < 1 or total & (total - 1) != 0 or total > 1 << MAX_PROB_BITS):
+            raise RuntimeError("Frequencies of the rANS model don't add up")
+        return cls(values, frequencies, None)
+
+    def __init__(self, values: np.ndarray, frequencies: np.ndarray, data):
+        self.values = values
+        self.prob_bits = max(int(frequencies.sum()).bit_length() - 1, 0)
+        self.frequencies = frequencies.astype(np.uint64)
+        self.starts = (np.cumsum(frequencies) - frequencies).astype(np.uint64)
+        self.data = data
+        self._decoder = None
+        self._lane_decoder = None
+
+    def encode_table(self):
+        """
+        (value, frequency) pairs
+        """
+        return list(zip(self.values.tolist(), self.frequencies.tolist()))
+
+    @instrument.timed("rans encode")
+    def encode_data(self, data=None, extra=None) -> io.Bits:
+        """
+        Code data (the data we were built from by default), extra is (bits, lengths) of raw bits for every symbol. Those
+        don't go through the coder at all, they are packed after the words
+        """
+        data = np.asarray(self.data if data is None else data)
+        index = np.minimum(np.searchsorted(self.values, data), max(len(self.values) - 1, 0))
+        if len(data) > 0 and np.any(self.values[index] != data):
+            raise RuntimeError("Data has values that are not in the rANS model")
+
+        lanes = lane_count(len(data))
+        (x, words) = self._encode_lanes(index, lanes) if lanes > 1 else self._encode_lane(index.tolist())
+        stream = varint(len(data)) + np.asarray(x, dtype=">u4").tobytes() + np.asarray(words, dtype=">u2").tobytes()
+        length = len(stream) * 8
+        if extra is not None:
+            writer = io.BitWriter()
+            writer.write_codes(extra[0], extra[1])
+            raw = writer.bits()
+            (stream, length) = (stream + raw.data, length + raw.length)
+        instrument.count("rans bits", length)
+        return io.Bits(stream, length)
+
+    def _encode_lanes(self, index: np.ndarray, lanes: int):
+        """
+        The final states and the words of every lane, backwards so the decoder goes forwards. At every step the lanes
+        that renormalize write a word each, in lane order
+        """
+        n = len(index)
+        steps = -(-n // lanes)
+        index = np.append(index, np.zeros(steps * lanes - n, dtype=index.dtype)).reshape(steps, lanes)
+        (bits, limit) = (np.uint64(self.prob_bits), np.uint64(32 - self.prob_bits))
+        x = np.full(lanes, RANS_L, dtype=np.uint64)
+        words = []
+        for t in range(steps - 1, -1, -1):
+            count = min(lanes, n - t * lanes)
+            s = index[t, :count]
+            (f, c) = (self.frequencies[s], self.starts[s])
+            xs = x[:count]
+            renorm = xs >= f << limit
+            words.append(xs[renorm] & np.uint64(0xFFFF))
+            xs[renorm] >>= np.uint64(16)
+            x[:count] = ((xs // f) << bits) + xs % f + c
+        return x, np.concatenate(words[::-1])
+
+    def _encode_lane(self, index: list):
+        (frequencies, starts) = (self.frequencies.tolist(), self.starts.tolist())
+        (bits, limit) = (self.prob_bits, 32 - self.prob_bits)
+        x = RANS_L
+        words = []
+        for s in reversed(index):
+            f = frequencies[s]
+            if x >= f << limit:
+                words.append(x & 0xFFFF)
+                x >>= 16
+            x = ((x // f) << bits) + x % f + starts[s]
+        return [x], words[::-1]
+
+    def decode_table(self):
+        """
+        Build (once) what every one of the 1 << prob_bits slots decodes to: the symbol (as an index into values), its
+        frequency and its slot minus its start, so a step is one lookup and a multiply add
+        """
+        if self._decoder is None:
+            slots = np.repeat(np.arange(len(self.values)), self.frequencies.astype(np.int64))
+            bias = np.arange(len(slots), dtype=np.uint64) - self.starts[slots]
+            self._decoder = (slots, self.frequencies[slots], bias)
+        return self._decoder
+
+    @instrument.timed("rans decode")
+    def decode_data(self, bits: io.Bits, start: int = 0, end: int = None, extra=None):
+        """
+        Decode a whole stream between bit positions start and end, start has to be where one begins. With extra, how
+        many raw bits follow each symbol (indexed by the symbol), we give back the symbols and those raw bits
+        """
+        end = bits.length if end is None else end
+        assert start % 8 == 0
+        data = bytes(bits.data[start // 8:-(-end // 8)])
+        (n, offset) = read_varint(data)
+        lanes = lane_count(n)
+        if len(data) < offset + 4 * lanes:
+            raise RuntimeError("rANS stream is cut short")
+        x = np.frombuffer(data, dtype=">u4", count=lanes, offset=offset).astype(np.uint64)
+        offset += 4 * lanes
+        words = np.frombuffer(data, dtype=">u2", count=(len(data) - offset) // 2, offset=offset).astype(np.uint64)
+        if lanes > 1:
+            (index, x, position) = self._decode_lanes(x, words, n)
+        else:
+            (index, x, position) = self._decode_lane(int(x[0]), words.tolist(), n)
+        if np.any(x != RANS_L):
+            raise RuntimeError("rANS stream is corrupt")
+
+        symbols = self.values[index]
+        if extra is None:
+            return symbols.tolist()
+        sizes = np.asarray(extra, dtype=np.int64)[symbols]
+        raw_start = start + 8 * (offset + 2 * position)
+        if raw_start + int(sizes.sum()) > end:
+            raise RuntimeError("rANS stream is cut short")
+        return symbols.tolist(), io.read_codes(bits, raw_start, sizes).tolist()
+
+    def _decode_lanes(self, x: np.ndarray, words: np.ndarray, n: int):
+        """
+        The symbol indexes, the states we ended up in (where the encoder started, if all went well) and how many words
+        we read
+        """
+        (slots, frequencies, bias) = self.decode_table()
+        (bits, mask) = (np.uint64(self.prob_bits), np.uint64((1 << self.prob_bits) - 1))
+        lanes = len(x)
+        steps = -(-n // lanes)
+        out = np.zeros((steps, lanes), dtype=np.int64)
+        position = 0
+        for t in range(steps):
+            count = min(lanes, n - t * lanes)
+            xs = x[:count]
+            slot = (xs & mask).astype(np.intp)
+            xs = frequencies[slot] * (xs >> bits) + bias[slot]
+            renorm = xs < RANS_L
+            k = int(np.count_nonzero(renorm))
+            if position + k > len(words):
+                raise RuntimeError("rANS stream is cut short")
+            xs[renorm] = (xs[renorm] << np.uint64(16)) | words[position:position + k]
+            position += k
+            x[:count] = xs
+            out[t, :count] = slot
+        return slots[out.ravel()[:n]], x, position
+
+    def _decode_lane(self, x: int, words: list, n: int):
+        if self._lane_decoder is None:
+            # restart segments come one after the other, only make the lists once
+            self._lane_decoder = [a.tolist() for a in self.decode_table()]
+        (slots, frequencies, bias) = self._lane_decoder
+        (bits, mask) = (self.prob_bits, (1 << self.prob_bits) - 1)
+        out = [0] * n
+        position = 0
+        for i in range(n):
+            slot = x & mask
+            s = slots[slot]
+            x = frequencies[slot] * (x >> bits) + bias[slot]
+            if x < RANS_L:
+                if position == len(words):
+                    raise RuntimeError("rANS stream is cut short")
+                x = (x << 16) | words[position]
+                position += 1
+            out[i] = s
+        return np.array(out, dtype=np.int64), np.array([x]), position
+
+
+def lane_count(n: int) -> int:
+    lanes = min(n // LANE_SYMBOLS, LANES)
+    return lanes if lanes >= MIN_LANES else 1
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(0x80 | (n & 0x7F))
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(data: bytes) -> tuple:
+    """
+    The number varint() wrote at the start of data and how many bytes it took
+    """
+    n = 0
+    for (i, b) in enumerate(data[:10]):
+        n |= (b & 0x7F) << (7 * i)
+        if b < 0x80:
+            return n, i + 1
+    raise RuntimeError("rANS stream is cut short")
+
+
+def normalize_frequencies(counts: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Scale counts to sum to 1 << bits, every symbol keeps at least 1. Whatever rounding is off comes out of (or goes
+    into) the most common symbols, where it costs the least
+    """
+    total = 1 << bits
+    if len(counts) > total:
+        raise RuntimeError("Cannot fit %d symbols in %d bits of probability" % (len(counts), bits))
+    if len(counts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    frequencies = np.maximum(1, np.round(counts * (total / counts.sum()))).astype(np.int64)
+    excess = int(frequencies.sum()) - total
+    for i in np.argsort(-frequencies, kind="stable"):
+        if excess == 0:
+            break
+        change = min(excess, int(frequencies[i]) - 1)
+        frequencies[i] -= change
+        excess -= change
+    return frequencies
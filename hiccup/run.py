@@ -1,15 +1,46 @@
+import concurrent.futures
+import cProfile
+import glob
 import os
+import time
+
 import cv2
 import hiccup.compression as compression
 import hiccup.model as model
 import hiccup.codec as codec
 import hiccup.hicimage as hic
+import hiccup.scheduler as scheduler
+import hiccup.utils as utils
+import hiccup.instrument as instrument
 
 """
 Entry functions for belch
 """
 
 
+def profile(f, output, style="cprofile"):
+    """
+    Run f with our spans collected and print where the time went. output gets either the cProfile stats (for pstats
+    or snakeviz) or our spans as collapsed stacks (for flame graphs)
+    """
+    profiler = cProfile.Profile() if style == "cprofile" else None
+    with instrument.Collector() as collector:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return f()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(output)
+            elif style == "collapsed":
+                with open(output, "w") as out:
+                    out.write(collector.collapsed() + "\n")
+            else:
+                raise RuntimeError("Unknown profile style: " + style)
+            print(collector.report())
+
+
 def img_name(path, c: model.Compression):
     f = os.path.split(path)[-1]
     return f + ".%s-hic" % c.value
@@ -21,23 +52,113 @@ def compress(path, output, c: model.Compression):
         compressed = compression.jpeg_compression(rgb)
         hi = codec.jpeg_encode(compressed)
     elif c == model.Compression.HIC:
-        compressed = compression.wavelet_compression(rgb)
-        hi = codec.wavelet_encode(compressed)
+        hi = scheduler.wavelet_encode_image(rgb)
     else:
         raise RuntimeError("Unknown compression type")
     output = os.path.join(output, img_name(path, c))
     hi.write_file(output)
+    return output
 
 
-def decompress(path):
-    hi = hic.HicImage.from_file(path)
-    if hi.hic_type == model.Compression.JPEG:
-        compressed = codec.jpeg_decode(hi)
-        rgb = compression.jpeg_decompression(compressed)
-    elif hi.hic_type == model.Compression.HIC:
-        compressed = codec.wavelet_decode(hi)
-        rgb = compression.wavelet_decompression(compressed)
-    else:
-        raise RuntimeError("Unknown compression type")
-    cv2.imshow("Result", rgb)
+def decode(path, max_level=0, region=None):
+    """
+    max_level > 0 gives a 1/2^max_level scale preview of a HIC file, only the coarse levels it needs are ever read.
+    region (top, left, height, width) gives just that part of a JPEG file, only the blocks it needs are ever decoded
+    """
+    with hic.HicImage.from_file(path) as hi:
+        if hi.hic_type == model.Compression.JPEG:
+            if max_level != 0:
+                raise RuntimeError("Only HIC files decode at lower resolutions")
+            if region is not None:
+                return compression.jpeg_decompression_region(codec.jpeg_decode_region(hi, region), region)
+            compressed = codec.jpeg_decode(hi)
+            rgb = compression.jpeg_decompression(compressed)
+        elif hi.hic_type == model.Compression.HIC:
+            if region is not None:
+                raise RuntimeError("Only JPEG files decode regions")
+            rgb = scheduler.wavelet_decode_image(hi, max_level=max_level)
+        else:
+            raise RuntimeError("Unknown compression type")
+    return rgb
+
+
+def decompress(path, max_level=0, region=None):
+    cv2.imshow("Result", decode(path, max_level=max_level, region=region))
     cv2.waitKey()
+
+
+def decompress_to(path, output):
+    """
+    Decompress without looking at it, the image lands next to the others as a png
+    """
+    f = os.path.split(path)[-1]
+    output = os.path.join(output, f + ".png")
+    cv2.imwrite(output, decode(path))
+    return output
+
+
+def is_hic(path):
+    return any([path.endswith(img_name("", c)) for c in model.Compression])
+
+
+def batch_inputs(pattern):
+    """
+    A directory means everything in it, otherwise pattern is a glob
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, f) for f in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted([p for p in paths if os.path.isfile(p)])
+
+
+def batch_file(path, args):
+    """
+    One unit of work in a batch, hic files get decompressed and everything else compressed. Gives back the timings for
+    our report
+    """
+    (output, c) = args
+    start = time.perf_counter()
+    out = decompress_to(path, output) if is_hic(path) else compress(path, output, c)
+    return os.path.getsize(path), os.path.getsize(out), time.perf_counter() - start
+
+
+def batch(pattern, output, c: model.Compression, workers: int = None):
+    """
+    Stream every input through a process pool. Workers read, code and write their own files so reading the next image
+    overlaps with coding the last, we just collect the results as they land
+    """
+    paths = batch_inputs(pattern)
+    workers = os.cpu_count() if workers is None else workers
+    pool = utils.executor_pool("process", workers)
+    snapshot = utils.settings_snapshot()
+
+    start = time.perf_counter()
+    futures = dict([(pool.submit(utils.call_with_settings, snapshot, batch_file, p, (output, c)), p) for p in paths])
+    results = {}
+    failures = {}
+    for future in concurrent.futures.as_completed(futures):
+        path = futures[future]
+        try:
+            results[path] = future.result()
+            utils.debug_msg("Finished %s", path)
+        except Exception as e:
+            failures[path] = e
+    elapsed = time.perf_counter() - start
+
+    print(batch_report(results, failures, elapsed))
+    return results, failures
+
+
+def batch_report(results: dict, failures: dict, elapsed: float) -> str:
+    lines = ["%-40s %10s %10s %8s" % ("file", "in bytes", "out bytes", "seconds")]
+    for (path, (in_size, out_size, seconds)) in sorted(results.items()):
+        lines.append("%-40s %10d %10d %8.3f" % (os.path.split(path)[-1], in_size, out_size, seconds))
+    for (path, e) in sorted(failures.items()):
+        lines.append("%-40s failed: %s" % (os.path.split(path)[-1], e))
+
+    read = sum([r[0] for r in results.values()])
+    elapsed = max(elapsed, 1e-9)
+    lines.append("%d images in %.3fs, %.2f images/s, %.2f MB/s read" %
+                 (len(results), elapsed, len(results) / elapsed, read / elapsed / 1e6))
+    return "\n".join(lines)
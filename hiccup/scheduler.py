@@ -0,0 +1,133 @@
+from multiprocessing import shared_memory
+from typing import List
+
+import numpy as np
+
+import hiccup.codec as codec
+import hiccup.compression as compression
+import hiccup.hicimage as hic
+import hiccup.model as model
+import hiccup.settings as settings
+import hiccup.utils as utils
+
+"""
+Wavelet tiles on a process pool. The entropy coding is plain Python so threads just take turns on the GIL, but shipping
+the channels to processes would pickle the whole image. Instead the channels (or the decoded output) live in shared
+memory and a worker only gets told which tile of which channel to work on, what comes back is the coded tile.
+"""
+
+
+class SharedChannels:
+    """
+    The lum, cr and cb planes of an image stacked in one shared memory block
+    """
+
+    def __init__(self, shape: tuple, name: str = None):
+        self.shape = (len(codec.CHANNELS),) + tuple(shape)
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        else:
+            # pool workers share our resource tracker so attaching never leaks, the creator unlinks
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.planes = np.ndarray(self.shape, dtype=np.uint8, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def channel(self, k) -> np.ndarray:
+        return self.planes[codec.CHANNELS.index(k)]
+
+    def close(self):
+        self.planes = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_attached = {}
+
+
+def _attach(name: str, shape: tuple) -> SharedChannels:
+    """
+    Workers keep the blocks they've seen mapped, only the last one is ever still in use
+    """
+    if name not in _attached:
+        for old in _attached.values():
+            old.close()
+        _attached.clear()
+        _attached[name] = SharedChannels(shape, name=name)
+    return _attached[name]
+
+
+def encode_tile_task(task: tuple, args: tuple) -> List[hic.Payload]:
+    (k, i) = task
+    (name, tiling, coding) = args
+    channel = _attach(name, tiling.shape).channel(k)
+    subbands = compression.wavelet_compress_tile(channel[tiling.regions[i]], coding)
+    return codec.wavelet_encode_tile(subbands)
+
+
+def decode_tile_task(task: tuple, args: tuple):
+    (k, i) = task
+    (payloads, name, tiling, out_tiling, coding, restart, symbols, entropy) = args
+    channel = _attach(name, out_tiling.shape).channel(k)
+    subbands = codec.wavelet_decode_tile(payloads, tiling.tile_shapes[i], coding, restart, symbols, entropy)
+    compression.wavelet_decompress_tile(subbands, channel[out_tiling.regions[i]], coding)
+
+
+def _run(f, tasks: dict, workers: int) -> dict:
+    pool = utils.executor_pool("process", workers)
+    snapshot = utils.settings_snapshot()
+    futures = [(k, pool.submit(utils.call_with_settings, snapshot, f, k, v)) for (k, v) in tasks.items()]
+    return dict([(k, future.result()) for (k, future) in futures])
+
+
+def wavelet_encode_image(rgb_image: np.ndarray, workers: int = None) -> hic.HicImage:
+    """
+    Same file as wavelet_compression() then wavelet_encode(), every tile of every channel is a task
+    """
+    workers = utils.process_workers(settings.TILE_WORKERS if workers is None else workers)
+    if workers <= 1:
+        return codec.wavelet_encode(compression.wavelet_compression(rgb_image))
+    coding = compression.wavelet_coding()
+    yrcrcb = compression.wavelet_color(rgb_image, coding)
+    tiling = model.Tiling.split(yrcrcb.shape[:2], settings.WAVELET_TILES, align=2 ** coding.levels)
+
+    with SharedChannels(tiling.shape) as shared:
+        shared.planes[:] = np.moveaxis(yrcrcb, -1, 0)
+        tasks = dict([((k, i), (shared.name, tiling, coding)) for k in codec.CHANNELS for i in range(len(tiling))])
+        utils.debug_msg("Scheduling %d tiles on %d workers", len(tasks), workers)
+        coded = _run(encode_tile_task, tasks, workers)
+
+    encoded = dict([(k, [coded[(k, i)] for i in range(len(tiling))]) for k in codec.CHANNELS])
+    return hic.HicImage.wavelet_image(codec.wavelet_payloads(tiling, coding, encoded))
+
+
+def wavelet_decode_image(hic_image: hic.HicImage, workers: int = None, max_level: int = 0) -> np.ndarray:
+    """
+    Same image as wavelet_decode() then wavelet_decompression(), workers write their tile straight into the output
+    """
+    workers = utils.process_workers(settings.TILE_WORKERS if workers is None else workers)
+    if workers <= 1:
+        return compression.wavelet_decompression(codec.wavelet_decode(hic_image, max_level=max_level))
+    assert hic_image.hic_type == model.Compression.HIC
+    (tiling, restart, symbols, entropy, coding, channels) = codec.wavelet_tile_payloads(hic_image.payloads,
+                                                                                         max_level=max_level)
+    out_tiling = tiling.reduced(max_level)
+
+    with SharedChannels(out_tiling.shape) as shared:
+        tasks = dict([((k, i), (channels[k][i], shared.name, tiling, out_tiling, coding, restart, symbols, entropy))
+                      for k in codec.CHANNELS for i in range(len(tiling))])
+        utils.debug_msg("Scheduling %d tiles on %d workers", len(tasks), workers)
+        _run(decode_tile_task, tasks, workers)
+        yrcrcb = np.ascontiguousarray(np.moveaxis(shared.planes, 0, -1))
+    return compression.wavelet_inverse_color(yrcrcb, coding)
+
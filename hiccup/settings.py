@@ -14,9 +14,27 @@ WAVELET_QUALITY_FACTOR = 1
 WAVELET_SUBBAND_QUANTIZATION_MULTIPLIER = 1
 WAVELET_THRESHOLD = 5
 WAVELET_NUM_LEVELS = 3
-WAVELET_TILES = 8
+WAVELET_TILES = 8  # tiles along each axis, every tile is transformed and coded on its own. 1 for the whole channel
+WAVELET_RESTART_INTERVAL = 0  # coefficients per restart segment of every level of a tile, 0 for none
+WAVELET_LOSSLESS = False  # reversible colors and no quantization, WAVELET has to be CDF_5_3
+
+HUFFMAN_MAX_CODE_LENGTH = 16  # like JPEG, keeps every decode table small and bounds the worst case
+SYMBOLS = model.Symbols.SEPARATE  # JOINT halves the symbols we code, one (zeros, size) symbol per run plus raw bits
+ENTROPY = model.Entropy.HUFFMAN  # what codes the wavelet symbols, RANS gets closer to the entropy, see rans.py
+
+CHANNEL_WORKERS = 1  # run the lum, cr and cb pipelines at the same time, 1 keeps everything on the calling thread
+CHANNEL_EXECUTOR = "thread"  # or "process", numpy lets go of the GIL for most of our work so threads are usually enough
+TILE_WORKERS = 1  # processes coding wavelet tiles out of shared memory, see scheduler.py
+RESTART_WORKERS = 1  # processes entropy decoding the restart segments of a JPEG channel
+
+FFT_WORKERS = 1  # threads scipy.fft may use for the block transforms, -1 for every core
 
 JPEG_BLOCK_SIZE = 8  # never going to change this since this would require an update to our qnt tables
+JPEG_BLOCK_GROUP = 16  # blocks along a row that are coded on their own and indexed, what a region decode jumps between
+# STANDARD codes with the Annex K tables, nothing to build or store. Our DCT isn't normalized so lum gets shifted right
+# a bit (twice the quantization step) to fit them, see codec.jpeg_coding()
+JPEG_HUFFMAN_TABLES = model.HuffmanTables.CUSTOM
+JPEG_RESTART_INTERVAL = 0  # block groups per restart segment, every segment is byte aligned and decodes on its own
 
 
 def JPEG_BLOCK_SHAPE():
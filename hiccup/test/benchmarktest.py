@@ -0,0 +1,44 @@
+import unittest
+
+from bin.benchmark import suite
+
+
+def results(stages: dict) -> dict:
+    return {"results": [{
+        "image": "gh.png",
+        "scale": 1,
+        "compression": "hic",
+        "stages": dict([(stage, {"median": median}) for (stage, median) in stages.items()])
+    }]}
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_compare_regression(self):
+        baseline = results({"encode": 0.1, "decode": 0.1})
+        current = results({"encode": 0.2, "decode": 0.105})
+        self.assertEqual(suite.compare(baseline, current, 0.1, 0.005), [{
+            "image": "gh.png",
+            "scale": 1,
+            "compression": "hic",
+            "stage": "encode",
+            "baseline": 0.1,
+            "current": 0.2
+        }])
+
+    def test_compare_improvement(self):
+        baseline = results({"encode": 0.2, "decode": 0.2})
+        current = results({"encode": 0.1, "decode": 0.2})
+        self.assertEqual(suite.compare(baseline, current, 0.1, 0.005), [])
+
+    def test_compare_floor(self):
+        # doubling counts for nothing when it's still under the floor
+        baseline = results({"encode": 0.001})
+        current = results({"encode": 0.002})
+        self.assertEqual(suite.compare(baseline, current, 0.1, 0.005), [])
+        self.assertEqual(len(suite.compare(baseline, current, 0.1, 0.0005)), 1)
+
+    def test_compare_unmatched(self):
+        baseline = results({"encode": 0.1})
+        current = results({"encode": 0.5, "decode": 0.5})
+        current["results"].append(dict(current["results"][0], scale=0.5))
+        self.assertEqual([r["stage"] for r in suite.compare(baseline, current, 0.1, 0.005)], ["encode"])
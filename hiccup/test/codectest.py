@@ -1,3 +1,5 @@
+import itertools
+import random
 import unittest
 import numpy as np
 
@@ -6,6 +8,10 @@ import hiccup.settings as settings
 import hiccup.model as model
 import hiccup.transform as transform
 import hiccup.codec as codec
+import hiccup.compression as compression
+import hiccup.huffman as huffman
+import hiccup.hicimage as hic
+import hiccup.iohelper as io
 
 settings.DEBUG = False
 
@@ -28,7 +34,7 @@ class CodecTest(unittest.TestCase):
             [0, 0, 0, 0, 0, 0, 0, 0],
             [0, 0, 0, 0, 0, 0, 0, 0]
         ])
-        rl = codec.run_length_coding(transform.zigzag(matrix))
+        rl = codec.RunLength.from_arrays(*codec.run_length_coding(transform.zigzag(matrix)))
         expected = [{'zeros': 0, 'value': 99, 'bits': 7}, {'zeros': 1, 'value': -59, 'bits': 6},
                     {'zeros': 6, 'value': 7, 'bits': 3}, {'zeros': 4, 'value': 12, 'bits': 4},
                     {'zeros': 1, 'value': -2, 'bits': 2}, {'zeros': 0, 'value': 0, 'bits': 0}]
@@ -39,7 +45,7 @@ class CodecTest(unittest.TestCase):
             [1, 2],
             [3, 4]
         ])
-        rl = codec.run_length_coding(transform.zigzag(matrix)[1:])
+        rl = codec.RunLength.from_arrays(*codec.run_length_coding(transform.zigzag(matrix)[1:]))
         self.assertEqual(rl, [
             codec.RunLength(3, 0),
             codec.RunLength(2, 0),
@@ -49,14 +55,13 @@ class CodecTest(unittest.TestCase):
     def test_rle_too_long(self):
         l = ([0] * 17) + [1]
         arr = np.array(l)
-        out = codec.run_length_coding(arr, max_len=0xF)
-        zeros = [s.length for s in out]
-        self.assertEqual(zeros, [14, 2])
+        zeros, values = codec.run_length_coding(arr, max_len=0xF)
+        self.assertEqual(zeros.tolist(), [14, 2])
+        self.assertEqual(values.tolist(), [0, 1])
 
     def _symbol_0_0(self, has, arr):
-        out = codec.run_length_coding(np.array(arr))
-        last = out[-1]
-        self.assertEqual((last.length == 0 and last.value == 0), has)
+        lengths, values = codec.run_length_coding(np.array(arr))
+        self.assertEqual((lengths[-1] == 0 and values[-1] == 0), has)
 
     def test_symbol_0_0(self):
         cases = [
@@ -74,9 +79,184 @@ class CodecTest(unittest.TestCase):
         )
         hic = codec.jpeg_encode(compressed)
         payloads = hic.payloads
-        self.assertEqual(len(payloads), 20)
+        self.assertEqual(len(payloads), 31)
         self.assertEqual(hic.hic_type, model.Compression.JPEG)
-        self.assertEqual(payloads[0].payloads[0].numbers, (1, '1'))
+        self.assertEqual(payloads[0].payload, "custom")
+        self.assertEqual(payloads[3].payload, "separate")
+        self.assertEqual(payloads[6].array.ravel().tolist(), [0, 0, 0])
+        self.assertEqual(payloads[7].payloads[0].numbers, (1, 1))
+
+    def test_rle_stops(self):
+        arr = np.array([0, 0, 3, 0, 0, 0, 0, 5, 0, 0])
+        lengths, values = codec.run_length_coding(arr, stops=[4])
+        self.assertEqual(codec.RunLength.from_arrays(lengths, values),
+                         codec.RunLength.from_arrays([2, 1, 2, 0], [3, 0, 5, 0]))
+        self.assertTrue(np.array_equal(codec.decode_run_length(lengths[:2], values[:2], 5), arr[:5]))
+        self.assertTrue(np.array_equal(codec.decode_run_length(lengths, values, 10), arr))
+
+    def test_group_differences(self):
+        values = np.array([5, 7, 2, 9, 9, 1, 4])
+        starts = np.array([0, 3, 5])
+        diffs = codec.group_differences(values, starts)
+        self.assertEqual(diffs.tolist(), [5, 2, -5, 9, 0, 1, 3])
+        self.assertEqual(codec.invert_group_differences(diffs, starts).tolist(), values.tolist())
+        self.assertEqual(codec.jpeg_group_starts((2, 5), 2).tolist(), [0, 2, 4, 5, 7, 9])
+
+    def test_jpeg_decode_region(self):
+        (size, group) = (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP)
+        settings.JPEG_BLOCK_SIZE = 8
+        settings.JPEG_BLOCK_GROUP = 2
+        try:
+            rng = np.random.RandomState(3)
+            lum = np.where(rng.rand(45, 70) < 0.7, 0, rng.randint(-20, 20, (45, 70)))
+            chroma = np.where(rng.rand(22, 35) < 0.7, 0, rng.randint(-20, 20, (22, 35)))
+            compressed = model.CompressedImage(lum, chroma, chroma * 2)
+            hic = codec.jpeg_encode(compressed)
+            self.assertEqual(codec.jpeg_decode(hic), compressed)
+
+            decoded = codec.jpeg_decode_region(hic, (20, 30, 10, 12))
+            (coefficients, (y, x)) = decoded["lum"]
+            self.assertEqual((y, x), (16, 16))
+            self.assertTrue(np.array_equal(coefficients, lum[16:32, 16:48]))
+            (coefficients, (y, x)) = decoded["cb"]
+            self.assertEqual((y, x), (8, 0))
+            self.assertTrue(np.array_equal(coefficients, chroma[8:22, 0:32] * 2))
+        finally:
+            (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP) = (size, group)
+
+    def test_bit_offsets_segments(self):
+        data = np.array([random.randint(0, 9) for _ in range(300)])
+        huff = huffman.HuffmanTree.construct_from_data(data)
+        segments = np.array([0, 40, 41, 200])
+        encoded = codec.huffman_data_encode(huff, segments=segments)
+        offsets = codec.bit_offsets(huff, data, np.arange(len(data)), segments)
+        self.assertEqual(offsets[segments].tolist(), encoded.starts.tolist())
+        self.assertEqual(offsets[-1], encoded.ends[-1])
+        self.assertEqual(codec.huffman_data_decode(encoded, huff), data.tolist())
+        self.assertEqual(codec.huffman_data_decode(encoded, huff, offsets[30], offsets[210]), data[30:210].tolist())
+
+    def test_jpeg_restarts(self):
+        (size, group, restart) = (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP, settings.JPEG_RESTART_INTERVAL)
+        settings.JPEG_BLOCK_SIZE = 8
+        settings.JPEG_BLOCK_GROUP = 2
+        settings.JPEG_RESTART_INTERVAL = 3
+        try:
+            rng = np.random.RandomState(5)
+            lum = np.where(rng.rand(40, 56) < 0.7, 0, rng.randint(-20, 20, (40, 56)))
+            chroma = np.where(rng.rand(20, 28) < 0.7, 0, rng.randint(-20, 20, (20, 28)))
+            compressed = model.CompressedImage(lum, chroma, chroma * 2)
+            hic_image = codec.jpeg_encode(compressed)
+            # 5 rows of 4 groups of lum blocks
+            self.assertEqual(len(hic_image.payloads[10]), 7)
+            self.assertEqual(codec.jpeg_decode(hic_image), compressed)
+
+            # garble the second segment of lum, only its 3 groups get lost
+            dc = hic_image.payloads[10]
+            garbled = bytearray(dc.payload.data)
+            garbled[dc.starts[1] // 8:dc.starts[2] // 8] = b"\xff" * ((dc.starts[2] - dc.starts[1]) // 8)
+            hic_image.payloads[10] = hic.SegmentsP(io.Bits(bytes(garbled), dc.payload.length), dc.ends)
+            decoded = codec.jpeg_decode(hic_image)
+            lost = np.zeros(lum.shape, dtype=bool)
+            lost[0:8, 48:56] = lost[8:16, 0:32] = True
+            self.assertTrue(np.array_equal(decoded.as_dict["lum"][~lost], lum[~lost]))
+            self.assertFalse(decoded.as_dict["lum"][lost].any())
+            self.assertTrue(np.array_equal(decoded.as_dict["cb"], chroma * 2))
+        finally:
+            (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP) = (size, group)
+            settings.JPEG_RESTART_INTERVAL = restart
+
+    def test_magnitude_bits(self):
+        values = np.array([0, 1, -1, 2, -3, 7, -8, 1023, -1023])
+        sizes = codec.size_categories(values)
+        self.assertEqual(sizes.tolist(), [0, 1, 1, 2, 2, 3, 4, 10, 10])
+        bits = codec.magnitude_bits(values, sizes)
+        self.assertEqual(bits[:5].tolist(), [0, 1, 0, 2, 0])
+        self.assertEqual(codec.invert_magnitude_bits(bits, sizes).tolist(), values.tolist())
+
+    def test_jpeg_ac_symbols(self):
+        acs = np.zeros((3, 40), dtype=np.int64)
+        acs[0, [0, 3]] = [5, -1]
+        acs[2, [20, 39]] = [2, 300]
+        (symbols, values, starts) = codec.jpeg_ac_symbols(acs)
+        self.assertEqual(symbols.tolist(), [0x03, 0x21, 0x00, 0x00, 0xF0, 0x42, 0xF0, 0x29, 0x00])
+        self.assertEqual(values.tolist(), [5, -1, 0, 0, 0, 2, 0, 300, 0])
+        self.assertEqual(starts.tolist(), [0, 3, 4])
+        bits = codec.magnitude_bits(values, symbols & 0xF)
+        self.assertTrue(np.array_equal(codec.jpeg_ac_blocks(symbols, bits, 3, 40), acs))
+        self.assertIsNone(codec.jpeg_ac_blocks(symbols, bits, 4, 40))
+
+    def test_jpeg_standard_tables(self):
+        tables = settings.JPEG_HUFFMAN_TABLES
+        settings.JPEG_HUFFMAN_TABLES = model.HuffmanTables.STANDARD
+        try:
+            rng = np.random.RandomState(11)
+            lum = np.where(rng.rand(32, 48) < 0.7, 0, rng.randint(-2000, 2000, (32, 48)))
+            chroma = np.where(rng.rand(16, 24) < 0.7, 0, rng.randint(-300, 300, (16, 24)))
+            compressed = model.CompressedImage(lum, chroma, chroma * 2)
+            hic_image = codec.jpeg_encode(compressed)
+            self.assertEqual([hic_image.payloads[i].payload for i in range(6)], ["standard"] * 3 + ["joint"] * 3)
+            self.assertEqual(len(hic_image.payloads), 6 + 1 + 2 * 3 + 2 + 1 + 3)
+            # lum has values the standard tables can't take, it's shifted a bit to fit and only off by the rounding
+            self.assertEqual(hic_image.payloads[6].array.ravel().tolist(), [1, 0, 0])
+            decoded = codec.jpeg_decode(hic_image)
+            self.assertTrue(np.array_equal(decoded.as_dict["cb"], chroma * 2))
+            self.assertLessEqual(np.abs(decoded.as_dict["lum"] - lum).max(), 1)
+            self.assertTrue(np.array_equal(decoded.as_dict["lum"], codec.shift_right(lum, 1) << 1))
+        finally:
+            settings.JPEG_HUFFMAN_TABLES = tables
+
+    def test_jpeg_standard_tables_lum(self):
+        (size, tables) = (settings.JPEG_BLOCK_SIZE, settings.JPEG_HUFFMAN_TABLES)
+        settings.JPEG_BLOCK_SIZE = 8
+        settings.JPEG_HUFFMAN_TABLES = model.HuffmanTables.STANDARD
+        try:
+            rng = np.random.RandomState(12)
+            blocks = rng.randint(0, 256, (4, 6))
+            rgb = np.kron(blocks, np.ones((8, 8))).astype(np.uint8)[:, :, np.newaxis].repeat(3, axis=2)
+            rgb = np.clip(rgb + rng.randint(-20, 20, rgb.shape), 0, 255).astype(np.uint8)
+            compressed = compression.jpeg_compression(rgb)
+            self.assertGreater(np.abs(compressed.luminance_component).max(), codec.STANDARD_LARGEST)
+            hic_image = codec.jpeg_encode(compressed)
+            self.assertEqual(hic_image.payloads[0].payload, "standard")
+            decoded = compression.jpeg_decompression(codec.jpeg_decode(hic_image))
+            # the shift costs a little against the exact coefficients, but nothing like the quantization itself
+            exact = compression.jpeg_decompression(compressed)
+            self.assertLess(np.abs(decoded - rgb.astype(int)).mean(), 1.1 * np.abs(exact - rgb.astype(int)).mean())
+        finally:
+            (settings.JPEG_BLOCK_SIZE, settings.JPEG_HUFFMAN_TABLES) = (size, tables)
+
+    def test_jpeg_joint_symbols(self):
+        (size, group, restart, symbols) = (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP,
+                                           settings.JPEG_RESTART_INTERVAL, settings.SYMBOLS)
+        settings.JPEG_BLOCK_SIZE = 8
+        settings.JPEG_BLOCK_GROUP = 2
+        settings.SYMBOLS = model.Symbols.JOINT
+        try:
+            rng = np.random.RandomState(13)
+            lum = np.where(rng.rand(40, 56) < 0.7, 0, rng.randint(-3000, 3000, (40, 56)))
+            chroma = np.where(rng.rand(20, 28) < 0.7, 0, rng.randint(-20, 20, (20, 28)))
+            compressed = model.CompressedImage(lum, chroma, chroma * 2)
+            for interval in [0, 3]:
+                settings.JPEG_RESTART_INTERVAL = interval
+                hic_image = codec.jpeg_encode(compressed)
+                self.assertEqual([hic_image.payloads[i].payload for i in range(3, 6)], ["joint"] * 3)
+                self.assertEqual(len(hic_image.payloads), 6 + 1 + 4 * 3 + 2 + 1 + 3)
+                self.assertEqual(codec.jpeg_decode(hic_image), compressed)
+            (coefficients, (y, x)) = codec.jpeg_decode_region(hic_image, (20, 30, 10, 12))["lum"]
+            self.assertTrue(np.array_equal(coefficients, lum[y:y + coefficients.shape[0], x:x + coefficients.shape[1]]))
+        finally:
+            (settings.JPEG_BLOCK_SIZE, settings.JPEG_BLOCK_GROUP) = (size, group)
+            (settings.JPEG_RESTART_INTERVAL, settings.SYMBOLS) = (restart, symbols)
+
+    def test_joint_symbols(self):
+        lengths = np.array([0, 3, 14, 0, 2])
+        values = np.array([5, -1, 0, -70000, 0])
+        (symbols, (bits, sizes)) = codec.joint_symbols(lengths, values)
+        self.assertEqual(symbols.tolist(), [3, (3 << 5) | 1, 14 << 5, 17, 2 << 5])
+        self.assertEqual(sizes.tolist(), [3, 1, 0, 17, 0])
+        (out_lengths, out_values) = codec.invert_joint_symbols(symbols.tolist(), bits.tolist())
+        self.assertEqual(out_lengths.tolist(), lengths.tolist())
+        self.assertEqual(out_values.tolist(), values.tolist())
 
     def test_jpeg_inverse(self):
         settings.JPEG_BLOCK_SIZE = 2
@@ -128,7 +308,7 @@ class CodecTest(unittest.TestCase):
             [0, 0, 0, 0]
         ])
         lin = transform.zigzag(matrix)
-        out = codec.run_length_coding(lin)
+        out = codec.RunLength.from_arrays(*codec.run_length_coding(lin))
         self.assertEqual(out, [
             codec.RunLength(11, 3),
             codec.RunLength(0, 0)
@@ -140,9 +320,9 @@ class CodecTest(unittest.TestCase):
             [0, 0, 0, 0]
         ])
         lin = transform.zigzag(matrix)
-        out = codec.run_length_coding(lin)
-        invert = codec.decode_run_length(out, 8)
-        self.assertEqual(lin, invert)
+        lengths, values = codec.run_length_coding(lin)
+        invert = codec.decode_run_length(lengths, values, 8)
+        self.assertEqual(lin.tolist(), invert.tolist())
 
     def test_rle_segment(self):
         rle = codec.RunLength(10, 0)
@@ -153,49 +333,85 @@ class CodecTest(unittest.TestCase):
 
     def test_rle_max_len(self):
         arr = [0, 0, 0, 0, 0, 1]
-        rle = codec.run_length_coding(np.array(arr))
-        invert = codec.decode_run_length(rle, len(arr))
-        self.assertEqual(arr, invert)
+        lengths, values = codec.run_length_coding(np.array(arr))
+        invert = codec.decode_run_length(lengths, values, len(arr))
+        self.assertEqual(arr, invert.tolist())
 
     def test_rle_consecutives(self):
         arr = [0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0]
-        rle = codec.run_length_coding(np.array(arr))
-        invert = codec.decode_run_length(rle, len(arr))
-        self.assertEqual(invert, arr)
+        lengths, values = codec.run_length_coding(np.array(arr))
+        invert = codec.decode_run_length(lengths, values, len(arr))
+        self.assertEqual(invert.tolist(), arr)
 
     def test_rle_random(self):
         arr = [np.random.randint(-5, 5) for _ in range(10000)]
-        rle = codec.run_length_coding(np.array(arr))
-        invert = codec.decode_run_length(rle, 10000)
-        self.assertEqual(invert, arr)
+        lengths, values = codec.run_length_coding(np.array(arr))
+        invert = codec.decode_run_length(lengths, values, 10000)
+        self.assertEqual(invert.tolist(), arr)
 
     def test_rle_break_plus_1(self):
         arr = [0, 0, 0, 0, 0, 1]
-        rle = codec.run_length_coding(np.array(arr), max_len=4)
-        invert = codec.decode_run_length(rle, len(arr))
-        self.assertEqual(invert, arr)
+        lengths, values = codec.run_length_coding(np.array(arr), max_len=4)
+        invert = codec.decode_run_length(lengths, values, len(arr))
+        self.assertEqual(invert.tolist(), arr)
 
     def test_rle_max_double(self):
         arr = [-1, 0, 0, 0, 0, 1, 2]
-        rle = codec.run_length_coding(np.array(arr), max_len=4)
-        invert = codec.decode_run_length(rle, len(arr))
-        self.assertEqual(arr, invert)
+        lengths, values = codec.run_length_coding(np.array(arr), max_len=4)
+        invert = codec.decode_run_length(lengths, values, len(arr))
+        self.assertEqual(arr, invert.tolist())
 
     def test_accidental_combine(self):
         rle = [
             codec.RunLength(value=0, length=14),
             codec.RunLength(value=31, length=0)
         ]
-        invert = codec.decode_run_length(rle, 15)
-        rle_2 = codec.run_length_coding(invert, max_len=0xF)
+        invert = codec.decode_run_length([r.length for r in rle], [r.value for r in rle], 15)
+        rle_2 = codec.RunLength.from_arrays(*codec.run_length_coding(invert, max_len=0xF))
         self.assertEqual(rle, rle_2)
 
-    def test_subband_shapes(self):
-        out = codec.wavelet_decoded_subbands_shapes((64, 64), (256, 256))
-        self.assertEqual([(64, 64), (128, 128), (256, 256)], out)
+    def test_rle_arrays(self):
+        arr = np.array([0, 3, 0, 0, -2, 0, 0, 0], dtype=np.int32)
+        lengths, values = codec.run_length_coding(arr)
+        self.assertEqual(lengths.tolist(), [1, 2, 0])
+        self.assertEqual(values.tolist(), [3, -2, 0])
+        self.assertEqual(values.dtype, np.int32)
+
+    def test_rle_long_runs_in_bulk(self):
+        arr = np.zeros(100, dtype=np.int32)
+        arr[[40, 41, 99]] = [1, 2, 3]
+        lengths, values = codec.run_length_coding(arr, max_len=16)
+        self.assertTrue(np.all(lengths < 16))
+        self.assertTrue(np.array_equal(arr, codec.decode_run_length(lengths, values, 100)))
+
+    def test_decode_run_length_into_buffer(self):
+        buffer = np.full(8, 7, dtype=np.int32)
+        out = codec.decode_run_length(np.array([1, 2, 0]), np.array([3, -2, 0]), 8, out=buffer)
+        self.assertIs(out, buffer)
+        self.assertEqual(buffer.tolist(), [0, 3, 0, 0, -2, 0, 0, 0])
 
-    def test_pull_subbands(self):
-        expected = [
+    def test_wavelet_inverse_tiles(self):
+        tiling = model.Tiling((13, 20), (8, 8))
+        channels = {}
+        for k in ["lum", "cr", "cb"]:
+            channels[k] = []
+            for shape in tiling.tile_shapes:
+                sub = transform.wavelet_split_resolutions(np.random.randint(-50, 50, shape), model.Wavelet.HAAR, 2)
+                channels[k].append([np.round(s).astype(np.int32) for s in sub])
+        coding = model.WaveletCoding(model.Wavelet.HAAR, 2)
+        compressed = model.CompressedImage.from_dict(channels, tiling=tiling, coding=coding)
+        inverse = codec.wavelet_decode(codec.wavelet_encode(compressed))
+
+        self.assertEqual(tiling, inverse.tiling)
+        self.assertEqual(coding, inverse.coding)
+        for k in ["lum", "cr", "cb"]:
+            for (tile, inverse_tile) in zip(channels[k], inverse.as_dict[k]):
+                self.assertEqual(len(tile), len(inverse_tile))
+                for (s, i) in zip(tile, inverse_tile):
+                    self.assertTrue(np.array_equal(s, i))
+
+    def test_wavelet_groups(self):
+        subbands = [
             np.array(range(4)).reshape((2, 2)),
             np.array(range(4, 8)).reshape((2, 2)),
             np.array(range(8, 12)).reshape((2, 2)),
@@ -205,10 +421,68 @@ class CodecTest(unittest.TestCase):
             np.array(range(32, 48)).reshape((4, 4)),
             np.array(range(48, 64)).reshape((4, 4))
         ]
-        data = np.array(utils.flatten([transform.zigzag(m) for m in expected]))
-        shapes = [(2, 2), (4, 4)]
-        out = codec.wavelet_decode_pull_subbands(data, shapes)
-        self.assertEqual(len(expected), len(out))
-        z = zip(expected, out)
-        for e in z:
-            self.assertTrue(np.array_equal(e[0], e[1]))
+        groups = codec.wavelet_groups(subbands)
+        self.assertEqual([len(g) for g in groups], [1, 3, 3])
+        self.assertIs(groups[0][0], subbands[0])
+        self.assertIs(groups[2][2], subbands[6])
+
+    def test_wavelet_tile_levels(self):
+        subbands = [np.array(range(4)).reshape((2, 2))] + \
+                   [np.full((2, 2), i) for i in range(1, 4)] + \
+                   [np.full((4, 4), i) for i in range(4, 7)]
+        payloads = codec.wavelet_encode_tile(subbands)
+        self.assertEqual(len(payloads), 2 + 2 * 3)
+
+        for (n, expected) in [(8, 7), (6, 4), (4, 1)]:
+            out = codec.wavelet_decode_tile(payloads[:n], (8, 8), model.WaveletCoding(model.Wavelet.HAAR, 2))
+            self.assertEqual(len(out), expected)
+            for (s, o) in zip(subbands, out):
+                self.assertTrue(np.array_equal(s, o))
+
+    def test_wavelet_tile_joint_symbols(self):
+        rng = np.random.RandomState(9)
+        subbands = [np.where(rng.rand(*s) < 0.5, 0, rng.randint(-99, 99, s)) for s in [(2, 2)] * 4 + [(4, 4)] * 3]
+        (restart, symbols) = (settings.WAVELET_RESTART_INTERVAL, settings.SYMBOLS)
+        settings.SYMBOLS = model.Symbols.JOINT
+        try:
+            for interval in [0, 5]:
+                settings.WAVELET_RESTART_INTERVAL = interval
+                payloads = codec.wavelet_encode_tile(subbands)
+                self.assertEqual(len(payloads), 1 + 3)
+                out = codec.wavelet_decode_tile(payloads, (8, 8), model.WaveletCoding(model.Wavelet.HAAR, 2),
+                                                interval, model.Symbols.JOINT)
+                for (s, o) in zip(subbands, out):
+                    self.assertTrue(np.array_equal(s, o))
+        finally:
+            (settings.WAVELET_RESTART_INTERVAL, settings.SYMBOLS) = (restart, symbols)
+
+    def test_wavelet_tile_rans(self):
+        rng = np.random.RandomState(4)
+        subbands = [np.where(rng.rand(*s) < 0.5, 0, rng.randint(-99, 99, s)) for s in [(2, 2)] * 4 + [(4, 4)] * 3]
+        (restart, symbols, entropy) = (settings.WAVELET_RESTART_INTERVAL, settings.SYMBOLS, settings.ENTROPY)
+        settings.ENTROPY = model.Entropy.RANS
+        try:
+            for (settings.SYMBOLS, settings.WAVELET_RESTART_INTERVAL) in itertools.product(model.Symbols, [0, 5]):
+                payloads = codec.wavelet_encode_tile(subbands)
+                out = codec.wavelet_decode_tile(payloads, (8, 8), model.WaveletCoding(model.Wavelet.HAAR, 2),
+                                                settings.WAVELET_RESTART_INTERVAL, settings.SYMBOLS, model.Entropy.RANS)
+                for (s, o) in zip(subbands, out):
+                    self.assertTrue(np.array_equal(s, o))
+        finally:
+            (settings.WAVELET_RESTART_INTERVAL, settings.SYMBOLS, settings.ENTROPY) = (restart, symbols, entropy)
+
+    def test_wavelet_tile_restarts(self):
+        rng = np.random.RandomState(7)
+        subbands = [np.where(rng.rand(*s) < 0.5, 0, rng.randint(-9, 9, s)) for s in [(2, 2)] * 4 + [(4, 4)] * 3]
+        restart = settings.WAVELET_RESTART_INTERVAL
+        settings.WAVELET_RESTART_INTERVAL = 5
+        try:
+            payloads = codec.wavelet_encode_tile(subbands)
+            self.assertEqual([len(p) for p in payloads[2::2]], [1, 3, 10])
+            out = codec.wavelet_decode_tile(payloads, (8, 8), model.WaveletCoding(model.Wavelet.HAAR, 2), restart=5)
+            for (s, o) in zip(subbands, out):
+                self.assertTrue(np.array_equal(s, o))
+        finally:
+            settings.WAVELET_RESTART_INTERVAL = restart
+
+
@@ -1,8 +1,16 @@
+import os
+import tempfile
 import cv2
 import unittest
 
+import numpy as np
+
 import hiccup.compression as compression
 import hiccup.codec as codec
+import hiccup.hicimage as hic
+import hiccup.iohelper as io
+import hiccup.model as model
+import hiccup.settings as settings
 
 
 class HicImageTest(unittest.TestCase):
@@ -34,3 +42,87 @@ class HicImageTest(unittest.TestCase):
         loads = zip(h.payloads, retrieve.payloads)
         for (i, z) in enumerate(loads):
             self.assertEqual(z[0], z[1], msg="Case %d" % i)
+
+    def test_sections(self):
+        h = hic.HicImage.wavelet_image([
+            hic.PayloadStringP(hic.TupP, [hic.TupP(-3, 2), hic.TupP(2 ** 40, 1)]),
+            hic.BitStringP(io.Bits.from_string("10110")),
+            hic.TupP(16, 24),
+            hic.ArrayP(np.array([[0, 3, 70000], [-1, 2, 5]])),
+            hic.ArrayP(np.zeros((0, 3), dtype=np.int64)),
+            hic.SegmentsP.join([io.Bits.from_string(b) for b in ["101", "11110000", "0110011001"]])
+        ])
+        bites = h.byte_stream()
+        self.assertEqual(bites[:4], hic.MAGIC)
+        self.assertNotIn(b"pickle", bites)
+
+        retrieve = hic.HicImage.from_bytes(bites)
+        self.assertEqual(retrieve.hic_type, model.Compression.HIC)
+        self.assertEqual(h.payloads, retrieve.payloads)
+
+    def test_segments(self):
+        segments = [io.Bits.from_string(b) for b in ["101", "11110000", "0110011001", "1"]]
+        joined = hic.SegmentsP.join(segments)
+        self.assertEqual(joined.starts.tolist(), [0, 8, 16, 32])
+        self.assertEqual(joined.ends.tolist(), [3, 16, 26, 33])
+        self.assertEqual(segments, [joined.segment(i) for i in range(len(joined))])
+
+    def test_file(self):
+        h = hic.HicImage.jpeg_image([hic.TupP(1, 2), hic.BitStringP(io.Bits.from_string("1"))])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.hic")
+            h.write_file(path)
+            retrieve = hic.HicImage.from_file(path)
+        self.assertEqual(retrieve.hic_type, model.Compression.JPEG)
+        self.assertEqual(h.payloads, retrieve.payloads)
+
+    def test_not_hic(self):
+        self.assertRaises(RuntimeError, hic.HicImage.from_bytes, b"\x80\x04not a hic file at all")
+
+    def test_lazy_sections(self):
+        h = hic.HicImage.wavelet_image([
+            hic.PayloadStringP(hic.TupP, [hic.TupP(-3, 2)]),
+            hic.BitStringP(io.Bits.from_string("10110")),
+            hic.TupP(16, 24)
+        ])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.hic")
+            h.write_file(path)
+            with hic.HicImage.from_file(path) as retrieve:
+                payloads = retrieve.payloads
+                self.assertEqual(3, len(payloads))
+                self.assertEqual(hic.BitStringP, payloads.kind(1))
+                self.assertEqual(hic.TupP(16, 24), payloads[-1])
+                self.assertEqual([2], list(payloads._decoded.keys()))
+                self.assertEqual(h.payloads[:2], payloads[:2])
+
+    def test_progressive_prefix(self):
+        rgb = cv2.imread("resources/gh.png")
+        h = codec.wavelet_encode(compression.wavelet_compression(rgb))
+        retrieve = hic.HicImage.from_bytes(h.byte_stream())
+        small = compression.wavelet_decompression(codec.wavelet_decode(retrieve, max_level=2))
+        self.assertEqual(small.shape[:2], tuple([-(-n // 4) for n in rgb.shape[:2]]))
+
+        # everything we read sits before the finest two levels of every tile
+        tiles = len(model.Tiling(h.payloads[0].numbers, h.payloads[1].numbers))
+        unread = 2 * tiles * 2 * 3
+        self.assertEqual(max(retrieve.payloads._decoded.keys()), len(h.payloads) - unread - 1)
+
+    def test_lifting_quality(self):
+        # smooth with a little noise, like a photo
+        rng = np.random.RandomState(3)
+        rgb = cv2.resize(rng.randint(0, 256, (12, 16, 3)).astype(np.uint8), (128, 96), interpolation=cv2.INTER_CUBIC)
+        rgb = np.clip(rgb + rng.normal(0, 4, rgb.shape), 0, 255).astype(np.uint8)
+        wavelet = settings.WAVELET
+        errors = {}
+        try:
+            for settings.WAVELET in [model.Wavelet.DAUBECHIE, model.Wavelet.CDF_5_3, model.Wavelet.CDF_9_7]:
+                h = codec.wavelet_encode(compression.wavelet_compression(rgb))
+                out = compression.wavelet_decompression(codec.wavelet_decode(h))
+                errors[settings.WAVELET] = (np.mean(np.square(out - rgb.astype(float))), len(h.byte_stream()))
+        finally:
+            settings.WAVELET = wavelet
+        # no worse and no bigger than db1, with the same quantization settings
+        for w in [model.Wavelet.CDF_5_3, model.Wavelet.CDF_9_7]:
+            self.assertLessEqual(errors[w][0], errors[model.Wavelet.DAUBECHIE][0])
+            self.assertLessEqual(errors[w][1], errors[model.Wavelet.DAUBECHIE][1])
@@ -1,7 +1,11 @@
+import itertools
 import random
 import unittest
 
+import numpy as np
+
 import hiccup.huffman as huffman
+import hiccup.model as model
 import hiccup.settings as settings
 
 settings.DEBUG = False
@@ -12,7 +16,7 @@ class HuffmanTest(unittest.TestCase):
         data = [0, 0, 0, 0, 0]
         tree = huffman.HuffmanTree.construct_from_data(data)
         self.assertEqual(len(tree.leaves), 1)
-        self.assertEqual(tree.encode_data(), "11111")
+        self.assertEqual(str(tree.encode_data()), "00000")
 
     def test_2_nodes(self):
         data = [0, 0, 0, 1]
@@ -52,7 +56,7 @@ class HuffmanTest(unittest.TestCase):
         data = [1, 2, 2, 3, 3, 3, 4, 4, 4, 4]
         tree = huffman.HuffmanTree.construct_from_data(data)
         out = tree.encode_data()
-        self.assertEqual(out, "001" + ("000" * 2) + ("01" * 3) + ("1" * 4))
+        self.assertEqual(str(out), "110" + ("111" * 2) + ("10" * 3) + ("0" * 4))
 
         inverse = tree.decode_data(out)
         self.assertEqual(data, inverse)
@@ -82,7 +86,7 @@ class HuffmanTest(unittest.TestCase):
         data = [1, 2, 2, 3, 3, 3, 4, 4, 4, 4]
         tree = huffman.HuffmanTree.construct_from_data(data)
         out = tree.encode_data(data=[4, 4, 4, 4])
-        self.assertEqual(out, "1111")
+        self.assertEqual(str(out), "0000")
 
     def test_encode_same_freq(self):
         data = [0, 0, 1, 1]
@@ -101,7 +105,7 @@ class HuffmanTest(unittest.TestCase):
             ("B", "01"),
             ("C", "00")
         ])
-        self.assertEqual(tree.encode_data("ABC"), "10100")
+        self.assertEqual(str(tree.encode_data("ABC")), "01011")
 
     def test_reconstruct_ya_simple(self):
         data = [1, 1, 1, 1, 2, 2, 2, 3]
@@ -109,3 +113,96 @@ class HuffmanTest(unittest.TestCase):
         enc = t.encode_table()
         tt = huffman.HuffmanTree.construct_from_coding(enc)
         self.assertEqual(t.encode_data(data=data), tt.encode_data(data=data))
+
+    def test_canonical_table(self):
+        data = [1, 2, 2, 3, 3, 3, 4, 4, 4, 4]
+        tree = huffman.HuffmanTree.construct_from_data(data)
+        self.assertEqual(tree.encode_table(), [(4, 1), (3, 2), (1, 3), (2, 3)])
+        self.assertEqual(tree.codes, {
+            4: (0b0, 1),
+            3: (0b10, 2),
+            1: (0b110, 3),
+            2: (0b111, 3)
+        })
+
+    def test_reconstruct_from_lengths(self):
+        data = [random.randint(-50, 50) for _ in range(1000)]
+        tree = huffman.HuffmanTree.construct_from_data(data)
+        new_tree = huffman.HuffmanTree.construct_from_coding(tree.encode_table())
+        self.assertEqual(tree.codes, new_tree.codes)
+        self.assertEqual(len(tree.leaves), len(new_tree.leaves))
+
+    def test_decode_long_codes(self):
+        # fibonacci frequencies give the deepest possible tree
+        fib = [1, 1]
+        while len(fib) < 20:
+            fib.append(fib[-1] + fib[-2])
+        data = [v for (v, f) in enumerate(fib) for _ in range(f)]
+        random.shuffle(data)
+        tree = huffman.HuffmanTree.construct_from_data(data)
+        self.assertTrue(max([t[1] for t in tree.encode_table()]) > tree.PEEK_BITS)
+
+        out = tree.encode_data()
+        new_tree = huffman.HuffmanTree.construct_from_coding(tree.encode_table())
+        self.assertEqual(data, new_tree.decode_data(out))
+
+    def test_decode_small_peek(self):
+        data = [random.randint(0, 40) for _ in range(2000)]
+        tree = huffman.HuffmanTree.construct_from_data(data)
+        tree.PEEK_BITS = 2
+        self.assertEqual(data, tree.decode_data(tree.encode_data()))
+
+    def test_decode_range(self):
+        data = [random.randint(0, 40) for _ in range(500)]
+        tree = huffman.HuffmanTree.construct_from_data(data)
+        bits = tree.encode_data()
+        ends = [0] + list(itertools.accumulate(tree.code_lengths(data)))
+        self.assertEqual(ends[-1], len(bits))
+        self.assertEqual(data[100:250], tree.decode_data(bits, ends[100], ends[250]))
+        self.assertEqual(data[499:], tree.decode_data(bits, ends[499]))
+
+    def test_standard_tables(self):
+        dc = huffman.HuffmanTree.standard(model.HTables.JPEG_DC_LUMINANCE)
+        ac = huffman.HuffmanTree.standard(model.HTables.JPEG_AC_LUMINANCE)
+        self.assertIs(dc, huffman.HuffmanTree.standard(model.HTables.JPEG_DC_LUMINANCE))
+        # straight out of Annex K
+        self.assertEqual(dc.codes[0], (0b00, 2))
+        self.assertEqual(dc.codes[11], (0b111111110, 9))
+        self.assertEqual(ac.codes[0x00], (0b1010, 4))
+        self.assertEqual(ac.codes[0xF0], (0b11111111001, 11))
+        self.assertEqual(ac.codes[0x01], (0b00, 2))
+        self.assertEqual(ac.codes[0xFA], (0b1111111111111110, 16))
+
+    def test_extra_bits(self):
+        tree = huffman.HuffmanTree.standard(model.HTables.JPEG_DC_CHROMINANCE)
+        sizes = np.array([3, 0, 11, 1, 5])
+        raw = np.array([5, 0, 2000, 1, 17])
+        bits = tree.encode_data(sizes, extra=(raw, sizes))
+        self.assertEqual(len(bits), int(tree.code_lengths(sizes).sum() + sizes.sum()))
+        self.assertEqual((sizes.tolist(), raw.tolist()), tree.decode_data(bits, extra=list(range(12))))
+
+    def test_package_merge(self):
+        lengths = huffman.HuffmanTree._package_merge([1, 1, 2, 4, 8, 16], 3)
+        self.assertEqual(max(lengths), 3)
+        self.assertEqual(sum([2 ** -l for l in lengths]), 1)
+        # unconstrained this is just Huffman
+        self.assertEqual(sorted(huffman.HuffmanTree._package_merge([1, 1, 2, 4, 8, 16], 5)), [1, 2, 3, 4, 5, 5])
+
+    def test_max_length(self):
+        fib = [1, 1]
+        while len(fib) < 20:
+            fib.append(fib[-1] + fib[-2])
+        data = [v for (v, f) in enumerate(fib) for _ in range(f)]
+        tree = huffman.HuffmanTree.construct_from_data(data, max_length=8)
+        self.assertEqual(max([t[1] for t in tree.encode_table()]), 8)
+
+        new_tree = huffman.HuffmanTree.construct_from_coding(tree.encode_table())
+        self.assertEqual(data, new_tree.decode_data(tree.encode_data()))
+
+    def test_max_length_unnecessary(self):
+        data = [1, 2, 2, 3, 3, 3, 4, 4, 4, 4]
+        tree = huffman.HuffmanTree.construct_from_data(data, max_length=16)
+        self.assertEqual(tree.encode_table(), [(4, 1), (3, 2), (1, 3), (2, 3)])
+
+    def test_max_length_too_small(self):
+        self.assertRaises(RuntimeError, huffman.HuffmanTree.construct_from_data, [0, 1, 2, 3, 4], max_length=2)
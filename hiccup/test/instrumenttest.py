@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+import hiccup.codec as codec
+import hiccup.instrument as instrument
+
+
+@instrument.timed("outer")
+def outer():
+    with instrument.span("inner"):
+        instrument.count("things", 2)
+    with instrument.span("inner"):
+        instrument.count("things")
+    return 5
+
+
+class InstrumentTest(unittest.TestCase):
+    def test_nested_spans(self):
+        with instrument.Collector() as collector:
+            self.assertEqual(outer(), 5)
+        self.assertEqual(set(collector.spans.keys()), {("outer",), ("outer", "inner")})
+        self.assertEqual(collector.spans[("outer", "inner")][0], 2)
+        self.assertEqual(collector.counters, {"things": 3})
+        self.assertLessEqual(collector.self_time(("outer",)), collector.total("outer"))
+
+    def test_nothing_attached(self):
+        collector = instrument.Collector()
+        self.assertEqual(outer(), 5)
+        self.assertIs(instrument.span("inner"), instrument.span("other"))
+        self.assertEqual(collector.spans, {})
+
+    def test_collapsed(self):
+        collector = instrument.Collector()
+        collector.on_span(("a",), 0.003)
+        collector.on_span(("a", "b"), 0.001)
+        self.assertEqual(collector.collapsed(), "a 2000\na;b 1000")
+
+    def test_pipeline_counters(self):
+        with instrument.Collector() as collector:
+            codec.run_length_coding(np.array([0, 0, 3, 0, 0, 0]))
+        self.assertEqual(collector.counters["rle runs"], 2)
+        self.assertIn(("rle",), collector.spans)
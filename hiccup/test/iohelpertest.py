@@ -49,3 +49,55 @@ class IOHelperTest(unittest.TestCase):
     def test_long_bug(self):
         s = "00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000001"
         self._check_pb(s)
+
+    def test_bit_writer(self):
+        writer = io.BitWriter()
+        writer.write(0b101, 3)
+        writer.write(0b1, 1)
+        writer.write(0b0000000011, 10)
+        bits = writer.bits()
+        self.assertEqual(14, len(bits))
+        self.assertEqual("10110000000011", str(bits))
+        self.assertEqual(b'\xb0\x0c', bits.data)
+
+    def test_bit_writer_codes(self):
+        codes = [random.randint(0, 2 ** 16 - 1) for _ in range(5000)]
+        lengths = [max(1, c.bit_length()) for c in codes]
+        one = io.BitWriter()
+        one.write(0b11, 2)
+        for (c, l) in zip(codes, lengths):
+            one.write(c, l)
+        vectorized = io.BitWriter()
+        vectorized.write(0b11, 2)
+        vectorized.write_codes(codes, lengths)
+        self.assertEqual(one.bits(), vectorized.bits())
+
+    def test_bit_reader(self):
+        codes = [random.randint(0, 2 ** 20 - 1) for _ in range(1000)]
+        writer = io.BitWriter()
+        for c in codes:
+            writer.write(c, 20)
+        reader = io.BitReader(writer.bits())
+        self.assertEqual(codes[0] >> 10, reader.peek(10))
+        self.assertEqual(codes, [reader.read(20) for _ in codes])
+        self.assertEqual(0, reader.remaining)
+
+    def test_bit_reader_start(self):
+        bits = io.Bits.from_string("1011001110001111")
+        for start in range(16):
+            reader = io.BitReader(bits, start=start)
+            self.assertEqual(start, reader.position)
+            self.assertEqual(int(str(bits)[start:], 2), reader.read(16 - start))
+
+    def test_read_codes(self):
+        writer = io.BitWriter()
+        writer.write(5, 3)
+        lengths = [random.randint(0, 31) for _ in range(200)]
+        codes = [random.getrandbits(n) if n > 0 else 0 for n in lengths]
+        writer.write_codes(codes, lengths)
+        self.assertEqual(codes, io.read_codes(writer.bits(), 3, lengths).tolist())
+
+    def test_bits_padded_bytes(self):
+        bits = io.Bits.from_string("1011")
+        self.assertEqual(b'\x04\xb0', bits.padded_bytes())
+        self.assertEqual(bits, io.Bits.from_padded_bytes(memoryview(bits.padded_bytes())))
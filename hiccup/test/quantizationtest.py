@@ -40,4 +40,8 @@ class QuantizationTest(unittest.TestCase):
             [0, 0],
             [0, 1],
             [1, 10]
-        ])))
\ No newline at end of file
+        ])))
+    def test_quality_threshold_unsorted(self):
+        vals = np.random.permutation(1000) - 500
+        out = qnt.quality_threshold_value(vals, q_factor=.1)
+        self.assertEqual(out, sorted(vals)[900])
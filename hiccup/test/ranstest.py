@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+
+import hiccup.iohelper as io
+import hiccup.rans as rans
+import hiccup.settings as settings
+
+settings.DEBUG = False
+
+
+class RansTest(unittest.TestCase):
+    def _round_trip(self, data):
+        coder = rans.RansModel.construct_from_data(data)
+        bits = coder.encode_data()
+        decoder = rans.RansModel.construct_from_coding(coder.encode_table())
+        self.assertEqual(decoder.decode_data(bits), data.tolist())
+        return bits
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(1)
+        for n in [0, 1, 7, 1000]:
+            self._round_trip(np.where(rng.rand(n) < 0.8, 0, rng.randint(-50, 50, n)))
+        self._round_trip(np.zeros(100, dtype=np.int64))
+
+    def test_lanes(self):
+        rng = np.random.RandomState(2)
+        n = rans.LANE_SYMBOLS * rans.MIN_LANES + 5
+        self.assertEqual(rans.lane_count(n), rans.MIN_LANES)
+        self.assertEqual(rans.lane_count(n - 10), 1)
+        bits = self._round_trip(np.where(rng.rand(n) < 0.9, 0, rng.randint(-9, 9, n)))
+        # far less than the two or so bits a Huffman code would need for this
+        self.assertLess(len(bits), 1.1 * n)
+
+    def test_extra_bits(self):
+        data = np.array([3, 0, 11, 1, 5, 3])
+        raw = np.array([5, 0, 2000, 1, 17, 7])
+        coder = rans.RansModel.construct_from_data(data)
+        bits = coder.encode_data(extra=(raw, data))
+        self.assertEqual((data.tolist(), raw.tolist()), coder.decode_data(bits, extra=list(range(12))))
+
+    def test_segment(self):
+        writer = io.BitWriter()
+        writer.write(3, 8)
+        data = np.array([1, 2, 2, 2, 1, 4])
+        coder = rans.RansModel.construct_from_data(data)
+        bits = coder.encode_data()
+        writer.write_codes(np.frombuffer(bits.data, dtype=np.uint8), [8] * len(bits.data))
+        self.assertEqual(coder.decode_data(writer.bits(), start=8), data.tolist())
+
+    def test_corrupt(self):
+        data = np.array([0, 0, 0, 1, 0, 2] * 50)
+        coder = rans.RansModel.construct_from_data(data)
+        bits = coder.encode_data()
+        with self.assertRaises(RuntimeError):
+            coder.decode_data(io.Bits(bits.data[:len(bits.data) // 2], len(bits) // 2))
+        with self.assertRaises(RuntimeError):
+            rans.RansModel.construct_from_coding([(0, 3), (1, 2)])
+
+    def test_normalize_frequencies(self):
+        frequencies = rans.normalize_frequencies(np.array([1000000, 1, 1, 3]), 8)
+        self.assertEqual(frequencies.sum(), 256)
+        self.assertEqual(frequencies[1:].tolist(), [1, 1, 1])
+        with self.assertRaises(RuntimeError):
+            rans.normalize_frequencies(np.ones(300), 8)
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+
+import hiccup.model as model
+import hiccup.run as run
+
+
+class RunTest(unittest.TestCase):
+    def test_batch_round_trip(self):
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copy("resources/gh.png", d)
+            (results, failures) = run.batch(d, d, model.Compression.HIC, workers=1)
+            self.assertEqual(failures, {})
+            self.assertEqual(list(results.keys()), [os.path.join(d, "gh.png")])
+            hic_path = os.path.join(d, run.img_name("gh.png", model.Compression.HIC))
+            self.assertTrue(os.path.exists(hic_path))
+
+            (results, failures) = run.batch(os.path.join(d, "*-hic"), d, model.Compression.HIC, workers=1)
+            self.assertEqual(failures, {})
+            out = cv2.imread(hic_path + ".png")
+            self.assertEqual(out.shape, cv2.imread("resources/gh.png").shape)
+
+    def test_batch_report(self):
+        report = run.batch_report({"a.png": (2000000, 10, 0.5)}, {"b.png": RuntimeError("nope")}, 2.0)
+        self.assertIn("b.png", report)
+        self.assertIn("failed: nope", report)
+        self.assertIn("1 images in 2.000s, 0.50 images/s, 1.00 MB/s read", report)
@@ -0,0 +1,60 @@
+import unittest
+
+import cv2
+import numpy as np
+
+import hiccup.compression as compression
+import hiccup.model as model
+import hiccup.codec as codec
+import hiccup.scheduler as scheduler
+import hiccup.settings as settings
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_same_file_as_serial(self):
+        rgb = cv2.imread("resources/gh.png")
+        tiles = settings.WAVELET_TILES
+        settings.WAVELET_TILES = 2
+        try:
+            serial = codec.wavelet_encode(compression.wavelet_compression(rgb))
+            scheduled = scheduler.wavelet_encode_image(rgb, workers=2)
+            self.assertEqual(scheduled.byte_stream(), serial.byte_stream())
+
+            out = scheduler.wavelet_decode_image(scheduled, workers=2)
+            self.assertTrue(np.array_equal(out, compression.wavelet_decompression(codec.wavelet_decode(serial))))
+        finally:
+            settings.WAVELET_TILES = tiles
+
+    def test_shared_channels(self):
+        with scheduler.SharedChannels((3, 4)) as shared:
+            shared.channel("cr")[:] = 7
+            attached = scheduler.SharedChannels((3, 4), name=shared.name)
+            self.assertTrue(np.all(attached.channel("cr") == 7))
+            self.assertTrue(np.all(attached.channel("lum") == shared.channel("lum")))
+            attached.close()
+
+    def test_lossless(self):
+        rgb = cv2.imread("resources/gh.png")
+        (tiles, wavelet, levels) = (settings.WAVELET_TILES, settings.WAVELET, settings.WAVELET_NUM_LEVELS)
+        lossless = settings.WAVELET_LOSSLESS
+        settings.WAVELET_TILES = 2
+        settings.WAVELET = model.Wavelet.CDF_5_3
+        settings.WAVELET_NUM_LEVELS = 2
+        settings.WAVELET_LOSSLESS = True
+        try:
+            serial = codec.wavelet_encode(compression.wavelet_compression(rgb))
+            scheduled = scheduler.wavelet_encode_image(rgb, workers=2)
+            self.assertEqual(scheduled.byte_stream(), serial.byte_stream())
+
+            # the file says how to decode it, whatever the settings are by then
+            (settings.WAVELET, settings.WAVELET_NUM_LEVELS, settings.WAVELET_LOSSLESS) = (wavelet, levels, lossless)
+            self.assertTrue(np.array_equal(rgb, compression.wavelet_decompression(codec.wavelet_decode(serial))))
+            self.assertTrue(np.array_equal(rgb, scheduler.wavelet_decode_image(serial, workers=2)))
+            small = compression.wavelet_decompression(codec.wavelet_decode(serial, max_level=1))
+            self.assertEqual(small.shape[:2], tuple(-(-np.array(rgb.shape[:2]) // 2)))
+
+            (settings.WAVELET, settings.WAVELET_LOSSLESS) = (model.Wavelet.HAAR, True)
+            self.assertRaises(RuntimeError, compression.wavelet_compression, rgb)
+        finally:
+            (settings.WAVELET_TILES, settings.WAVELET, settings.WAVELET_NUM_LEVELS) = (tiles, wavelet, levels)
+            settings.WAVELET_LOSSLESS = lossless
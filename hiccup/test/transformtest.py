@@ -279,3 +279,84 @@ class TransformTest(unittest.TestCase):
         ]
         for (i, ele) in enumerate(l):
             self.assertTrue(np.array_equiv(ele, out[i]))
+
+    def test_zigzag_rect(self):
+        matrix = np.array([
+            [1, 2, 6],
+            [3, 5, 7],
+            [4, 8, 9],
+            [10, 11, 12]
+        ])
+        self.assertEqual(trans.zigzag(matrix).tolist(), [1, 3, 2, 6, 5, 4, 10, 8, 7, 9, 11, 12])
+
+    def test_zigzag_stack(self):
+        blocks = np.random.randint(0, 256, (5, 8, 8))
+        ziggy = trans.zigzag(blocks)
+        self.assertEqual((5, 64), ziggy.shape)
+        for (b, z) in zip(blocks, ziggy):
+            self.assertTrue(np.array_equal(trans.zigzag(b), z))
+        self.assertTrue(np.array_equal(blocks, trans.izigzag(ziggy, (8, 8))))
+
+    def test_dct_stack(self):
+        blocks = np.random.randint(-128, 128, (6, 8, 8))
+        stacked = trans.dct2(blocks)
+        for (b, d) in zip(blocks, stacked):
+            self.assertTrue(np.allclose(trans.dct2(b), d))
+        self.assertTrue(np.allclose(blocks, trans.idct2(stacked)))
+
+    def test_merge_blocks_out(self):
+        matrix = np.random.randint(0, 256, (9, 13))
+        blocks = trans.split_matrix(matrix, 4)
+        out = np.empty(matrix.shape, dtype=np.int64)
+        merged = trans.merge_blocks(blocks, matrix.shape, out=out)
+        self.assertIs(merged, out)
+        self.assertTrue(np.array_equal(matrix, out))
+
+    def test_threshold_negatives(self):
+        arr = np.array([[-3, 1], [-1, 4]])
+        out = trans.threshold(arr, 2)
+        self.assertTrue(np.array_equal(out, np.array([[-3, 0], [0, 4]])))
+
+    def test_threshold_by_quality_keep_all(self):
+        i = [np.array([[-5, 0], [3, 1]]), np.array([[2, -7]])]
+        out = trans.threshold_channel_by_quality(i, q_factor=1)
+        for (a, b) in zip(i, out):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_wavelet_subband_shapes(self):
+        out = trans.wavelet_subband_shapes((512, 512), model.Wavelet.HAAR, levels=3)
+        self.assertEqual([(64, 64), (128, 128), (256, 256)], out)
+        out = trans.wavelet_subband_shapes((37, 50), model.Wavelet.DAUBECHIE, levels=3)
+        pyr = trans.wavelet_split_resolutions(np.zeros((37, 50)), model.Wavelet.DAUBECHIE, levels=3)
+        self.assertEqual([p.shape for p in pyr[1::3]], out)
+
+    def test_lifting_5_3_reversible(self):
+        for shape in [(16, 16), (37, 50), (5, 3)]:
+            matrix = np.random.randint(-256, 0, shape)
+            pyr = trans.wavelet_split_resolutions(matrix, model.Wavelet.CDF_5_3, levels=3)
+            self.assertTrue(all([p.dtype == np.int32 for p in pyr]))
+            merged = trans.wavelet_merge_resolutions(pyr, model.Wavelet.CDF_5_3)
+            self.assertTrue(np.array_equal(matrix, merged[:shape[0], :shape[1]]))
+
+    def test_lifting_9_7_inverse(self):
+        matrix = np.random.randint(-256, 0, (37, 50))
+        pyr = trans.wavelet_split_resolutions(matrix, model.Wavelet.CDF_9_7, levels=3)
+        merged = trans.wavelet_merge_resolutions(pyr, model.Wavelet.CDF_9_7)
+        self.assertTrue(np.allclose(matrix, merged[:37, :50], atol=1e-2))
+
+    def test_lifting_subbands(self):
+        for wavelet in [model.Wavelet.CDF_5_3, model.Wavelet.CDF_9_7]:
+            pyr = trans.wavelet_split_resolutions(np.full((37, 50), 7), wavelet, levels=3)
+            out = trans.wavelet_subband_shapes((37, 50), wavelet, levels=3)
+            self.assertEqual([p.shape for p in pyr[1::3]], out)
+            self.assertEqual(pyr[0].shape, out[0])
+            # every subband is a view of the one buffer we lifted in place
+            self.assertTrue(all([p.base is pyr[0].base is not None for p in pyr[1:]]))
+            self.assertTrue(np.allclose(pyr[0], 7 * trans.wavelet_approximation_gain(wavelet) ** 3))
+            self.assertTrue(all([np.allclose(p, 0, atol=1e-4) for p in pyr[1:]]))
+
+    def test_reversible_color(self):
+        rgb = np.random.randint(0, 256, (7, 9, 3)).astype(np.uint8)
+        gcrcb = trans.reversible_color(rgb)
+        self.assertEqual(gcrcb.dtype, np.uint8)
+        self.assertTrue(np.array_equal(rgb, trans.inverse_reversible_color(gcrcb)))
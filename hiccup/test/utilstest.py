@@ -1,10 +1,25 @@
+import os
 import random
 import unittest
 import hiccup.utils as utils
+import hiccup.settings as settings
 
 import numpy as np
 
 
+def scaled_by_setting(k, v):
+    return v * settings.WAVELET_TILES
+
+
+def pid(k, v):
+    return os.getpid()
+
+
+def nested_pids(k, v):
+    inner = utils.channel_map({"lum": 1, "cr": 2}, pid, workers=2, executor="process")
+    return os.getpid(), set(inner.values())
+
+
 class UtilsTest(unittest.TestCase):
     def test_grouping(self):
         out = utils.group_tuples([1, 2, 3, 4], 2)
@@ -100,4 +115,27 @@ class UtilsTest(unittest.TestCase):
     def test_size(self):
         self.assertEqual(utils.size(np.array([
             [1, 2]
-        ]).shape), 2)
\ No newline at end of file
+        ]).shape), 2)
+    def test_channel_map(self):
+        d = {"lum": 1, "cr": 2, "cb": 3}
+        for executor in ["thread", "process"]:
+            self.assertEqual(utils.channel_map(d, lambda k, v: k * v, workers=1, executor=executor),
+                             {"lum": "lum", "cr": "crcr", "cb": "cbcbcb"})
+        self.assertEqual(utils.channel_map(d, lambda k, v: k * v, workers=3, executor="thread"),
+                         {"lum": "lum", "cr": "crcr", "cb": "cbcbcb"})
+
+    def test_channel_map_processes_see_settings(self):
+        tiles = settings.WAVELET_TILES
+        settings.WAVELET_TILES = 5
+        try:
+            out = utils.channel_map({"lum": 1, "cr": 2}, scaled_by_setting, workers=2, executor="process")
+        finally:
+            settings.WAVELET_TILES = tiles
+        self.assertEqual(out, {"lum": 5, "cr": 10})
+
+    def test_channel_map_no_nested_processes(self):
+        out = utils.channel_map({"lum": 1, "cr": 2}, nested_pids, workers=2, executor="process")
+        for (worker, inner) in out.values():
+            self.assertNotEqual(worker, os.getpid())
+            self.assertEqual(inner, {worker})
+        self.assertEqual(utils.process_workers(4), 4)
@@ -3,11 +3,13 @@ import functools
 import numpy as np
 import cv2
 import pywt
-import scipy.fftpack
+import scipy.fft
 
 import hiccup.model as model
 import hiccup.utils as utils
 import hiccup.quantization as qz
+import hiccup.settings as settings
+import hiccup.instrument as instrument
 
 """
 Helpful transformation functions from sampling the image, to applying dwt and dct 
@@ -42,110 +44,74 @@ def split_matrix(matrix, N):
     return form_blocks
 
 
-def merge_blocks(blocks: np.ndarray, shape):
+def merge_blocks(blocks: np.ndarray, shape, out: np.ndarray = None):
     """
-    After doing block level transformations, reconstruct a 2d matrix
+    After doing block level transformations, reconstruct a 2d matrix. This is just split_matrix() backwards, a reshape
+    and swap of the block axes and then a crop of any padding. If out is given we write in there instead
     """
-    y, x = shape
     num, N, _ = blocks.shape
-    if y * x != num * N * N:
-        # I must have done some padding
-        assert y * x < num * N * N  # otherwise we somehow dropped data
-        padded = pad_matrix(np.zeros(shape), N)
-        y, x = padded.shape
+    y = shape[0] + ((N - shape[0] % N) % N)
+    x = shape[1] + ((N - shape[1] % N) % N)
+    assert y * x == num * N * N  # otherwise we somehow dropped data
 
-    d4 = blocks.reshape(y // N, x // N, N, N)
-    block_mats = [
-        [np.matrix(d4[y][x]) for x in range(d4[y].shape[0])]
-        for y in range(d4.shape[0])
-    ]
-    out = np.array(np.bmat(block_mats))
-    sanitized = out[:shape[0], :shape[1]]
-    return sanitized
+    merged = blocks.reshape(y // N, x // N, N, N).swapaxes(1, 2).reshape(y, x)
+    sanitized = merged[:shape[0], :shape[1]]
+    if out is None:
+        return sanitized
+    out[...] = sanitized
+    return out
 
 
-def dct2(matrix: np.ndarray):
+def dct2(matrix: np.ndarray, workers=None):
     """
-    Computed dct type II
+    Computed dct type II over the last two axes, so a whole stack of blocks goes through in one call
 
-    Credits for dct2() comes from Mark Newman <mejn@umich.edu>
+    Same (unnormalized) scaling as the original row then column scipy.fftpack.dct from Mark Newman <mejn@umich.edu>
     """
+    return scipy.fft.dctn(matrix, type=2, axes=(-2, -1), workers=workers)
 
-    M = matrix.shape[0]
-    N = matrix.shape[1]
-    a = np.empty([M, N], float)
-    b = np.empty([M, N], float)
 
-    for i in range(M):
-        a[i, :] = scipy.fftpack.dct(matrix[i, :])
-    for j in range(N):
-        b[:, j] = scipy.fftpack.dct(a[:, j])
-
-    return b
-
-
-def idct2(matrix: np.ndarray):
+def idct2(matrix: np.ndarray, workers=None):
     """
-    Inverse dct type II
-
-    Credits for idct2() comes from Mark Newman <mejn@umich.edu>
+    Inverse dct type II over the last two axes, the normalization folds in the 1/256 we used to divide 8x8 blocks by
     """
-    M = matrix.shape[0]
-    N = matrix.shape[1]
-    a = np.empty([M, N], float)
-    y = np.empty([M, N], float)
-
-    for i in range(M):
-        a[i, :] = scipy.fftpack.idct(matrix[i, :])
-    for j in range(N):
-        y[:, j] = scipy.fftpack.idct(a[:, j])
+    return scipy.fft.idctn(matrix, type=2, axes=(-2, -1), workers=workers)
 
-    return np.divide(y, 256)
 
-
-def _zigzag_indices(matrix: np.ndarray):
+@functools.lru_cache(maxsize=None)
+def _zigzag_indices(shape: Tuple[int, int]) -> np.ndarray:
     """
-    Ok not the prettiest.. but I cannot figure how to do this the np-way
-
+    Flat (row major) indices of a matrix of this shape in zigzag order. Even diagonals run up the rows, odd ones come
+    back down. We see the same handful of shapes over and over (blocks, subbands) so remember them
     """
-    d = {}
-    for y, row in enumerate(matrix):
-        for x, ele in enumerate(row):
-            if x + y in d:
-                d[x + y].append((y, x))
-            else:
-                d[x + y] = [(y, x)]
-    combined = []
-    for i in range(len(d)):
-        if i % 2 == 0:
-            combined.append(d[i])
-        else:
-            combined.append(list(reversed(d[i])))
-    return functools.reduce(lambda a, b: a + b, combined)
+    rows, cols = np.indices(shape)
+    rows = rows.ravel()
+    diagonals = rows + cols.ravel()
+    along = np.where(diagonals % 2 == 0, rows, -rows)
+    indices = np.lexsort((along, diagonals))
+    indices.setflags(write=False)
+    return indices
 
 
 def zigzag(matrix: np.ndarray):
     """
     Linearize the 2d matrix into a 1d array by diagonals. This way, the bulk of 0 are clumped together at the end and
-    compress better with Huffman coding
+    compress better with Huffman coding. A stack of matrices is linearized matrix by matrix
 
     """
-    indices = _zigzag_indices(matrix)
-    result = list(map(lambda t: matrix[t[0]][t[1]], indices))
-    return result
+    matrix = np.asarray(matrix)
+    indices = _zigzag_indices(matrix.shape[-2:])
+    return matrix.reshape(matrix.shape[:-2] + (-1,))[..., indices]
 
 
 def izigzag(arr: np.ndarray, shape: Tuple[int, int]):
     """
-    Recreate our matrix from the diagonals
+    Recreate our matrix from the diagonals, or a stack of matrices from a stack of diagonals
     """
-    mat = np.zeros(shape)
-    indices = _zigzag_indices(mat)
-    zipped = zip(arr, indices)
-    for ele in zipped:
-        y, x = ele[1]
-        mat[y][x] = ele[0]
-    return mat
+    arr = np.asarray(arr)
+    mat = np.empty(arr.shape, dtype=arr.dtype)
+    mat[..., _zigzag_indices(tuple(shape))] = arr
+    return mat.reshape(arr.shape[:-1] + tuple(shape))
 
 
 def up_sample(matrix: np.ndarray, factor=2):
@@ -172,35 +138,215 @@ def inv_dct_channel(channel: np.ndarray, quantization_table: model.QTables, bloc
     """
 
     blocks = split_matrix(channel, block_size)
-    rev_q_blocks = [qz.invert_jpeg_quantize(b, quantization_table) for b in blocks]
-    rev_dct = [idct2(b) for b in rev_q_blocks]
-    merged = merge_blocks(np.array(rev_dct), channel.shape)
+    with instrument.span("quantize"):
+        rev_q_blocks = qz.invert_jpeg_quantize(blocks, quantization_table)
+    with instrument.span("transform"):
+        rev_dct = idct2(rev_q_blocks, workers=settings.FFT_WORKERS)
+    merged = merge_blocks(rev_dct, channel.shape)
     offset = np.add(merged, 128).astype(np.uint8)
     return offset
 
 
 def dct_channel(channel: np.ndarray, quantization_table: model.QTables, block_size=8):
     """
-    Apply the Discrete Cosine transform on a channel of our image to later be encoded
+    Apply the Discrete Cosine transform on a channel of our image to later be encoded. All of the blocks are
+    transformed and quantized as one (nblocks, N, N) stack
     """
     offset = channel.astype(np.int64) - 128
 
     blocks = split_matrix(offset, block_size)
-    transformed_blocks = [dct2(block) for block in blocks]
-    qnt_blocks = [qz.jpeg_quantize(block, quantization_table) for block in transformed_blocks]
-    quantized = np.array(qnt_blocks)
+    with instrument.span("transform"):
+        transformed_blocks = dct2(blocks, workers=settings.FFT_WORKERS)
+    with instrument.span("quantize"):
+        quantized = qz.jpeg_quantize(transformed_blocks, quantization_table)
     ret = merge_blocks(quantized, channel.shape)
     return ret
 
 
 def wavelet_split_resolutions(channel: np.ndarray, wavelet: model.Wavelet, levels=3):
     """
-    Simple wrapper to also flatten the array for convenience
+    Simple wrapper to also flatten the array for convenience. The lifting wavelets give views into their one buffer
     """
+    if wavelet in LIFTING:
+        buffer = lifting_buffer(channel, wavelet, levels)
+        lift(buffer, wavelet, levels)
+        return mallat_subbands(buffer, levels)
     cascade = pywt.wavedec2(channel, wavelet.value, level=levels)
     return linearize_subband(cascade)
 
 
+def wavelet_subband_shapes(shape, wavelet: model.Wavelet, levels=3):
+    """
+    Shape of the detail subbands at every level from coarsest to finest, the approximation is the same as the coarsest
+    """
+    if wavelet in LIFTING:
+        padded = lifting_shape(shape, levels)
+        return [(padded[0] >> l, padded[1] >> l) for l in range(levels, 0, -1)]
+    shapes = pywt.wavedecn_shapes(tuple(shape), wavelet.value, level=levels)
+    return [s["dd"] for s in shapes[1:]]
+
+
+def wavelet_approximation_gain(wavelet: model.Wavelet) -> int:
+    """
+    What a level of the 2d transform multiplies a flat approximation by. pywt's filters are orthonormal, the lifting
+    ones keep the approximation at the scale of the pixels
+    """
+    return 1 if wavelet in LIFTING else 2
+
+
+@functools.lru_cache(maxsize=None)
+def wavelet_subband_norms(wavelet: model.Wavelet, levels: int) -> tuple:
+    """
+    How big the pixels a unit coefficient of every subband (in wavelet_split_resolutions() order) turns into are, the
+    norm of its synthesis function. 1 everywhere for an orthonormal wavelet. We invert an impulse in the middle of every
+    subband of a buffer big enough for the edges not to matter, a big one so the 5/3 rounding doesn't either
+    """
+    if wavelet not in LIFTING:
+        return (1.0,) * (3 * levels + 1)
+    (side, impulse) = (16 << levels, 1 << 12)
+    norms = []
+    for i in range(3 * levels + 1):
+        buffer = np.zeros((side, side), dtype=LIFTING[wavelet])
+        band = mallat_subbands(buffer, levels)[i]
+        band[band.shape[0] // 2, band.shape[1] // 2] = impulse
+        unlift(buffer, wavelet, levels)
+        norms.append(float(np.sqrt(np.sum(np.square(buffer, dtype=np.float64)))) / impulse)
+    return tuple(norms)
+
+
+LIFTING = {model.Wavelet.CDF_5_3: np.int32, model.Wavelet.CDF_9_7: np.float32}  # and the buffer they lift in
+
+# JPEG 2000's irreversible 9/7 lifting steps, then what the low and high pass come out scaled by
+CDF_9_7_STEPS = [-1.586134342059924, -0.052980118572961, 0.882911075530934, 0.443506852043971]
+CDF_9_7_SCALE = 1.230174104914001
+
+
+def lifting_shape(shape, levels: int) -> tuple:
+    """
+    Every level halves both axes, so lift in a buffer that is a multiple of 2^levels
+    """
+    step = 1 << levels
+    return tuple([-(-n // step) * step for n in shape[:2]])
+
+
+def lifting_buffer(channel: np.ndarray, wavelet: model.Wavelet, levels: int) -> np.ndarray:
+    """
+    The one buffer a channel is lifted in, the edges repeat out to lifting_shape()
+    """
+    (rows, cols) = lifting_shape(channel.shape, levels)
+    buffer = np.empty((rows, cols), dtype=LIFTING[wavelet])
+    (h, w) = channel.shape
+    buffer[:h, :w] = channel
+    buffer[h:, :w] = buffer[h - 1:h, :w]
+    buffer[:, w:] = buffer[:, w - 1:w]
+    return buffer
+
+
+def mallat_subbands(buffer: np.ndarray, levels: int) -> list:
+    """
+    Views of the approximation and then the details of every level coarsest first, in the same order as pywt. Level l
+    leaves its approximation in the top left quarter of what it was given, the details in the other three
+    """
+    (rows, cols) = buffer.shape
+    subbands = [buffer[:rows >> levels, :cols >> levels]]
+    for l in range(levels, 0, -1):
+        (h, w) = (rows >> l, cols >> l)
+        subbands += [buffer[h:2 * h, :w], buffer[:h, w:2 * w], buffer[h:2 * h, w:2 * w]]
+    return subbands
+
+
+def lift(buffer: np.ndarray, wavelet: model.Wavelet, levels: int):
+    """
+    Forward transform in place, the rows then the columns of a level and then on to its approximation. Sorting the
+    low and high pass apart goes through the one scratch buffer, every axis of every level reuses it
+    """
+    (rows, cols) = buffer.shape
+    scratch = np.empty(buffer.size, dtype=buffer.dtype)
+    for l in range(levels):
+        region = buffer[:rows >> l, :cols >> l]
+        _lift_axis(region, wavelet, scratch)
+        _lift_axis(region.T, wavelet, scratch)
+
+
+def unlift(buffer: np.ndarray, wavelet: model.Wavelet, levels: int):
+    """
+    Invert lift(), from the coarsest level out
+    """
+    (rows, cols) = buffer.shape
+    scratch = np.empty(buffer.size, dtype=buffer.dtype)
+    for l in range(levels - 1, -1, -1):
+        region = buffer[:rows >> l, :cols >> l]
+        _unlift_axis(region.T, wavelet, scratch)
+        _unlift_axis(region, wavelet, scratch)
+
+
+def _lift_axis(region: np.ndarray, wavelet: model.Wavelet, scratch: np.ndarray):
+    """
+    One level along the first axis, low pass into the first half and high pass into the second. The edges are mirrored
+    """
+    (even, odd) = (region[0::2], region[1::2])
+    if wavelet == model.Wavelet.CDF_5_3:
+        _predict(odd, even, lambda a, b: -((a + b) >> 1))
+        _update(even, odd, lambda a, b: (a + b + 2) >> 2)
+    else:
+        (p1, u1, p2, u2) = CDF_9_7_STEPS
+        _predict(odd, even, lambda a, b: p1 * (a + b))
+        _update(even, odd, lambda a, b: u1 * (a + b))
+        _predict(odd, even, lambda a, b: p2 * (a + b))
+        _update(even, odd, lambda a, b: u2 * (a + b))
+        even *= 1 / CDF_9_7_SCALE
+        odd *= CDF_9_7_SCALE / 2
+    half = region.shape[0] // 2
+    work = _scratch_like(scratch, region)
+    (work[:half], work[half:]) = (even, odd)
+    region[:] = work
+
+
+def _unlift_axis(region: np.ndarray, wavelet: model.Wavelet, scratch: np.ndarray):
+    half = region.shape[0] // 2
+    work = _scratch_like(scratch, region)
+    work[:] = region
+    (even, odd) = (region[0::2], region[1::2])
+    (even[:], odd[:]) = (work[:half], work[half:])
+    if wavelet == model.Wavelet.CDF_5_3:
+        _update(even, odd, lambda a, b: -((a + b + 2) >> 2))
+        _predict(odd, even, lambda a, b: (a + b) >> 1)
+    else:
+        (p1, u1, p2, u2) = CDF_9_7_STEPS
+        even *= CDF_9_7_SCALE
+        odd *= 2 / CDF_9_7_SCALE
+        _update(even, odd, lambda a, b: -u2 * (a + b))
+        _predict(odd, even, lambda a, b: -p2 * (a + b))
+        _update(even, odd, lambda a, b: -u1 * (a + b))
+        _predict(odd, even, lambda a, b: -p1 * (a + b))
+
+
+def _scratch_like(scratch: np.ndarray, region: np.ndarray) -> np.ndarray:
+    """
+    The start of scratch as an array shaped like region and laid out the same way, the columns of a level are a
+    transposed view and copying those into row major order would go against the cache
+    """
+    if region.strides[0] < region.strides[1]:
+        return scratch[:region.size].reshape(region.shape[::-1]).T
+    return scratch[:region.size].reshape(region.shape)
+
+
+def _predict(odd: np.ndarray, even: np.ndarray, step):
+    """
+    odd[i] += step(even[i], even[i + 1]), past the end even mirrors back onto itself
+    """
+    odd[:-1] += step(even[:-1], even[1:])
+    odd[-1] += step(even[-1], even[-1])
+
+
+def _update(even: np.ndarray, odd: np.ndarray, step):
+    """
+    even[i] += step(odd[i - 1], odd[i]), before the start odd mirrors onto itself
+    """
+    even[1:] += step(odd[:-1], odd[1:])
+    even[0] += step(odd[0], odd[0])
+
+
 def linearize_subband(subbands):
     """
     Unravel the subbands so I can do general transforms irrespective of the subbands
@@ -218,8 +364,21 @@ def subband_view(pyramid: List[np.ndarray]):
 
 def wavelet_merge_resolutions(pyramid: List[np.ndarray], wavelet: model.Wavelet):
     """
-    Since hombln just had to unravel the output of .wavedec2(), I need to reconstruct here!
-    """
+    Since hombln just had to unravel the output of .wavedec2(), I need to reconstruct here! The lifting wavelets copy
+    the subbands back into one buffer and invert in place, which comes back as big as that buffer
+    """
+    if wavelet in LIFTING:
+        levels = (len(pyramid) - 1) // 3
+        (h, w) = np.shape(pyramid[0])
+        buffer = np.empty((h << levels, w << levels), dtype=LIFTING[wavelet])
+        integer = np.issubdtype(buffer.dtype, np.integer)
+        for (view, subband) in zip(mallat_subbands(buffer, levels), pyramid):
+            if integer and not np.issubdtype(np.asarray(subband).dtype, np.integer):
+                # dequantized 5/3 coefficients are rounded back to what the integer lifting works on
+                subband = np.rint(subband)
+            view[:] = subband
+        unlift(buffer, wavelet, levels)
+        return buffer
     coeffs = subband_view(pyramid)
     return pywt.waverec2(coeffs, wavelet.value)
 
@@ -228,15 +387,8 @@ def threshold(arr: np.ndarray, thresh, replace=0):
     """
     Supposedly scipy.stats has this, but I must not have the version. I'll search for it later.
     """
-
-    def _vec(ele):
-        if abs(ele) < thresh:
-            return replace
-        else:
-            return ele
-
-    vector = np.vectorize(_vec)
-    return vector(arr)
+    arr = np.asarray(arr)
+    return np.where(np.abs(arr) < thresh, replace, arr)
 
 
 def threshold_channel_by_quality(parts: List[np.ndarray], q_factor=1):
@@ -244,8 +396,10 @@ def threshold_channel_by_quality(parts: List[np.ndarray], q_factor=1):
     Actually apply the threshold after calculating the value. We take an array in parts since most likely
     our call is from the Wavelet compression where we have a series of images from the filter bank.
     """
-    imgs = [utils.img_as_list(img) for img in parts]
-    vals = utils.flatten(imgs)
+    if q_factor >= 1:
+        # the cutoff would be the smallest coefficient and nothing is smaller than that in magnitude
+        return list(parts)
+    vals = np.concatenate([np.ravel(p) for p in parts])
     val = qz.quality_threshold_value(vals, q_factor)
     return [threshold(i, val) for i in parts]
 
@@ -261,9 +415,23 @@ def ac_components(blocks: np.ndarray):
     """
     Return the AC components for blocks (JPEG)
     """
-    block_list = blocks.tolist()
-    zigs = [zigzag(m)[1:] for m in block_list]
-    return utils.flatten(zigs)
+    return zigzag(blocks)[:, 1:].ravel()
+
+
+def reversible_color(rgb_image: np.ndarray) -> np.ndarray:
+    """
+    Green and then red and blue less green, all mod 256 (and centered on 128) so the channels stay 8 bits and nothing
+    is lost. Not much of a luminance, but YCrCb in 8 bits rounds
+    """
+    rgb = rgb_image.astype(np.int16)
+    green = rgb[..., 1]
+    return np.stack([green, rgb[..., 0] - green + 128, rgb[..., 2] - green + 128], axis=-1).astype(np.uint8)
+
+
+def inverse_reversible_color(gcrcb: np.ndarray) -> np.ndarray:
+    g = gcrcb.astype(np.int16)
+    green = g[..., 0]
+    return np.stack([g[..., 1] + green - 128, green, g[..., 2] + green - 128], axis=-1).astype(np.uint8)
 
 
 def force_merge(lu, c1, c2):
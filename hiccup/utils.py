@@ -1,4 +1,7 @@
+import atexit
 import functools
+import concurrent.futures
+import multiprocessing
 from typing import List
 
 import cv2
@@ -19,9 +22,12 @@ def debug_img(img):
             break
 
 
-def debug_msg(msg):
+def debug_msg(msg, *args):
+    """
+    Pass the arguments along rather than formatting them yourself, nothing gets formatted unless we are printing
+    """
     if settings.DEBUG:
-        print("%s %s" % (datetime.datetime.utcnow(), msg))
+        print("%s %s" % (datetime.datetime.utcnow(), msg % args if args else msg))
 
 
 def group_tuples(l, n):
@@ -132,6 +138,75 @@ def dict_map(d, f):
     return dict(items)
 
 
+_executors = {}
+
+
+def executor_pool(kind: str, workers: int) -> concurrent.futures.Executor:
+    """
+    Pools are kept around, spinning up processes per image would eat whatever we gain
+    """
+    key = (kind, workers)
+    if key not in _executors:
+        if kind == "thread":
+            _executors[key] = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        elif kind == "process":
+            _executors[key] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise RuntimeError("Unknown executor: " + kind)
+    return _executors[key]
+
+
+@atexit.register
+def _shutdown_executors():
+    for pool in _executors.values():
+        pool.shutdown()
+    _executors.clear()
+
+
+def process_workers(workers: int) -> int:
+    """
+    How many processes a pool may have. Inside a worker process that is 1: every nested pool would start its own
+    processes (oversubscribing the cores) and forking from a process that has threads going can hang
+    """
+    return 1 if multiprocessing.parent_process() is not None else workers
+
+
+def settings_snapshot() -> dict:
+    return dict([(k, v) for (k, v) in vars(settings).items() if k.isupper()])
+
+
+def call_with_settings(snapshot: dict, f, k, v):
+    """
+    Worker processes may not have been forked from us (or were forked before someone fiddled with the settings) so
+    bring the settings along
+    """
+    for (name, value) in snapshot.items():
+        setattr(settings, name, value)
+    return f(k, v)
+
+
+def channel_map(d, f, workers: int = None, executor: str = None):
+    """
+    dict_map() but every channel runs concurrently. Defaults to CHANNEL_WORKERS and CHANNEL_EXECUTOR, with one worker
+    this is just dict_map(). For processes f and the values have to pickle, so module level functions (or partials of
+    them) only.
+    """
+    workers = settings.CHANNEL_WORKERS if workers is None else workers
+    executor = settings.CHANNEL_EXECUTOR if executor is None else executor
+    if executor == "process":
+        workers = process_workers(workers)
+    if workers <= 1 or len(d) <= 1:
+        return dict_map(d, f)
+
+    pool = executor_pool(executor, workers)
+    if executor == "process":
+        snapshot = settings_snapshot()
+        futures = [(k, pool.submit(call_with_settings, snapshot, f, k, v)) for (k, v) in d.items()]
+    else:
+        futures = [(k, pool.submit(f, k, v)) for (k, v) in d.items()]
+    return dict([(k, future.result()) for (k, future) in futures])
+
+
 def is_gray(img: np.ndarray):
     """
     Might want later, take the hackers approach and just assume 2d matrices are always gray images
@@ -24,7 +24,6 @@ setup(
         "opencv-python",
         "rawpy",
         "PyWavelets",
-        "scipy",
-        "bitstring"
+        "scipy"
     ],
 )